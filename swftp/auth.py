@@ -1,6 +1,9 @@
 """
 See COPYING for license information.
 """
+from functools import partial
+import hashlib
+import os
 import urlparse
 
 from zope.interface import implements
@@ -9,7 +12,11 @@ from twisted.web.client import HTTPConnectionPool
 from twisted.python import log
 from twisted.cred import checkers, error, credentials
 
-from swftp.swift import ThrottledSwiftConnection, UnAuthenticated, UnAuthorized
+from swftp.balancer import EndpointBalancer
+from swftp.swift import (
+    ThrottledSwiftConnection, UnAuthenticated, UnAuthorized, encode_utf8)
+from swftp.utils import (
+    LRUCache, FairScheduler, AIMDLimiter, RetryPolicy)
 from swftp import USER_AGENT
 
 
@@ -19,12 +26,35 @@ class SwiftBasedAuthDB(object):
 
         Implements twisted.cred.ICredentialsChecker
 
+        All connections handed out by this checker share a single
+        HTTPConnectionPool (and therefore keep-alive connections to each
+        storage host) and a single FairScheduler for the global concurrency
+        limit, which shares it fairly between users. Per-session
+        concurrency is still enforced by each ThrottledSwiftConnection.
+
         :param auth_url: auth endpoint for swift
         :param int global_max_concurrency: The max concurrency for the entire
             server
         :param int max_concurrency: The max concurrency for each
             ThrottledSwiftConnection object
+        :param int timeout: How long idle persistent connections are kept
         :param bool verbose: verbose setting
+        :param int token_cache_size: max number of auth tokens to cache
+        :param int token_cache_ttl: seconds to reuse a cached auth token for
+            repeat logins with the same credentials. 0 disables the cache
+        :param int adaptive_max_concurrency: if set, the global concurrency
+            starts at global_max_concurrency and adapts to how swift copes,
+            up to this many requests
+        :param int max_retries: how many times to retry idempotent requests
+            that fail with a 5xx or a connection error. 0 disables retries
+        :param float retry_backoff: seconds to wait (at most) before the
+            first retry. Each retry after that waits up to twice as long
+        :param float retry_budget: retries allowed per request, across all
+            connections
+        :param storage_endpoints: base URLs of swift proxies to spread
+            requests over, instead of using the storage URL's host
+        :param int endpoint_eject_time: seconds to stop using a proxy for
+            after a connection error
     """
     implements(checkers.ICredentialsChecker)
     credentialInterfaces = (
@@ -39,7 +69,15 @@ class SwiftBasedAuthDB(object):
                  extra_headers=None,
                  verbose=False,
                  rewrite_scheme=None,
-                 rewrite_netloc=None):
+                 rewrite_netloc=None,
+                 token_cache_size=1000,
+                 token_cache_ttl=0,
+                 adaptive_max_concurrency=0,
+                 max_retries=0,
+                 retry_backoff=0.1,
+                 retry_budget=0.1,
+                 storage_endpoints=None,
+                 endpoint_eject_time=30):
         self.auth_url = auth_url
         self.global_max_concurrency = global_max_concurrency
         self.max_concurrency = max_concurrency
@@ -49,6 +87,41 @@ class SwiftBasedAuthDB(object):
         self.rewrite_scheme = rewrite_scheme
         self.rewrite_netloc = rewrite_netloc
 
+        self.pool = HTTPConnectionPool(reactor, persistent=False)
+        self.pool.cachedConnectionTimeout = self.timeout
+        if self.global_max_concurrency or self.max_concurrency:
+            self.pool.persistent = True
+            self.pool.maxPersistentPerHost = \
+                self.global_max_concurrency or self.max_concurrency
+
+        self.scheduler = None
+        if self.global_max_concurrency:
+            limiter = None
+            if adaptive_max_concurrency:
+                limiter = AIMDLimiter(
+                    self.global_max_concurrency,
+                    max_limit=adaptive_max_concurrency)
+            self.scheduler = FairScheduler(
+                self.global_max_concurrency, limiter=limiter)
+
+        self.retry_policy = None
+        if max_retries:
+            self.retry_policy = RetryPolicy(
+                max_retries=max_retries, backoff=retry_backoff,
+                budget_ratio=retry_budget)
+
+        self.balancer = None
+        if storage_endpoints:
+            self.balancer = EndpointBalancer(
+                storage_endpoints, eject_time=endpoint_eject_time)
+
+        self.token_cache = None
+        if token_cache_ttl:
+            self.token_cache = LRUCache(
+                max_size=token_cache_size, ttl=token_cache_ttl)
+        # Credentials are only ever kept as a salted hash
+        self._token_cache_salt = os.urandom(16)
+
     def _rewrite_storage_url(self, connection):
         if not any((self.rewrite_scheme, self.rewrite_netloc)):
             return
@@ -77,41 +150,88 @@ class SwiftBasedAuthDB(object):
             new_parts['scheme'], new_parts['netloc'], new_parts['path'],
             new_parts['query'], new_parts['fragment']))
 
-    def _after_auth(self, result, connection):
+    def _token_cache_key(self, creds):
+        digest = hashlib.sha256(
+            self._token_cache_salt + encode_utf8(creds.password)).hexdigest()
+        return (creds.username, digest)
+
+    def _cache_token(self, connection, cache_key):
+        if self.token_cache is not None and connection.auth_token:
+            self.token_cache.set(
+                cache_key, (connection.storage_url, connection.auth_token))
+
+    def _after_auth(self, result, connection, cache_key=None):
         log.msg(metric='auth.succeed')
+        if cache_key:
+            self._cache_token(connection, cache_key)
         self._rewrite_storage_url(connection)
         return connection
 
+    def _after_reauth(self, result, connection, cache_key):
+        self._cache_token(connection, cache_key)
+        self._rewrite_storage_url(connection)
+        return result
+
     def requestAvatarId(self, c):
         creds = credentials.IUsernamePassword(c, None)
 
         if creds is not None:
             locks = []
-            pool = HTTPConnectionPool(reactor, persistent=False)
-            pool.cachedConnectionTimeout = self.timeout
             if self.max_concurrency:
-                pool.persistent = True
-                pool.maxPersistentPerHost = self.max_concurrency
                 locks.append(
                     defer.DeferredSemaphore(self.max_concurrency))
 
-            if self.global_max_concurrency:
-                locks.append(
-                    defer.DeferredSemaphore(self.global_max_concurrency))
-
             conn = ThrottledSwiftConnection(
                 locks, self.auth_url, creds.username, creds.password,
-                pool=pool,
+                pool=self.pool,
                 extra_headers=self.extra_headers,
                 verbose=self.verbose)
             conn.user_agent = USER_AGENT
-
-            d = conn.authenticate()
-            d.addCallback(self._after_auth, conn)
+            conn.scheduler = self.scheduler
+            conn.retry_policy = self.retry_policy
+            conn.balancer = self.balancer
+
+            cache_key = self._token_cache_key(creds)
+            # Expired tokens are refreshed by make_request's re-auth retry
+            conn.reauth_callback = partial(
+                self._after_reauth, connection=conn, cache_key=cache_key)
+
+            cached = None
+            if self.token_cache is not None:
+                cached = self.token_cache.get(cache_key)
+                if cached:
+                    log.msg(metric='auth.cache_hit')
+                else:
+                    log.msg(metric='auth.cache_miss')
+
+            if cached:
+                conn.storage_url, conn.auth_token = cached
+                d = defer.succeed(None)
+                d.addCallback(self._after_auth, conn)
+            else:
+                d = conn.authenticate()
+                d.addCallback(self._after_auth, conn, cache_key)
             d.addErrback(eb_failed_auth)
             return d
         return defer.fail(error.UnauthorizedLogin())
 
+    def token_connection(self, storage_url, auth_token):
+        """ Returns a connection that uses an auth token from an earlier
+        login. It has no credentials, so requests fail once the token
+        expires. """
+        conn = ThrottledSwiftConnection(
+            [], self.auth_url, None, None,
+            pool=self.pool,
+            extra_headers=self.extra_headers,
+            verbose=self.verbose)
+        conn.user_agent = USER_AGENT
+        conn.storage_url = storage_url
+        conn.auth_token = auth_token
+        conn.scheduler = self.scheduler
+        conn.retry_policy = self.retry_policy
+        conn.balancer = self.balancer
+        return conn
+
 
 def eb_failed_auth(failure):
     failure.trap(UnAuthenticated, UnAuthorized)
@@ -0,0 +1,207 @@
+"""
+Spreads requests to Swift over several proxy endpoints. Each request goes to
+the healthy endpoint with the fewest requests in progress, and endpoints that
+can't be reached are left out for a while.
+
+See COPYING for license information.
+"""
+import urlparse
+
+from twisted.application import service
+from twisted.internet import reactor, task
+from twisted.internet.error import ConnectError, TimeoutError
+from twisted.internet.protocol import Protocol
+from twisted.python import log
+from twisted.web.client import Agent, ResponseNeverReceived
+from twisted.web.http_headers import Headers
+
+from swftp import USER_AGENT
+
+# Path of the proxy healthcheck middleware, used by active probes
+HEALTHCHECK_PATH = '/healthcheck'
+
+
+class Endpoint(object):
+    " A proxy that requests can be sent to "
+    def __init__(self, scheme, netloc):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.outstanding = 0
+        self.failures = 0  # connection errors in a row
+        self.ejected_until = 0
+
+    def __repr__(self):
+        return '<Endpoint %s://%s>' % (self.scheme, self.netloc)
+
+
+class EndpointBalancer(object):
+    """ Picks the proxy endpoint for each request
+
+    Requests go to the endpoint with the fewest requests in progress. A
+    request counts until its response body has been received, so an
+    endpoint busy with slow downloads gets fewer new requests.
+
+    After max_failures connection errors in a row, an endpoint is ejected
+    for eject_time seconds. Ejections are counted in the endpoint.ejected
+    metric. With start_probes, every endpoint is also sent a HEAD request
+    for /healthcheck every so often. Endpoints that fail it are ejected, and
+    ejected endpoints that pass it are let back in. If every endpoint is
+    ejected, requests are spread over all of them anyway.
+
+    :param urls: base URLs of the endpoints, like http://10.0.0.1:8080
+    :param int max_failures: connection errors in a row that eject an
+        endpoint
+    :param int eject_time: seconds an endpoint is ejected for
+    :param clock: provider of seconds() and callLater(), defaults to the
+        reactor
+    """
+    def __init__(self, urls, max_failures=1, eject_time=30, clock=None):
+        self.endpoints = []
+        for url in urls:
+            parts = urlparse.urlsplit(url)
+            self.endpoints.append(Endpoint(parts.scheme, parts.netloc))
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.clock = clock or reactor
+        self.agent = None
+        self.probes = None
+        self._next = 0  # where ties start from, so they take turns
+
+    def healthy(self):
+        " Returns the endpoints that aren't ejected "
+        now = self.clock.seconds()
+        return [e for e in self.endpoints if e.ejected_until <= now]
+
+    def pick(self):
+        " Returns the endpoint to send the next request to "
+        candidates = self.healthy() or self.endpoints
+        self._next = (self._next + 1) % len(candidates)
+        candidates = candidates[self._next:] + candidates[:self._next]
+        return min(candidates, key=lambda e: e.outstanding)
+
+    def rewrite(self, url, endpoint):
+        " Returns url with its scheme and netloc replaced by the endpoint's "
+        parts = urlparse.urlsplit(url)
+        return urlparse.urlunsplit((endpoint.scheme, endpoint.netloc,
+                                    parts.path, parts.query, parts.fragment))
+
+    def track(self, endpoint, d):
+        """ Counts a request to the endpoint as in progress until its
+        response body is received.
+
+        :param d: Deferred that fires with the t.w.c.Response
+        """
+        endpoint.outstanding += 1
+        d.addCallbacks(self._cb_response, self._eb_request,
+                       callbackArgs=(endpoint,), errbackArgs=(endpoint,))
+        return d
+
+    def _cb_response(self, response, endpoint):
+        endpoint.failures = 0
+        deliverBody = response.deliverBody
+
+        def deliver(protocol):
+            deliverBody(ReleasingProtocol(protocol, endpoint))
+        response.deliverBody = deliver
+        return response
+
+    def _eb_request(self, reason, endpoint):
+        endpoint.outstanding -= 1
+        if reason.check(ConnectError, ResponseNeverReceived, TimeoutError):
+            self.failed(endpoint)
+        return reason
+
+    def failed(self, endpoint):
+        " Notes a connection error, ejecting the endpoint after too many "
+        endpoint.failures += 1
+        if endpoint.failures >= self.max_failures:
+            endpoint.failures = 0
+            self.eject(endpoint)
+
+    def eject(self, endpoint):
+        if endpoint.ejected_until <= self.clock.seconds():
+            log.msg('Ejecting %s for %s seconds' % (endpoint.netloc,
+                                                    self.eject_time))
+            log.msg(metric='endpoint.ejected')
+        endpoint.ejected_until = self.clock.seconds() + self.eject_time
+
+    def start_probes(self, interval, agent=None):
+        " Probes every endpoint each `interval` seconds "
+        self.agent = agent or Agent(reactor)
+        self.probes = task.LoopingCall(self.probe)
+        self.probes.clock = self.clock
+        self.probes.start(interval, now=False)
+
+    def stop_probes(self):
+        if self.probes and self.probes.running:
+            self.probes.stop()
+
+    def probe(self):
+        for endpoint in self.endpoints:
+            url = '%s://%s%s' % (endpoint.scheme, endpoint.netloc,
+                                 HEALTHCHECK_PATH)
+            d = self.agent.request(
+                'HEAD', url, Headers({'User-Agent': [USER_AGENT]}), None)
+            d.addCallbacks(self._cb_probe, self._eb_probe,
+                           callbackArgs=(endpoint,), errbackArgs=(endpoint,))
+
+    def _cb_probe(self, response, endpoint):
+        response.deliverBody(DiscardingProtocol())
+        if response.code == 200:
+            endpoint.failures = 0
+            endpoint.ejected_until = 0
+        else:
+            self.eject(endpoint)
+
+    def _eb_probe(self, reason, endpoint):
+        self.eject(endpoint)
+
+    def gauges(self):
+        " Returns callables for the current state of the endpoints, by name "
+        return {
+            'endpoint.healthy': lambda: len(self.healthy()),
+        }
+
+
+class ProbeService(service.Service):
+    """ Probes the endpoints of a balancer while the service is running
+
+    :param balancer: EndpointBalancer to probe the endpoints of
+    :param int interval: seconds between probes
+    :param agent: t.w.c.Agent to send the probes with
+    """
+    def __init__(self, balancer, interval, agent=None):
+        self.balancer = balancer
+        self.interval = interval
+        self.agent = agent
+
+    def startService(self):
+        service.Service.startService(self)
+        self.balancer.start_probes(self.interval, agent=self.agent)
+
+    def stopService(self):
+        self.balancer.stop_probes()
+        return service.Service.stopService(self)
+
+
+class ReleasingProtocol(Protocol):
+    " Passes a response body on and marks the request as done at the end "
+    def __init__(self, protocol, endpoint):
+        self.protocol = protocol
+        self.endpoint = endpoint
+
+    def makeConnection(self, transport):
+        self.protocol.makeConnection(transport)
+
+    def dataReceived(self, data):
+        self.protocol.dataReceived(data)
+
+    def connectionLost(self, reason):
+        self.endpoint.outstanding -= 1
+        self.protocol.connectionLost(reason)
+
+
+class DiscardingProtocol(Protocol):
+    " Stops the body of a probe response from being sent "
+    def makeConnection(self, transport):
+        transport.stopProducing()
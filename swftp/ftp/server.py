@@ -3,8 +3,9 @@ This file contains the primary server code for the FTP server.
 
 See COPYING for license information.
 """
+import fnmatch
 import stat
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from zope.interface import implements
 from twisted.protocols.ftp import (
@@ -12,16 +13,36 @@ from twisted.protocols.ftp import (
     CmdNotImplementedForArgError, IsNotADirectoryError, IsADirectoryError,
     RESPONSE, TOO_MANY_CONNECTIONS)
 from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectionLost
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import Protocol
 from twisted.python import log
+from twisted.python.filepath import Permissions
 from twisted.protocols.ftp import (
     CmdArgSyntaxError, BadCmdSequenceError,
-    REQ_FILE_ACTN_PENDING_FURTHER_INFO, PortConnectionError
+    REQ_FILE_ACTN_PENDING_FURTHER_INFO, PortConnectionError, FTPCmdError,
+    DATA_CNX_ALREADY_OPEN_START_XFR, TXFR_COMPLETE_OK,
+    CNX_CLOSED_TXFR_ABORTED, InvalidPath, toSegments, DTP
 )
 
 from swftp.logging import msg
 from swftp.swiftfilesystem import SwiftFileSystem, swift_stat, obj_to_path
-from swftp.swift import NotFound, Conflict
+from swftp.swift import NotFound, Conflict, encode_utf8
+
+
+def _list_permissions():
+    """ Returns what LIST lines take the permissions of an entry as.
+    Newer Twisted releases format them from a filepath.Permissions, older
+    ones from the plain mode. """
+    try:
+        DTP()._formatOneListResponse(
+            'name', 0, False, Permissions(0644), 1, 0, 'owner', 'group')
+    except (AttributeError, TypeError):
+        return int
+    return Permissions
+
+
+LIST_PERMISSIONS = _list_permissions()
 
 
 def stat_format(keys, props):
@@ -33,7 +54,7 @@ def stat_format(keys, props):
         elif key == 'directory':
             val = st.st_mode & stat.S_IFDIR == stat.S_IFDIR
         elif key == 'permissions':
-            val = st.st_mode
+            val = LIST_PERMISSIONS(stat.S_IMODE(st.st_mode))
         elif key == 'hardlinks':
             val = st.st_nlink
         elif key == 'modified':
@@ -48,6 +69,96 @@ def stat_format(keys, props):
     return l
 
 
+LIST_KEYS = ('size', 'directory', 'permissions', 'hardlinks', 'modified',
+             'owner', 'group')
+
+
+class ListingProducer(object):
+    """ Writes a directory listing to the data connection one page at a time.
+    Registered as a streaming producer on the data connection's transport so
+    that fetching more pages stops while the client isn't keeping up.
+
+    :param listing: swftp.swiftfilesystem.SwiftListing instance
+    :param send_entry: callable(name, entry) that writes one entry
+    :param consumer: transport of the data connection
+    """
+    implements(IPushProducer)
+
+    def __init__(self, listing, send_entry, consumer):
+        self.listing = listing
+        self.send_entry = send_entry
+        self.consumer = consumer
+        self.entries = deque()
+        self.finished = defer.Deferred()
+        self.paused = False
+        self.fetching = False
+        self._sending = False
+
+    def start(self, page):
+        """ Starts writing, beginning with the already fetched first page.
+
+        @returns Deferred that fires once the whole listing is written
+        """
+        d = self.finished
+        self.entries.extend(page)
+        self.consumer.registerProducer(self, True)
+        self._send()
+        return d
+
+    def _send(self):
+        self._sending = True
+        try:
+            while not self.paused and self.finished is not None:
+                if self.entries:
+                    self.send_entry(*self.entries.popleft())
+                elif self.listing.done:
+                    self._finish()
+                elif not self.fetching:
+                    self.fetching = True
+                    self.listing.next_page().addCallbacks(
+                        self._cb_page, self._eb_page)
+                else:
+                    break
+        finally:
+            self._sending = False
+
+    def _cb_page(self, page):
+        self.fetching = False
+        self.entries.extend(page)
+        if not self._sending:
+            self._send()
+
+    def _eb_page(self, failure):
+        self.fetching = False
+        self._finish(failure)
+
+    def _finish(self, failure=None):
+        if self.finished is None:
+            return
+        d, self.finished = self.finished, None
+        self.listing.close()
+        self.consumer.unregisterProducer()
+        if failure:
+            d.errback(failure)
+        else:
+            d.callback(None)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._send()
+
+    def stopProducing(self):
+        self._finish(failure=ConnectionLost())
+
+
+def is_glob(segments):
+    " True if the last path segment is a shell-style glob "
+    return bool(segments) and any(c in segments[-1] for c in '*?[')
+
+
 class SwftpFTPProtocol(FTP, object):
     _connCountMap = defaultdict(int)
     maxConnectionsPerUser = 10
@@ -99,18 +210,90 @@ class SwftpFTPProtocol(FTP, object):
         return d
 
     def ftp_LIST(self, path=''):
+        """ Overwritten to write the listing to the data connection a page at
+            a time as it comes in from Swift """
+        if self.dtpInstance is None or not self.dtpInstance.isConnected:
+            return defer.fail(
+                BadCmdSequenceError('must send PORT or PASV before RETR'))
+
         # ignore special flags for command LIST
         keys = ['-a', '-l', '-la', '-al']
         segm = path.split()
         path = " ".join(s for s in segm if s.lower() not in keys)
 
-        return super(SwftpFTPProtocol, self).ftp_LIST(path)
+        try:
+            segments = toSegments(self.workingDirectory, path)
+        except InvalidPath:
+            return defer.fail(FileNotFoundError(path))
+
+        def send_entry(name, props):
+            self.dtpInstance.sendListResponse(
+                encode_utf8(name), stat_format(LIST_KEYS, props))
+
+        def gotListing(result):
+            self.reply(DATA_CNX_ALREADY_OPEN_START_XFR)
+            return self._sendListing(result, send_entry)
+
+        d = self.shell.listPages(segments)
+        d.addCallback(gotListing)
+        return d
 
     def ftp_NLST(self, path=''):
         """
-        Overwrite for fix http://twistedmatrix.com/trac/ticket/4258
+        Overwrite for fix http://twistedmatrix.com/trac/ticket/4258 and to
+        write the listing a page at a time, like ftp_LIST
         """
-        return super(SwftpFTPProtocol, self).ftp_NLST(path)
+        if self.dtpInstance is None or not self.dtpInstance.isConnected:
+            return defer.fail(
+                BadCmdSequenceError('must send PORT or PASV before RETR'))
+
+        try:
+            segments = toSegments(self.workingDirectory, path)
+        except InvalidPath:
+            return defer.fail(FileNotFoundError(path))
+
+        glob = None
+        if is_glob(segments):
+            glob = segments.pop()
+
+        def send_entry(name, props):
+            if not glob or fnmatch.fnmatch(name, glob):
+                self.dtpInstance.sendLine(encode_utf8(name))
+
+        def gotListing(result):
+            self.reply(DATA_CNX_ALREADY_OPEN_START_XFR)
+            return self._sendListing(result, send_entry)
+
+        def listErr(failure):
+            # RFC 959 only allows directory listings, so send nothing
+            failure.trap(FileNotFoundError)
+            self.dtpInstance.transport.loseConnection()
+            return (TXFR_COMPLETE_OK,)
+
+        d = self.shell.listPages(segments)
+        d.addCallbacks(gotListing, listErr)
+        return d
+
+    def _sendListing(self, result, send_entry):
+        page, listing = result
+        transport = self.dtpInstance.transport
+        producer = ListingProducer(listing, send_entry, transport)
+
+        def cb(_):
+            transport.loseConnection()
+            return (TXFR_COMPLETE_OK,)
+
+        def err(failure):
+            transport.loseConnection()
+            if failure.check(FTPCmdError):
+                return failure
+            if not failure.check(ConnectionLost):
+                log.err(failure, 'Listing aborted')
+            return (CNX_CLOSED_TXFR_ABORTED,)
+
+        d = producer.start(page)
+        d.addCallbacks(cb, err)
+        return d
 
     def ftp_PASV(self):
         d = super(SwftpFTPProtocol, self).ftp_PASV()
@@ -171,8 +354,6 @@ class SwiftFTPShell(object):
 
     def logout(self):
         self.log_command('logout')
-        if self.swiftconn.pool:
-            self.swiftconn.pool.closeCachedConnections()
         del self.swiftconn
 
     def _fullpath(self, path_parts):
@@ -288,12 +469,33 @@ class SwiftFTPShell(object):
         d.addErrback(err)
         return d
 
+    def listPages(self, path=None):
+        """ Like list(), but only waits for the first page of the listing.
+
+        @returns Deferred that fires with a (page, listing) tuple. page is a
+            list of (name, properties) tuples and listing is the SwiftListing
+            that produces the rest of them.
+        """
+        self.log_command('list', path)
+        fullpath = self._fullpath(path)
+        listing = self.swiftfilesystem.get_listing(fullpath)
+
+        def err(failure):
+            failure.trap(NotFound)
+            return defer.fail(FileNotFoundError(fullpath))
+
+        d = listing.next_page()
+        d.addCallback(lambda page: (page, listing))
+        d.addErrback(err)
+        return d
+
     def openForReading(self, path):
         self.log_command('openForReading', path)
         fullpath = self._fullpath(path)
 
         def cb(results):
-            return SwiftReadFile(self.swiftfilesystem, fullpath)
+            return SwiftReadFile(
+                self.swiftfilesystem, fullpath, size=int(results['size']))
 
         def err(failure):
             failure.trap(NotFound)
@@ -338,9 +540,10 @@ class SwiftWriteFile(object):
 class SwiftReadFile(Protocol):
     implements(IReadFile)
 
-    def __init__(self, swiftfilesystem, fullpath):
+    def __init__(self, swiftfilesystem, fullpath, size=None):
         self.swiftfilesystem = swiftfilesystem
         self.fullpath = fullpath
+        self.size = size
         self.finished = defer.Deferred()
         self.backend_transport = None
         self.timeout = None
@@ -366,7 +569,7 @@ class SwiftReadFile(Protocol):
             del consumer.rest_offset  # reset for next command
         self.consumer = consumer
         d = self.swiftfilesystem.startFileDownload(
-            self.fullpath, self, offset=at)
+            self.fullpath, self, offset=at, size=self.size)
         d.addCallback(lambda _: self.finished)
         self.consumer.registerProducer(self, True)
         return d
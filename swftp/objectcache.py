@@ -0,0 +1,292 @@
+"""
+A local disk cache for whole objects. SwiftFileSystem uses it to serve
+objects that are downloaded over and over from disk, after checking with a
+conditional GET that they haven't changed.
+
+See COPYING for license information.
+"""
+import hashlib
+import mmap
+import os
+import tempfile
+
+from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectionAborted
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Protocol
+from twisted.python import failure, log
+from twisted.web._newclient import ResponseDone
+
+from zope import interface
+
+from swftp.swift import parse_content_range
+from swftp.utils import OrderedDict
+
+CACHE_FILE_PREFIX = 'obj-'
+TEMP_FILE_PREFIX = 'tmp-'
+
+
+def response_header(response, name):
+    " Returns the last value of a header of a t.w.c.Response, or None "
+    values = response.headers.getRawHeaders(name)
+    if values:
+        return values[-1]
+
+
+def unlink(filename):
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
+
+class CacheEntry(object):
+    " An object kept in an ObjectCache "
+    def __init__(self, key, filename, size, etag, last_modified=None):
+        self.key = key
+        self.filename = filename
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def conditional_headers(self):
+        " Headers for a GET that only returns the object if it has changed "
+        headers = {'If-None-Match': '"%s"' % self.etag.strip('"')}
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ObjectCache(object):
+    """ Keeps whole objects in files under `path`, up to max_size bytes in
+    total, and evicts the least recently used ones to make room.
+
+    Entries are keyed by account, container and object, and remember the
+    ETag and Last-Modified of the copy that was stored so it can be
+    revalidated. The index only lives in memory, so files left behind by an
+    earlier process are removed on startup.
+
+    :param str path: directory to keep the files in
+    :param int max_size: max number of bytes to keep
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in os.listdir(path):
+            if name.startswith((CACHE_FILE_PREFIX, TEMP_FILE_PREFIX)):
+                unlink(os.path.join(path, name))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        " Returns the CacheEntry for key, or None "
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return entry
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+            unlink(entry.filename)
+
+    def temp_file(self):
+        " Returns (file, filename) of a new file to write an object to "
+        fd, filename = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX, dir=self.path)
+        return os.fdopen(fd, 'wb'), filename
+
+    def add(self, key, temp_filename, size, etag, last_modified=None):
+        """ Stores the object written to temp_filename as the copy of key,
+        evicting other objects to make room for it """
+        self.remove(key)
+        if size > self.max_size:
+            unlink(temp_filename)
+            return
+        while self.entries and self.size + size > self.max_size:
+            _, oldest = self.entries.popitem(last=False)
+            self.size -= oldest.size
+            unlink(oldest.filename)
+        filename = os.path.join(
+            self.path, CACHE_FILE_PREFIX + hashlib.sha1(repr(key)).hexdigest())
+        os.rename(temp_filename, filename)
+        self.entries[key] = CacheEntry(key, filename, size, etag,
+                                       last_modified)
+        self.size += size
+
+
+class CachingReceiver(Protocol):
+    """ Passes the body of a GET for a whole object on to `consumer` and
+    writes a copy of it to the cache. The copy is added to the cache once
+    the body has arrived intact and cb_response has seen the headers, in
+    whichever order those happen.
+
+    :param cache: ObjectCache to add the object to
+    :param key: key to add the object as
+    :param consumer: twisted.internet.protocol.Protocol to pass the body to
+    :param int size: size of the object, if known. The response's own is
+        used instead once cb_response has it
+    """
+    def __init__(self, cache, key, consumer, size=None):
+        self.cache = cache
+        self.key = key
+        self.consumer = consumer
+        self.size = size
+        self.etag = None
+        self.last_modified = None
+        self.received = 0
+        self.caching = size is None or size <= cache.max_size
+        self.response = None
+        self.reason = None
+        self.file = None
+        self.filename = None
+
+    def cb_response(self, response):
+        " Checks the response headers to see if the object can be cached "
+        self.response = response
+        self.etag = response_header(response, 'etag')
+        self.last_modified = response_header(response, 'last-modified')
+        # The size the download started with may be out of date
+        content_range = parse_content_range(
+            response_header(response, 'content-range'))
+        if content_range is not None and content_range[2] is not None:
+            self.size = content_range[2]
+        elif response.code == 200 \
+                and isinstance(response.length, (int, long)):
+            self.size = response.length
+        if self.etag is None or self.size is None \
+                or self.size > self.cache.max_size:
+            self._discard()
+        if self.reason is not None:
+            self._store()
+        return response
+
+    def connectionMade(self):
+        self.consumer.makeConnection(self.transport)
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        if self.caching:
+            try:
+                if self.file is None:
+                    self.file, self.filename = self.cache.temp_file()
+                self.file.write(data)
+            except (IOError, OSError):
+                log.err(None, 'Could not write to the object cache')
+                self._discard()
+        self.consumer.dataReceived(data)
+
+    def connectionLost(self, reason):
+        self.reason = reason
+        if self.response is not None:
+            self._store()
+        self.consumer.connectionLost(reason)
+
+    def _store(self):
+        if self.caching and self.reason.check(ResponseDone) \
+                and self.received == self.size:
+            try:
+                if self.file is None:
+                    self.file, self.filename = self.cache.temp_file()
+                self.file.close()
+                self.file = None
+                self.cache.add(self.key, self.filename, self.size, self.etag,
+                               self.last_modified)
+            except (IOError, OSError):
+                log.err(None, 'Could not add to the object cache')
+                unlink(self.filename)
+        self._discard()
+
+    def _discard(self):
+        self.caching = False
+        if self.file is not None:
+            self.file.close()
+            unlink(self.filename)
+            self.file = None
+
+
+class CachedFileReader(object):
+    """ Delivers an object from the cache to `consumer` as if it were the body
+    of a GET, and is the consumer's transport so it can pause, resume and
+    stop it. The file is memory mapped, so the data is sliced straight out of
+    the page cache instead of being read into another buffer first.
+
+    :param entry: CacheEntry to read
+    :param consumer: twisted.internet.protocol.Protocol to deliver data to
+    :param int offset: where in the object to start
+    """
+    interface.implements(IPushProducer)
+    chunk_size = 64 * 1024
+    chunks_per_turn = 16
+
+    def __init__(self, entry, consumer, offset=0, clock=None):
+        self.entry = entry
+        self.consumer = consumer
+        self.offset = offset
+        self.clock = clock or reactor
+        self.data = None
+        self.paused = False
+        self.stopped = False
+        self._call = None
+
+    def start(self):
+        """ Opens the file and starts delivering it. Raises IOError or OSError
+        if the file can't be read.
+
+        @returns Deferred that fires with the CacheEntry
+        """
+        if self.entry.size:
+            with open(self.entry.filename, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = ''
+        self.consumer.makeConnection(self)
+        self._schedule()
+        return defer.succeed(self.entry)
+
+    def _schedule(self):
+        if self._call is None and not self.paused and not self.stopped:
+            self._call = self.clock.callLater(0, self._deliver)
+
+    def _deliver(self):
+        self._call = None
+        sent = 0
+        for _ in range(self.chunks_per_turn):
+            if self.paused or self.stopped:
+                break
+            if self.offset >= len(self.data):
+                self._finish(failure.Failure(ResponseDone()))
+                break
+            chunk = self.data[self.offset:self.offset + self.chunk_size]
+            self.offset += len(chunk)
+            sent += len(chunk)
+            self.consumer.dataReceived(chunk)
+        if sent:
+            log.msg(metric='cache.bytes_saved', count=sent)
+        self._schedule()
+
+    def _finish(self, reason):
+        self.stopped = True
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.consumer.connectionLost(reason)
+
+    # IPushProducer
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._schedule()
+
+    def stopProducing(self):
+        if not self.stopped:
+            self._finish(failure.Failure(ConnectionAborted()))
@@ -52,6 +52,21 @@ class SwiftSession(object):
         self.avatar.conn.transport.transport.loseConnection()
 
 
+class SwiftSessionChannel(session.SSHSession):
+    """ SSHSession that calls its window_listeners whenever the client makes
+        room in the channel's window, so a download that paused for a full
+        session buffer can resume as soon as it drains.
+    """
+    def __init__(self, *args, **kwargs):
+        session.SSHSession.__init__(self, *args, **kwargs)
+        self.window_listeners = []
+
+    def addWindowBytes(self, data):
+        session.SSHSession.addWindowBytes(self, data)
+        for listener in list(self.window_listeners):
+            listener()
+
+
 class SwiftFileTransferServer(FileTransferServer):
     client = None
     transport = None
@@ -62,6 +77,32 @@ class SwiftFileTransferServer(FileTransferServer):
         fileObj.session = self.transport.session
         FileTransferServer._cbOpenFile(self, fileObj, requestId)
 
+    # Overridden because SwiftDirectory returns a Deferred while it waits on
+    # the next page of the listing. The original drops the result in that
+    # case instead of returning it.
+    def _scanDirectory(self, dirIter, f):
+        while len(f) < 250:
+            try:
+                info = dirIter.next()
+            except StopIteration:
+                info = None
+            if isinstance(info, defer.Deferred):
+                return info.addCallback(self._cbScanDirectory, dirIter, f)
+            if info is None:
+                if not f:
+                    raise EOFError
+                return f
+            f.append(info)
+        return f
+
+    def _cbScanDirectory(self, result, dirIter, f):
+        if result is None:
+            if not f:
+                raise EOFError
+            return f
+        f.append(result)
+        return self._scanDirectory(dirIter, f)
+
     # This is overridden because Flow was sending data that looks to be invalid
     def packet_REALPATH(self, data):
         requestId = data[:4]
@@ -155,7 +196,7 @@ class SwiftSFTPUser(avatar.ConchUser):
         avatar.ConchUser.__init__(self)
         self.swiftconn = swiftconn
 
-        self.channelLookup.update({"session": session.SSHSession})
+        self.channelLookup.update({"session": SwiftSessionChannel})
         self.subsystemLookup.update({"sftp": SwiftFileTransferServer})
 
         self.cwd = ''
@@ -166,8 +207,6 @@ class SwiftSFTPUser(avatar.ConchUser):
     def logout(self):
         """ Log-out/clean up avatar-related things """
         self.log_command('logout')
-        if self.swiftconn.pool:
-            self.swiftconn.pool.closeCachedConnections()
         del self.swiftconn
 
     def log_command(self, command, *args):
@@ -322,7 +361,7 @@ class SFTPServerForSwiftConchUser(object):
             failure.trap(NotFound)
             raise SFTPError(FX_FAILURE, 'Not Found')
 
-        d = directory.get_full_listing()
+        d = directory.get_first_page()
         d.addCallback(cb)
         d.addErrback(errback)
         return d
@@ -25,15 +25,41 @@ CONFIG_DEFAULTS = {
 
     'rewrite_storage_scheme': '',
     'rewrite_storage_netloc': '',
+    'storage_endpoints': '',
+    'endpoint_eject_time': '30',
+    'endpoint_probe_interval': '0',
 
     'priv_key': '/etc/swftp/id_rsa',
     'pub_key': '/etc/swftp/id_rsa.pub',
     'num_persistent_connections': '100',
     'num_connections_per_session': '10',
+    'max_adaptive_connections': '0',
+    'max_retries': '3',
+    'retry_backoff': '0.1',
+    'retry_budget': '0.1',
     'connection_timeout': '240',
     'sessions_per_user': '10',
     'extra_headers': '',
     'verbose': 'false',
+    'auth_token_cache_ttl': '300',
+    'auth_token_cache_size': '1000',
+    'attr_cache_ttl': '0',
+    'attr_cache_size': '10000',
+    'attr_cache_shared': 'false',
+    'listing_concurrency': '1',
+    'download_concurrency': '1',
+    'download_range_size': '16777216',
+    'upload_segment_size': '0',
+    'upload_concurrency': '2',
+    'transfer_memory_budget': '0',
+    'object_cache_dir': '',
+    'object_cache_size': '1073741824',
+    'upload_spool_dir': '',
+    'upload_spool_size': '10737418240',
+    'upload_spool_ack': 'commit',
+    'rename_concurrency': '4',
+    'recursive_rmdir': 'false',
+    'delete_concurrency': '10',
 
     'log_statsd_host': '',
     'log_statsd_port': '8125',
@@ -152,8 +178,10 @@ def makeService(options):
     from swftp.realm import SwftpRealm
     from swftp.sftp.server import SwiftSSHUserAuthServer
     from swftp.auth import SwiftBasedAuthDB
+    from swftp.swiftfilesystem import SwiftFileSystem
     from swftp.utils import (
-        log_runtime_info, GLOBAL_METRICS, parse_key_value_config)
+        log_runtime_info, GLOBAL_METRICS, parse_key_value_config, LRUCache,
+        TransferBudget)
 
     c = get_config(options['config_file'], options)
 
@@ -178,6 +206,19 @@ def makeService(options):
         except ImportError:
             sys.stderr.write('Missing Statsd Module. Requires "txstatsd" \n')
 
+    transfer_budget = TransferBudget(
+        c.getint('sftp', 'transfer_memory_budget'))
+    gauges = transfer_budget.gauges()
+
+    upload_spool = None
+    if c.get('sftp', 'upload_spool_dir'):
+        from swftp.spool import UploadSpool
+        upload_spool = UploadSpool(
+            c.get('sftp', 'upload_spool_dir'),
+            c.getint('sftp', 'upload_spool_size'),
+            ack=c.get('sftp', 'upload_spool_ack'))
+        gauges.update(upload_spool.gauges())
+
     if c.get('sftp', 'stats_host'):
         from swftp.report import makeService as makeReportService
         known_fields = [
@@ -195,7 +236,8 @@ def makeService(options):
         makeReportService(
             c.get('sftp', 'stats_host'),
             c.getint('sftp', 'stats_port'),
-            known_fields=known_fields
+            known_fields=known_fields,
+            gauges=gauges,
         ).setServiceParent(sftp_service)
 
     authdb = SwiftBasedAuthDB(
@@ -207,7 +249,68 @@ def makeService(options):
         verbose=c.getboolean('sftp', 'verbose'),
         rewrite_scheme=c.get('sftp', 'rewrite_storage_scheme'),
         rewrite_netloc=c.get('sftp', 'rewrite_storage_netloc'),
+        token_cache_size=c.getint('sftp', 'auth_token_cache_size'),
+        token_cache_ttl=c.getint('sftp', 'auth_token_cache_ttl'),
+        adaptive_max_concurrency=c.getint(
+            'sftp', 'max_adaptive_connections'),
+        max_retries=c.getint('sftp', 'max_retries'),
+        retry_backoff=c.getfloat('sftp', 'retry_backoff'),
+        retry_budget=c.getfloat('sftp', 'retry_budget'),
+        storage_endpoints=[
+            url.strip()
+            for url in c.get('sftp', 'storage_endpoints').split(',')
+            if url.strip()],
+        endpoint_eject_time=c.getint('sftp', 'endpoint_eject_time'),
     )
+    if authdb.scheduler:
+        gauges.update(authdb.scheduler.gauges())
+    if authdb.retry_policy:
+        gauges.update(authdb.retry_policy.gauges())
+    if authdb.balancer:
+        gauges.update(authdb.balancer.gauges())
+        if c.getint('sftp', 'endpoint_probe_interval'):
+            from swftp.balancer import ProbeService
+            ProbeService(
+                authdb.balancer, c.getint('sftp', 'endpoint_probe_interval'),
+            ).setServiceParent(sftp_service)
+
+    SwiftFileSystem.attr_cache_ttl = c.getint('sftp', 'attr_cache_ttl')
+    SwiftFileSystem.attr_cache_size = c.getint('sftp', 'attr_cache_size')
+    SwiftFileSystem.shared_attr_cache = None
+    if SwiftFileSystem.attr_cache_ttl and \
+            c.getboolean('sftp', 'attr_cache_shared'):
+        SwiftFileSystem.shared_attr_cache = LRUCache(
+            max_size=SwiftFileSystem.attr_cache_size,
+            ttl=SwiftFileSystem.attr_cache_ttl)
+    SwiftFileSystem.listing_concurrency = c.getint(
+        'sftp', 'listing_concurrency')
+    SwiftFileSystem.download_concurrency = c.getint(
+        'sftp', 'download_concurrency')
+    SwiftFileSystem.download_range_size = c.getint(
+        'sftp', 'download_range_size')
+    SwiftFileSystem.upload_segment_size = c.getint(
+        'sftp', 'upload_segment_size')
+    SwiftFileSystem.upload_concurrency = c.getint(
+        'sftp', 'upload_concurrency')
+    SwiftFileSystem.transfer_budget = transfer_budget
+    SwiftFileSystem.object_cache = None
+    if c.get('sftp', 'object_cache_dir'):
+        from swftp.objectcache import ObjectCache
+        SwiftFileSystem.object_cache = ObjectCache(
+            c.get('sftp', 'object_cache_dir'),
+            c.getint('sftp', 'object_cache_size'))
+    SwiftFileSystem.rename_concurrency = c.getint(
+        'sftp', 'rename_concurrency')
+    SwiftFileSystem.recursive_rmdir = c.getboolean(
+        'sftp', 'recursive_rmdir')
+    SwiftFileSystem.delete_concurrency = c.getint(
+        'sftp', 'delete_concurrency')
+    SwiftFileSystem.upload_spool = upload_spool
+    if upload_spool is not None:
+        reactor.callWhenRunning(
+            upload_spool.recover,
+            lambda storage_url, auth_token: SwiftFileSystem(
+                authdb.token_connection(storage_url, auth_token)))
 
     realm = SwftpRealm()
     sftpportal = Portal(realm)
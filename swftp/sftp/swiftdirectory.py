@@ -1,53 +1,63 @@
 """
 See COPYING for license information.
 """
+from collections import deque
+
 from twisted.conch import ls
 
-from swftp.utils import OrderedDict
 from swftp.swiftfilesystem import swift_stat
 
 
 class SwiftDirectory(object):
-    "Swift Directory is an iterator that returns a listing of the directory."
+    """ Swift Directory is an iterator that returns a listing of the
+    directory. Pages of the listing are fetched as they are consumed, with
+    up to `readahead` pages fetched ahead of time. When no entry is ready,
+    next() returns a Deferred that fires with the next entry, or None at the
+    end of the listing. """
+    readahead = 2
+
     def __init__(self, swiftfilesystem, fullpath):
         self.swiftfilesystem = swiftfilesystem
         self.fullpath = fullpath
+        self.listing = swiftfilesystem.get_listing(
+            fullpath, readahead=self.readahead)
         # A lot of clients require . and .. to be within the directory listing
-        self.files = OrderedDict(
-            [
-                ('.', {}),
-                ('..', {}),
-            ])
-
-    def get_full_listing(self):
-        "Populate the directory listing."
-        def cb(results):
-            for k, v in results.iteritems():
-                self.files[k] = v
-
-        d = self.swiftfilesystem.get_full_listing(self.fullpath)
-        d.addCallback(cb)
+        self.files = deque([('.', {}), ('..', {})])
+
+    def get_first_page(self):
+        "Fetch the first page of the directory listing."
+        d = self.listing.next_page()
+        d.addCallback(self.files.extend)
         return d
 
     def __iter__(self):
         return self
 
     def next(self):
-        try:
-            name, f = self.files.popitem(last=False)
-            lstat = swift_stat(**f)
-            longname = ls.lsLine(name, lstat)
-            return (name, longname, {
-                "size": lstat.st_size,
-                "uid": lstat.st_uid,
-                "gid": lstat.st_gid,
-                "permissions": lstat.st_mode,
-                "atime": int(lstat.st_atime),
-                "mtime": int(lstat.st_mtime)
-            })
-        except KeyError:
+        if self.files:
+            return self.format_entry(*self.files.popleft())
+        if self.listing.done:
             raise StopIteration
 
+        def cb(page):
+            if not page:
+                return None
+            self.files.extend(page)
+            return self.format_entry(*self.files.popleft())
+        return self.listing.next_page().addCallback(cb)
+
+    def format_entry(self, name, f):
+        lstat = swift_stat(**f)
+        longname = ls.lsLine(name, lstat)
+        return (name, longname, {
+            "size": lstat.st_size,
+            "uid": lstat.st_uid,
+            "gid": lstat.st_gid,
+            "permissions": lstat.st_mode,
+            "atime": int(lstat.st_atime),
+            "mtime": int(lstat.st_mtime)
+        })
+
     def close(self):
-        self.files = []
-        self.offset = 0
+        self.files = deque()
+        self.listing.close()
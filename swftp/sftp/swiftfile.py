@@ -4,9 +4,11 @@ Swift server.
 
 See COPYING for license information.
 """
+from collections import deque
+
 from zope import interface
 
-from twisted.internet import defer, task, reactor
+from twisted.internet import defer
 from twisted.conch.ssh.filetransfer import (
     FXF_CREAT, FXF_TRUNC, SFTPError, FX_NO_SUCH_FILE, FX_FAILURE,
     FX_CONNECTION_LOST)
@@ -14,9 +16,10 @@ from twisted.conch.interfaces import ISFTPFile
 from twisted.internet.protocol import Protocol
 from twisted.internet.interfaces import IPushProducer
 from twisted.internet.error import ConnectionLost
-from twisted.python import log
+from twisted.python import failure, log
 
 from swftp.swift import NotFound
+from swftp.utils import ChunkBuffer
 
 
 def cb_log_egress_bytes(result):
@@ -25,79 +28,218 @@ def cb_log_egress_bytes(result):
     return result
 
 
-class SwiftFileReceiver(Protocol):
-    "Streams data from Swift user to SFTP session"
+class RecentRanges(object):
+    """ Keeps the last max_size bytes that went through a SwiftFileReceiver
+    as (offset, data) blocks, so reads that arrive out of order or repeat a
+    range don't need another GET. """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._blocks = deque()
+        self._size = 0
+
+    def add(self, offset, data):
+        if not data or not self.max_size:
+            return
+        self._blocks.append((offset, data))
+        self._size += len(data)
+        while self._size > self.max_size:
+            _, old = self._blocks.popleft()
+            self._size -= len(old)
+
+    def get(self, offset, length):
+        " Returns the bytes at [offset, offset + length) or None "
+        pieces = []
+        pos, end = offset, offset + length
+        while pos < end:
+            for start, data in self._blocks:
+                if start <= pos < start + len(data):
+                    piece = data[pos - start:end - start]
+                    break
+            else:
+                return None
+            pieces.append(piece)
+            pos += len(piece)
+        return ''.join(pieces)
+
+    def clear(self):
+        self._blocks.clear()
+        self._size = 0
+
+
+class SwiftDownloadStream(Protocol):
+    "Receives the body of one GET made by a SwiftFileReceiver"
+    def __init__(self, receiver, offset):
+        self.receiver = receiver
+        self.offset = offset
+
+    def dataReceived(self, _bytes):
+        self.receiver._stream_data(self, _bytes)
+
+    def connectionLost(self, reason):
+        self.receiver._stream_lost(self, reason)
+
+
+class SwiftFileReceiver(object):
+    """ Streams data from Swift user to SFTP session
+
+    Reads are served from one GET that moves forward through the object.
+    A read behind it, or more than seek_limit bytes ahead of it, replaces
+    it with a ranged GET that starts at the read's offset. The last
+    read_cache_size bytes that went by are kept for reads that arrive out
+    of order.
+    """
     download_buffer_limit = 1024 * 1024
     upload_buffer_limit = 1024 * 1024
+    read_cache_size = 256 * 1024
+    seek_limit = 1024 * 1024
 
-    def __init__(self, size, session):
+    def __init__(self, size, session, swiftfilesystem, fullpath):
         self.size = size
         self.session = session
-        self.finished = defer.Deferred()
+        self.swiftfilesystem = swiftfilesystem
+        self.fullpath = fullpath
+        self.stream = None  # SwiftDownloadStream of the current GET
+        self.done = False  # True once the current GET has ended
+        self.consume_paused = False  # the current GET is paused
+        self.session_full = False  # the session buffer is too big
+
+        self._offset = 0  # offset of the first byte of self._recv_buffer
+        self._recv_buffer = ChunkBuffer()
+        self.share = swiftfilesystem.transfer_budget.share(
+            self._update_pause)
+        self._recv_listeners = []
+        self._recent = RecentRanges(self.read_cache_size)
+
+    @property
+    def transport(self):
+        if self.stream:
+            return self.stream.transport
+
+    def _start_stream(self, offset):
+        " Replaces the current GET with one that starts at offset "
+        self._stop_stream()
+        self._recv_buffer.clear()
+        self.share.set(0)
+        self._offset = offset
         self.done = False
         self.consume_paused = False
+        self.stream = stream = SwiftDownloadStream(self, offset)
+        d = self.swiftfilesystem.startFileDownload(
+            self.fullpath, stream, offset=offset, size=self.size)
+        d.addErrback(self._stream_failed, stream)
 
-        self._offset = 0
-        self._recv_buffer = ""
-        self._recv_listeners = []
-        self.transport = None
+    def _stop_stream(self):
+        stream, self.stream = self.stream, None
+        if stream and stream.transport:
+            stream.transport.stopProducing()
 
-    def dataReceived(self, _bytes):
+    def _stream_data(self, stream, _bytes):
         """
             Data has been received from Swift. Pauses Swift if the
             download_buffer_limit has been reached.
         """
-        self._recv_buffer += _bytes
+        if stream is not self.stream:
+            # A seek replaced this GET before its response came in
+            stream.transport.stopProducing()
+            return
+        self._recv_buffer.write(_bytes)
         self._readloop()
-        if len(self._recv_buffer) > self.download_buffer_limit:
-            self.consume_paused = True
-            self.transport.pauseProducing()
+        self._update_pause()
 
-    def _checksessionbuffertimer(self):
+    def _update_pause(self):
         """
-            Checks session buffer to see if we need to resume.
-            Reschedules itself if the buffer is still not small enough
+            Pauses Swift while the receive buffer is over
+            download_buffer_limit, the session buffer is too big or the
+            transfer budget is used up, and resumes it otherwise.
         """
-        if not self.consume_paused:
+        self.share.set(len(self._recv_buffer))
+        paused = self.session_full or self.share.check() or \
+            len(self._recv_buffer) > self.download_buffer_limit
+        if paused == self.consume_paused or not self.transport:
             return
-        if len(self.session.buf) <= self.upload_buffer_limit:
-            self.consume_paused = False
-            self.transport.resumeProducing()
+        self.consume_paused = paused
+        if paused:
+            self.transport.pauseProducing()
         else:
-            reactor.callLater(5, self._checksessionbuffertimer)
+            self.transport.resumeProducing()
 
     def _checksessionbuffer(self):
-        "Checks buffer size to see if we need to pause"
-        if not self.transport:
-            return
-        if self.consume_paused:
+        """
+            Checks the session buffer to see if we need to pause. Once it is
+            too big, _session_opened checks it again each time the client
+            makes room.
+        """
+        if self.session_full:
             return
         if len(self.session.buf) > self.upload_buffer_limit:
-            self.consume_paused = True
-            self.transport.pauseProducing()
-            reactor.callLater(0, self._checksessionbuffertimer)
+            self.session_full = True
+            self.session.window_listeners.append(self._session_opened)
+            self._update_pause()
+
+    def _unwatch_session(self):
+        if self._session_opened in self.session.window_listeners:
+            self.session.window_listeners.remove(self._session_opened)
+
+    def _session_opened(self):
+        " The client made room in the session window "
+        if len(self.session.buf) > self.upload_buffer_limit:
+            return
+        self._unwatch_session()
+        self.session_full = False
+        self._update_pause()
 
     def _readloop(self):
         """
             The loop that checks to see if there is enough data to give back to
-            the SFTP client.
+            the SFTP client. Reads are served in order of their offset.
         """
         self._checksessionbuffer()
-        for callback in self._recv_listeners:
-            d, _, length = callback
-            if len(self._recv_buffer) >= length:
-                data = self._recv_buffer[:length]
-                d.callback(data)
-                self._recv_listeners.remove(callback)
-                self._offset += len(data)
-                self._recv_buffer = self._recv_buffer[length:]
-
-                if self.consume_paused and \
-                        len(self._recv_buffer) <= self.download_buffer_limit:
-                    self.consume_paused = False
-                    self.transport.resumeProducing()
-            else:
+        while self._recv_listeners:
+            d, offset, length = self._recv_listeners[0]
+            data = self._recent.get(offset, length)
+            try:
+                if data is None:
+                    data = self._read_stream(offset, length)
+            except EOFError as err:
+                self._recv_listeners.pop(0)
+                d.errback(err)
+                continue
+            if data is None:
                 break
+            self._recv_listeners.pop(0)
+            d.callback(data)
+
+    def _read_stream(self, offset, length):
+        """
+            Returns the data at offset from the current GET, or None if the
+            read has to wait for it. Starts a new GET if the current one
+            won't get to offset. Raises EOFError if the object ended first.
+        """
+        end = self._offset + len(self._recv_buffer)
+        if self.stream is None or offset < self._offset \
+                or offset > end + self.seek_limit:
+            self._start_stream(offset)
+            return None
+
+        # Skip ahead to the offset, keeping what is skipped in case a read
+        # for it is still on the way
+        if offset > self._offset:
+            skipped = self._recv_buffer.read(offset - self._offset)
+            self._recent.add(self._offset, skipped)
+            self._offset += len(skipped)
+
+        if self._offset < offset or len(self._recv_buffer) < length:
+            if not self.done:
+                return None
+            if self._offset < offset or not len(self._recv_buffer):
+                raise EOFError("EOF")
+
+        data = self._recv_buffer.read(length)
+        self._recent.add(offset, data)
+        self._offset += len(data)
+
+        self._update_pause()
+        return data
 
     def read(self, offset, length):
         """
@@ -105,25 +247,43 @@ class SwiftFileReceiver(Protocol):
             described by the given offset/length. Returns a deferred that fires
             with the data once it is available.
         """
+        if offset >= self.size:
+            raise EOFError("EOF")
         if offset + length > self.size:
             length = self.size - offset
 
-        def cb(result):
-            if result is None:
-                raise EOFError("EOF")
-            return result
-
-        # It looks like the SFTP client is asking for too much.
-        if self.done and len(self._recv_buffer) == 0:
-            raise EOFError("EOF")
-
         d = defer.Deferred()
-        d.addCallback(cb)
         self._recv_listeners.append((d, offset, length))
+        self._recv_listeners.sort(key=lambda listener: listener[1])
         self._readloop()
         return d
 
-    def connectionLost(self, reason):
+    def close(self):
+        " Stops the current GET and fails any reads still waiting on it "
+        self._unwatch_session()
+        self._stop_stream()
+        self._recv_buffer.clear()
+        self._recent.clear()
+        self.share.close()
+        self._fail_reads(SFTPError(FX_CONNECTION_LOST, 'Connection Lost'))
+
+    def _fail_reads(self, err):
+        listeners, self._recv_listeners = self._recv_listeners, []
+        for d, _, _ in listeners:
+            d.errback(err)
+
+    def _stream_failed(self, reason, stream):
+        " The GET itself failed "
+        if stream is not self.stream:
+            return
+        self.stream = None
+        if reason.check(NotFound):
+            self._fail_reads(SFTPError(FX_NO_SUCH_FILE, 'File Not Found'))
+        else:
+            log.err(reason, 'Download failed')
+            self._fail_reads(SFTPError(FX_FAILURE, 'Download Failure'))
+
+    def _stream_lost(self, stream, reason):
         """
             For some reason, the HTTP connection has been lost. We can either
             be done reading from Swift or something back could have happened.
@@ -131,28 +291,37 @@ class SwiftFileReceiver(Protocol):
         from twisted.web._newclient import ResponseDone
         from twisted.web.http import PotentialDataLoss
 
-        self.done = True
+        if stream is not self.stream:
+            return
 
         if reason.check(ResponseDone) or reason.check(PotentialDataLoss):
+            self.done = True
             self._readloop()
-            for callback in self._recv_listeners:
-                d, _, _ = callback
-                d.errback(reason)
-            self._recv_listeners = []
-            self.finished.callback(None)
         else:
-            for callback in self._recv_listeners:
-                d, _, _ = callback
-                d.errback(SFTPError(FX_CONNECTION_LOST, 'Connection Lost'))
-            self._recv_listeners = []
-            self.finished.errback(reason)
+            self.stream = None
+            self._fail_reads(SFTPError(FX_CONNECTION_LOST, 'Connection Lost'))
 
 
 class SwiftFileSender(object):
-    "Streams data from SFTP user to Swift"
+    """ Streams data from SFTP user to Swift
+
+    Writes go straight to the upload while Swift is ready for data and are
+    buffered otherwise. The SSH connection is paused while more than
+    max_buffer_bytes are buffered, or while the transfer budget is used up,
+    and resumed once the buffer is down to buffer_bytes_resume. A write is
+    acknowledged as soon as it is accepted; an upload that fails shows up as
+    an error on the following writes and on close.
+
+    Writes can arrive out of order when a client pipelines them. They are
+    held by offset until the data before them arrives, as long as they end
+    within max_reorder_bytes of the last byte sent to Swift. Writes beyond
+    that window or overlapping data already written fail, and closing the
+    file while data is missing aborts the upload.
+    """
     interface.implements(IPushProducer)
-    max_buffer_writes = 20
-    buffer_writes_resume = 5
+    max_buffer_bytes = 1024 * 1024
+    buffer_bytes_resume = 256 * 1024
+    max_reorder_bytes = 4 * 1024 * 1024
 
     def __init__(self, swiftfilesystem, fullpath, session):
         self.swiftfilesystem = swiftfilesystem
@@ -160,81 +329,119 @@ class SwiftFileSender(object):
         self.session = session
 
         self.write_finished = None  # Deferred that fires when finished writing
-        self._task = None           # Task loop
+        self.writer = None          # IConsumer the upload is written to
+        self.failure = None         # SFTPError once the upload has failed
         self._done_sending = False  # Set to True when the user closes the file
-        self._writeBuffer = []
-
-        self.paused = False
+        self._writeBuffer = deque()
+        self._buffered = 0          # bytes in self._writeBuffer
+        self._pending = {}          # offset: data of early writes
+        self._next_offset = 0       # offset of the next write to send
+        self.share = swiftfilesystem.transfer_budget.share(self._checkBuffer)
+
+        self.paused = False         # the SSH connection is paused
+        self.writer_ready = False   # Swift is ready for data
         self.started = False
 
     def pauseProducing(self):
-        self._task.pause()
+        self.writer_ready = False
 
     def resumeProducing(self):
-        self._task.resume()
+        self.writer_ready = True
+        self._flush()
 
     def stopProducing(self):
-        if self._task:
-            try:
-                self._task.stop()
-            except task.TaskStopped:
-                pass
-
-        for buf in self._writeBuffer:
-            d, _ = buf
-            d.errback(SFTPError(FX_CONNECTION_LOST, 'Connection Lost'))
-            self._writeBuffer.remove(buf)
-        self._writeBuffer = []
-
-    def _writeFlusher(self, writer):
-        while True:
-            if self._done_sending and len(self._writeBuffer) == 0:
-                writer.unregisterProducer()
-                break
-
-            if len(self._writeBuffer) == 0:
-                yield
-                continue
-
-            try:
-                d, data = self._writeBuffer.pop(0)
-                writer.write(data)
-                d.callback(len(data))
-                self._checkBuffer()
-                yield
-            except IndexError:
-                pass
-            finally:
-                yield
+        if not self.failure:
+            self.failure = SFTPError(FX_CONNECTION_LOST, 'Connection Lost')
+        self.writer_ready = False
+        self._writeBuffer.clear()
+        self._buffered = 0
+        self._checkBuffer()
+        self.share.close()
+
+    def _flush(self):
+        " Writes buffered data to Swift for as long as it is ready for it "
+        while self._writeBuffer and self.writer_ready:
+            data = self._writeBuffer.popleft()
+            self._buffered -= len(data)
+            self.writer.write(data)
+        self._checkBuffer()
+        if self._done_sending and not self._writeBuffer \
+                and self.writer_ready and not self._pending:
+            self.writer_ready = False
+            self.share.close()
+            self.writer.unregisterProducer()
 
     def _checkBuffer(self):
-        if self.paused and len(self._writeBuffer) < self.buffer_writes_resume:
+        self.share.set(self._buffered)
+        if self.paused and self._buffered <= self.buffer_bytes_resume \
+                and not self.share.check():
             self.session.conn.transport.transport.resumeProducing()
             self.paused = False
-        elif not self.paused \
-                and len(self._writeBuffer) > self.max_buffer_writes:
+        elif not self.paused and (self._buffered > self.max_buffer_bytes
+                                  or self.share.check()):
             self.session.conn.transport.transport.pauseProducing()
             self.paused = True
 
-    def cb_start_task(self, writer):
-        self._task = task.cooperate(self._writeFlusher(writer))
+    def cb_writer_started(self, writer):
+        self.resumeProducing()
+
+    def _cb_upload_done(self, result):
+        if isinstance(result, failure.Failure) and not self.failure:
+            self.failure = SFTPError(FX_FAILURE, 'Upload Failure')
+            self.stopProducing()
+        return result
 
     def close(self):
         self._done_sending = True
+        if self._pending:
+            err = SFTPError(
+                FX_FAILURE, 'Missing data at offset %s' % self._next_offset)
+            self._abort(err)
+            self.write_finished.addErrback(lambda _: failure.Failure(err))
+        elif self.writer_ready:
+            self._flush()
         return self.write_finished
 
-    def write(self, data):
+    def _abort(self, err):
+        " Drops everything that is buffered and fails the upload "
+        self._pending = {}
+        self.stopProducing()
+        self.writer.abort(failure.Failure(err))
+
+    def _send(self, data):
+        if self.writer_ready and not self._writeBuffer:
+            self.writer.write(data)
+            return
+        self._writeBuffer.append(data)
+        self._buffered += len(data)
+        self._checkBuffer()
+
+    def write(self, offset, data):
+        if self.failure:
+            raise self.failure
+        if not data:
+            return 0
+        if offset < self._next_offset or offset in self._pending:
+            raise SFTPError(
+                FX_FAILURE, 'Overlapping write at offset %s' % offset)
+        if offset + len(data) > self._next_offset + self.max_reorder_bytes:
+            raise SFTPError(
+                FX_FAILURE, 'Write at offset %s is too far ahead of offset '
+                '%s' % (offset, self._next_offset))
         if not self.started:
             # If we haven't started uploading to Swift, start up that process
-            self.write_finished, writer = \
+            self.write_finished, self.writer = \
                 self.swiftfilesystem.startFileUpload(self.fullpath)
-            writer.registerProducer(self, streaming=True)
-            writer.started.addCallback(self.cb_start_task)
+            self.write_finished.addBoth(self._cb_upload_done)
+            self.writer.registerProducer(self, streaming=True)
+            self.writer.started.addCallback(self.cb_writer_started)
             self.started = True
-        d = defer.Deferred()
-        self._writeBuffer.append((d, data))
-        self._checkBuffer()
-        return d
+        self._pending[offset] = data
+        while self._next_offset in self._pending:
+            chunk = self._pending.pop(self._next_offset)
+            self._next_offset += len(chunk)
+            self._send(chunk)
+        return len(data)
 
 
 class SwiftFile(object):
@@ -279,6 +486,8 @@ class SwiftFile(object):
     # New Writer Methods
     def close(self):
         " Returns a deferred that fires when the connection is closed "
+        if self.r:
+            self.r.close()
         if self.w:
             d = defer.maybeDeferred(self.w.close)
             d.addErrback(self._errClose)
@@ -297,23 +506,14 @@ class SwiftFile(object):
             self.w = SwiftFileSender(
                 self.swiftfilesystem, self.fullpath, self.session)
 
-        d = self.w.write(data)
-
-        def errback(failure):
-            raise SFTPError(FX_FAILURE, 'Upload Failure')
-        d.addErrback(errback)
-
-        def cb(result):
-            return result
-        d.addCallback(cb)
-        return d
+        return self.w.write(offset, data)
 
     # Reading Methods
     def readChunk(self, offset, length):
         if not self.r:
-            self.r = SwiftFileReceiver(int(self.props['size']), self.session)
-            self.swiftfilesystem.startFileDownload(
-                self.fullpath, self.r, offset=offset)
+            self.r = SwiftFileReceiver(
+                int(self.props['size']), self.session, self.swiftfilesystem,
+                self.fullpath)
         d = self.r.read(offset, length)
         d.addCallback(cb_log_egress_bytes)
         return d
@@ -0,0 +1,288 @@
+"""
+A local disk spool for uploads. SwiftFileSystem uses it to take uploads from
+clients as fast as they send them and PUT them to Swift from disk, so a slow
+Swift doesn't hold up the client or make it time out.
+
+See COPYING for license information.
+"""
+import json
+import os
+import tempfile
+
+from twisted.internet import defer, task
+from twisted.internet.interfaces import IConsumer
+from twisted.python import failure, log
+from twisted.web.client import FileBodyProducer
+
+from zope import interface
+
+SPOOL_FILE_PREFIX = 'up-'
+META_SUFFIX = '.json'
+
+ACK_ON_COMMIT = 'commit'
+ACK_ON_SPOOL = 'spool'
+
+
+class SpoolFull(Exception):
+    " The upload spool ran out of space "
+
+
+def unlink(filename):
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
+
+class UploadSpool(object):
+    """ Keeps the data of uploads in files under `path` until it is stored in
+    Swift.
+
+    Spooled data counts against max_size until its upload is done. New
+    uploads go straight to Swift while the spool is full. An upload that
+    fills the spool while it is being written is paused until other uploads
+    free up space, and fails if there are none to wait for.
+
+    With ack=ACK_ON_COMMIT an upload finishes once Swift has stored it. With
+    ACK_ON_SPOOL it finishes as soon as it is synced to disk, and where it
+    goes and the auth token to PUT it with are written next to it. Uploads
+    that were acknowledged but not stored yet are found again on startup and
+    PUT by `recover`; all other files left in `path` are removed.
+
+    :param str path: directory to keep the files in
+    :param int max_size: max number of bytes to keep
+    :param str ack: when an upload counts as finished, ACK_ON_COMMIT or
+        ACK_ON_SPOOL
+    """
+    cooperator = task
+
+    def __init__(self, path, max_size, ack=ACK_ON_COMMIT):
+        if ack not in (ACK_ON_COMMIT, ACK_ON_SPOOL):
+            raise ValueError('Unknown upload spool ack mode: %r' % ack)
+        self.path = path
+        self.max_size = max_size
+        self.ack = ack
+        self.used = 0
+        self.uploading = 0  # spooled files being PUT to Swift
+        self.waiting = []  # SpooledUploads paused until space is freed
+        self.recovered = []  # acknowledged files found on startup
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        names = set(os.listdir(path))
+        for name in sorted(names):
+            if not name.startswith(SPOOL_FILE_PREFIX):
+                continue
+            filename = os.path.join(path, name)
+            if name + META_SUFFIX in names:
+                size = os.path.getsize(filename)
+                self.recovered.append((filename, size))
+                self.used += size
+            elif not name.endswith(META_SUFFIX) \
+                    or name[:-len(META_SUFFIX)] not in names:
+                unlink(filename)
+
+    @property
+    def full(self):
+        return self.used >= self.max_size
+
+    def gauges(self):
+        " Returns callables for the current state of the spool, by name "
+        return {
+            'spool.bytes': lambda: self.used,
+            'spool.uploads': lambda: self.uploading,
+        }
+
+    def create(self):
+        " Returns (file, filename) of a new file to spool an upload to "
+        fd, filename = tempfile.mkstemp(prefix=SPOOL_FILE_PREFIX,
+                                        dir=self.path)
+        return os.fdopen(fd, 'wb'), filename
+
+    def add(self, size):
+        self.used += size
+
+    def release(self, size):
+        " Frees up size bytes and lets waiting uploads check for space "
+        self.used -= size
+        waiting, self.waiting = self.waiting, []
+        for upload in waiting:
+            upload._check_space()
+
+    def remove(self, filename, size):
+        unlink(filename + META_SUFFIX)
+        unlink(filename)
+        self.release(size)
+
+    def acknowledge(self, filename, meta):
+        """ Records where an acknowledged upload goes, so it can be PUT again
+        after a restart. Only the owner can read the file, since the auth
+        token is in it. """
+        temp_filename = filename + '.tmp'
+        fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_filename, filename + META_SUFFIX)
+
+    def upload(self, filesystem, filename, container, path, size):
+        """ PUTs a spooled file to Swift. The file is removed once it is
+        stored, or once the upload fails if it was never acknowledged.
+
+        @returns Deferred that fires when the upload is done
+        """
+        self.uploading += 1
+        try:
+            producer = FileBodyProducer(open(filename, 'rb'),
+                                        cooperator=self.cooperator)
+        except (IOError, OSError):
+            return defer.fail(
+                self._cb_uploaded(failure.Failure(), filename, size))
+        d, consumer = filesystem.uploadObject(container, path, size)
+
+        def cb_started(consumer):
+            consumer.registerProducer(producer, True)
+            d = producer.startProducing(consumer)
+            d.addCallback(lambda _: consumer.unregisterProducer())
+
+        consumer.started.addCallback(cb_started)
+        d.addBoth(self._cb_uploaded, filename, size)
+        return d
+
+    def _cb_uploaded(self, result, filename, size):
+        self.uploading -= 1
+        if isinstance(result, failure.Failure) \
+                and os.path.exists(filename + META_SUFFIX):
+            log.err(result, 'Could not upload spooled file %s' % filename)
+            self.release(0)
+        else:
+            self.remove(filename, size)
+        return result
+
+    def recover(self, filesystem_factory):
+        """ PUTs the acknowledged uploads that were found on startup.
+
+        :param filesystem_factory: callable that returns a SwiftFileSystem
+            for a storage URL and an auth token
+        """
+        recovered, self.recovered = self.recovered, []
+        for filename, size in recovered:
+            try:
+                with open(filename + META_SUFFIX) as f:
+                    meta = json.load(f)
+            except (IOError, ValueError):
+                log.err(None, 'Could not read spooled upload %s' % filename)
+                self.remove(filename, size)
+                continue
+            log.msg('Uploading spooled file %s to %s/%s' % (
+                filename, meta['container'], meta['path']))
+            filesystem = filesystem_factory(meta['storage_url'],
+                                            meta['auth_token'])
+            d = self.upload(filesystem, filename, meta['container'],
+                            meta['path'], size)
+            d.addErrback(lambda _: None)  # logged by _cb_uploaded
+
+
+class SpooledUpload(object):
+    """ Consumer for an upload that is written to the spool as fast as the
+    client sends it and PUT to Swift from there once the client is done.
+
+    :param spool: UploadSpool to write to
+    :param filesystem: SwiftFileSystem to upload the file with
+    """
+    interface.implements(IConsumer)
+
+    def __init__(self, spool, filesystem, container, path):
+        self.spool = spool
+        self.filesystem = filesystem
+        self.container = container
+        self.path = path
+        self.started = defer.succeed(self)
+        self.finished = defer.Deferred()
+        self.producer = None
+        self.paused = False
+        self.closed = False
+        self.failure = None
+        self.size = 0
+        self.file, self.filename = spool.create()
+
+    # IConsumer
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        assert streaming
+
+    def unregisterProducer(self):
+        self.producer = None
+        self.closed = True
+        if self.failure:
+            return
+        acknowledge = self.spool.ack == ACK_ON_SPOOL
+        try:
+            self.file.flush()
+            if acknowledge:
+                os.fsync(self.file.fileno())
+            self.file.close()
+            if acknowledge:
+                swiftconn = self.filesystem.swiftconn
+                self.spool.acknowledge(self.filename, {
+                    'storage_url': swiftconn.storage_url,
+                    'auth_token': swiftconn.auth_token,
+                    'container': self.container,
+                    'path': self.path,
+                    'size': self.size,
+                })
+        except (IOError, OSError):
+            self._fail(failure.Failure())
+            return
+        d = self.spool.upload(self.filesystem, self.filename,
+                              self.container, self.path, self.size)
+        if acknowledge:
+            d.addErrback(lambda _: None)  # logged by the spool
+            self.finished.callback(None)
+        else:
+            d.chainDeferred(self.finished)
+
+    def abort(self, reason):
+        " Fails the upload instead of finishing it "
+        self.producer = None
+        self._fail(reason)
+
+    def write(self, data):
+        if self.failure:
+            return
+        try:
+            self.file.write(data)
+        except (IOError, OSError):
+            self._fail(failure.Failure())
+            return
+        self.size += len(data)
+        self.spool.add(len(data))
+        self._check_space()
+
+    def _check_space(self):
+        if self.failure or self.closed:
+            return
+        if not self.spool.full:
+            if self.paused and self.producer is not None:
+                self.paused = False
+                self.producer.resumeProducing()
+        elif self.spool.uploading:
+            if not self.paused and self.producer is not None:
+                self.paused = True
+                self.producer.pauseProducing()
+            # Producers can keep writing for a while after being paused
+            if self not in self.spool.waiting:
+                self.spool.waiting.append(self)
+        else:
+            self._fail(failure.Failure(SpoolFull('Upload spool is full')))
+
+    def _fail(self, reason):
+        if self.failure:
+            return
+        self.failure = reason
+        self.file.close()
+        self.spool.remove(self.filename, self.size)
+        if self.producer is not None:
+            self.producer.stopProducing()
+        self.finished.errback(reason)
@@ -8,17 +8,30 @@ See COPYING for license information.
 """
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred, succeed
-from twisted.web.client import Agent, WebClientContextFactory
+from twisted.internet.error import ConnectError, ConnectionLost, TimeoutError
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import Protocol
+from twisted.internet.task import deferLater
+from twisted.web.client import (
+    Agent, FileBodyProducer, ResponseFailed, ResponseNeverReceived,
+    WebClientContextFactory)
 from twisted.web.http_headers import Headers
 from twisted.web import error
 from twisted.web._newclient import ResponseDone
 from twisted.web.http import PotentialDataLoss
+from twisted.web.iweb import UNKNOWN_LENGTH
 from twisted.python import log
+from twisted.python.failure import Failure
+from zope.interface import implements
 
 import json
+import re
+import urlparse
+from cStringIO import StringIO
 from urllib import quote as _quote
 
+from swftp.utils import PRIORITY_METADATA, PRIORITY_TRANSFER
+
 
 class RequestError(error.Error):
     pass
@@ -59,6 +72,74 @@ class ResponseReceiver(Protocol):
             self.finished.errback(reason)
 
 
+class JSONListingReceiver(Protocol):
+    """
+    Incrementally decodes a JSON list of objects (the format of Swift account
+    and container listings) as it is received. Each entry is handed to
+    entry_callback as soon as it is complete so the full body is never held
+    in memory.
+    """
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+
+    def __init__(self, finished, entry_callback):
+        self.finished = finished
+        self.entry_callback = entry_callback
+        self._buffer = ''
+        self._started = False
+        self._ended = False
+        self._error = None
+
+    def dataReceived(self, _bytes):
+        if self._error:
+            return
+        self._buffer += _bytes
+        try:
+            self._parse()
+        except ValueError as e:
+            self._error = e
+            self._buffer = ''
+            self.transport.stopProducing()
+
+    def _parse(self):
+        buf = self._buffer
+        pos = 0
+        while True:
+            pos = self.separators.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if not self._started:
+                if buf[pos] != '[':
+                    raise ValueError('Expected a JSON list')
+                self._started = True
+                pos += 1
+            elif self._ended:
+                raise ValueError('Extra data after JSON list')
+            elif buf[pos] == ']':
+                self._ended = True
+                pos += 1
+            else:
+                try:
+                    entry, pos = self.decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # Wait for the rest of this entry
+                    break
+                self.entry_callback(entry)
+        self._buffer = buf[pos:]
+
+    def connectionLost(self, reason):
+        if self._error:
+            self.finished.errback(self._error)
+        elif reason.check(ResponseDone) or reason.check(PotentialDataLoss):
+            if not self._ended or self._buffer.strip():
+                self.finished.errback(
+                    ValueError('Incomplete JSON listing received'))
+            else:
+                self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+
 class ResponseIgnorer(Protocol):
     def __init__(self, finished):
         self.finished = finished
@@ -74,11 +155,31 @@ class ResponseIgnorer(Protocol):
         pass
 
 
+def parse_content_range(value):
+    """ Parses a Content-Range header like 'bytes 0-99/300'
+
+    :returns (first, last, total) tuple of ints, where total is None if the
+        server didn't give it, or None if the value isn't a byte range
+    """
+    try:
+        unit, span = value.strip().split(' ', 1)
+        span, total = span.split('/', 1)
+        first, last = span.split('-', 1)
+        first, last = int(first), int(last)
+        total = None if total.strip() == '*' else int(total)
+    except (AttributeError, ValueError):
+        return None
+    if unit.lower() != 'bytes':
+        return None
+    return first, last, total
+
+
 def cb_recv_resp(response, load_body=False, receiver=None):
     d_resp_recvd = Deferred()
     if response.code == 204:
         response.deliverBody(ResponseIgnorer(d_resp_recvd))
-    elif load_body:
+    elif load_body or (receiver and response.code > 299):
+        # Error bodies are never handed to the receiver as if they were data
         response.deliverBody(ResponseReceiver(d_resp_recvd))
     else:
         if receiver:
@@ -90,6 +191,19 @@ def cb_recv_resp(response, load_body=False, receiver=None):
     return d_resp_recvd
 
 
+def cb_recv_json_listing(response, entry_callback):
+    d_resp_recvd = Deferred()
+    if response.code == 204:
+        response.deliverBody(ResponseIgnorer(d_resp_recvd))
+    elif response.code == 200:
+        response.deliverBody(
+            JSONListingReceiver(d_resp_recvd, entry_callback))
+    else:
+        response.deliverBody(ResponseReceiver(d_resp_recvd))
+    d_resp_recvd.addCallback(cb_process_resp, response)
+    return d_resp_recvd
+
+
 def cb_process_resp(body, response):
     if response.code == 404:
         raise NotFound(response.code, body)
@@ -120,6 +234,164 @@ def cb_json_decode(result):
     return resp, json.loads(body)
 
 
+def cb_bulk_delete_result(result):
+    """ The bulk delete middleware answers 200 and puts the real status in
+    the body. Raises RequestError if anything other than a 404 failed. """
+    resp, body = result
+    status = body.get('Response Status', '200 OK')
+    code = int(status.split(' ', 1)[0])
+    if code > 299 or body.get('Errors'):
+        raise RequestError(code, json.dumps(body.get('Errors')))
+    return resp, body
+
+
+# Statuses that swift answers with when it is too busy: rate limited by
+# the proxy (498), too many requests (429) and unavailable (503)
+OVERLOADED_STATUSES = (429, 498, 503)
+
+
+def is_overloaded(result):
+    """ Returns True if the response or Failure of a request shows swift
+    is too busy to handle it """
+    if isinstance(result, Failure):
+        return bool(result.check(TimeoutError, ResponseNeverReceived))
+    return getattr(result, 'code', None) in OVERLOADED_STATUSES
+
+
+# Requests that can be sent again without changing their outcome
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'DELETE')
+# Statuses that are worth trying again after a pause
+RETRY_STATUSES = (500, 502, 504) + OVERLOADED_STATUSES
+
+
+def is_retryable(result):
+    """ Returns True if the response or Failure of a request looks like a
+    passing problem, like a 5xx or a dropped connection """
+    if isinstance(result, Failure):
+        return bool(result.check(
+            ConnectError, ConnectionLost, ResponseFailed, TimeoutError))
+    return getattr(result, 'code', None) in RETRY_STATUSES
+
+
+# Request headers that are left out when a download is resumed
+RESUME_DROPPED_HEADERS = (
+    'range', 'if-match', 'if-none-match', 'if-modified-since',
+    'if-unmodified-since')
+
+
+class ResumingReceiver(Protocol):
+    """ Passes the body of a GET on to `receiver`. If the connection drops
+    part way through, the rest of the body is fetched with a ranged GET
+    from the last byte delivered, as long as the object still has the same
+    ETag. Retries follow the connection's retry_policy.
+
+    It is the receiver's transport, so pausing and stopping apply to
+    whichever response is being received.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, swiftconn, path, headers, receiver):
+        self.swiftconn = swiftconn
+        self.path = path
+        self.headers = headers
+        self.receiver = receiver
+        self.response_transport = None
+        self.etag = None
+        self.start = 0
+        self.end = None
+        self.delivered = 0
+        self.attempt = 1
+        self.paused = False
+        self.stopped = False
+        self.reason = None
+
+    def cb_response(self, response):
+        """ Notes which part of which version of the object the response
+        holds, so the right part can be asked for again """
+        if response.code == 206:
+            content_range = response.headers.getRawHeaders(
+                'content-range', [''])[0]
+            match = re.match(r'bytes (\d+)-(\d+)/', content_range)
+            if match:
+                self.etag = response.headers.getRawHeaders('etag')
+                self.start, self.end = map(int, match.groups())
+        elif response.code == 200:
+            self.etag = response.headers.getRawHeaders('etag')
+            if response.length != UNKNOWN_LENGTH:
+                self.end = response.length - 1
+        return response
+
+    def makeConnection(self, transport):
+        first = self.response_transport is None
+        self.response_transport = transport
+        if self.paused:
+            transport.pauseProducing()
+        if first:
+            self.receiver.makeConnection(self)
+
+    def dataReceived(self, _bytes):
+        self.delivered += len(_bytes)
+        self.receiver.dataReceived(_bytes)
+
+    def connectionLost(self, reason):
+        if self.stopped or not self.etag or \
+                reason.check(ResponseDone, PotentialDataLoss) or \
+                not is_retryable(reason):
+            self.receiver.connectionLost(reason)
+            return
+        if self.end is not None and self.start + self.delivered > self.end:
+            self.receiver.connectionLost(Failure(ResponseDone()))
+            return
+        delay = self.swiftconn.retry_policy.delay(self.attempt)
+        if delay is None:
+            self.receiver.connectionLost(reason)
+            return
+        self.attempt += 1
+        self.reason = reason
+        deferLater(self.swiftconn.retry_policy.clock, delay, self._resume)
+
+    def _resume(self):
+        if self.stopped:
+            self.receiver.connectionLost(self.reason)
+            return
+        # Conditions were already met by the first response
+        headers = dict((k, v) for k, v in (self.headers or {}).iteritems()
+                       if k.lower() not in RESUME_DROPPED_HEADERS)
+        headers['Range'] = 'bytes=%s-%s' % (
+            self.start + self.delivered,
+            '' if self.end is None else self.end)
+        d = self.swiftconn.make_request('GET', self.path, headers=headers)
+        d.addCallbacks(self._cb_resumed, self._eb_resumed)
+
+    def _cb_resumed(self, response):
+        if response.code != 206 or \
+                response.headers.getRawHeaders('etag') != self.etag:
+            # The object changed or the range was ignored
+            response.deliverBody(ResponseIgnorer(Deferred()))
+            self.receiver.connectionLost(self.reason)
+            return
+        response.deliverBody(self)
+
+    def _eb_resumed(self, failure):
+        self.receiver.connectionLost(self.reason)
+
+    # IPushProducer
+    def pauseProducing(self):
+        self.paused = True
+        if self.response_transport:
+            self.response_transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.response_transport:
+            self.response_transport.resumeProducing()
+
+    def stopProducing(self):
+        self.stopped = True
+        if self.response_transport:
+            self.response_transport.stopProducing()
+
+
 class SwiftConnection(object):
     """ A basic connection class to interface with OpenStack Swift.
 
@@ -129,8 +401,17 @@ class SwiftConnection(object):
         :param pool: A twisted.web.client.HTTPConnectionPool object
         :param dict extra_headers: extra HTTP headers to send with each request
         :param bool verbose: verbose setting
+
+        With a retry_policy (swftp.utils.RetryPolicy), GET, HEAD and DELETE
+        requests that fail with a 5xx or a connection error are tried
+        again, and downloads that are cut off part way are resumed.
+
+        With a balancer (swftp.balancer.EndpointBalancer), each request is
+        sent to the proxy endpoint it picks instead of the storage URL's.
     """
     user_agent = 'Twisted Swift'
+    retry_policy = None
+    balancer = None
 
     def __init__(self, auth_url, username, api_key, pool=None,
                  extra_headers=None, verbose=False):
@@ -145,6 +426,8 @@ class SwiftConnection(object):
         self.agent = Agent(reactor, contextFactory, pool=self.pool)
         self.extra_headers = extra_headers
         self.verbose = verbose
+        # Called with the auth result after a 401/403 forced re-auth
+        self.reauth_callback = None
 
     def _form_url(self, path, params):
         url = "/".join((self.storage_url, path))
@@ -158,7 +441,9 @@ class SwiftConnection(object):
     def make_request(self, method, path, params=None, headers=None, body=None):
         """ Make an HTTP request against Swift. This method will try once to
         re-authenticate to swift after receiving a 401 or 403 and then
-        (if successful) will re-attempt the request.
+        (if successful) will re-attempt the request. Idempotent requests
+        are also retried as the retry_policy allows. A retried DELETE that
+        gets a 404 succeeds, since an earlier attempt may have deleted it.
 
         :param method: HTTP Method. E.G. GET, POST, PUT
         :param path: Path to be appended to the storage url
@@ -169,6 +454,32 @@ class SwiftConnection(object):
         :returns t.w.c.Response:
 
         """
+        d = self._make_request(method, path, params, headers, body)
+        if self.retry_policy and method in IDEMPOTENT_METHODS:
+            self.retry_policy.request()
+            d.addBoth(self._cb_retry, 1, method, path, params, headers, body)
+        return d
+
+    def _cb_retry(self, result, attempt, *args):
+        if attempt > 1 and args[0] == 'DELETE' and \
+                getattr(result, 'code', None) == 404:
+            # An earlier attempt may have deleted it before failing
+            result.code = 204
+        if not is_retryable(result):
+            return result
+        delay = self.retry_policy.delay(attempt)
+        if delay is None:
+            return result
+        if not isinstance(result, Failure):
+            result.deliverBody(ResponseIgnorer(Deferred()))
+        d = deferLater(self.retry_policy.clock, delay, self._make_request,
+                       *args)
+        d.addBoth(self._cb_retry, attempt + 1, *args)
+        return d
+
+    def _make_request(self, method, path, params=None, headers=None,
+                      body=None):
+        """ Makes one attempt at a request, see make_request """
         h = {
             'User-Agent': [self.user_agent],
         }
@@ -183,9 +494,16 @@ class SwiftConnection(object):
         def doRequest(ignored):
             h['X-Auth-Token'] = [self.auth_token]
             url = self._form_url(path, params)
+            endpoint = None
+            if self.balancer:
+                endpoint = self.balancer.pick()
+                url = self.balancer.rewrite(url, endpoint)
             if self.verbose:
                 log.msg('Request: %s %s, headers: %s' % (method, url, h))
-            return self.agent.request(method, url, Headers(h), body)
+            d = self.agent.request(method, url, Headers(h), body)
+            if endpoint:
+                self.balancer.track(endpoint, d)
+            return d
 
         d = doRequest(None)
 
@@ -202,7 +520,10 @@ class SwiftConnection(object):
         return d
 
     def cb_retry_auth(self, ignored):
-        return self.authenticate()
+        d = self.authenticate()
+        if self.reauth_callback:
+            d.addCallback(self.reauth_callback)
+        return d
 
     def after_authenticate(self, result):
         response, _ = result
@@ -238,14 +559,17 @@ class SwiftConnection(object):
         d.addCallback(format_head_response)
         return d
 
-    def get_account(self, limit=None, marker=None, end_marker=None):
+    def get_account(self, limit=None, marker=None, end_marker=None,
+                    entry_callback=None):
         """ Get listing of containers in the account
 
         :param int limit: The max number of results to return
         :param marker: container names greater than this value
         :param end_marker: container names less than this value
+        :param entry_callback: if given, called with each container as it is
+                               received instead of returning the list
 
-        :returns t.w.c.Response, list:
+        :returns t.w.c.Response, list: (t.w.c.Response, None when streaming)
 
         """
         params = {'format': 'json'}
@@ -253,12 +577,15 @@ class SwiftConnection(object):
             params['limit'] = str(limit)
         if marker:
             params['marker'] = quote(marker)
-        if marker:
+        if end_marker:
             params['end_marker'] = quote(end_marker)
 
         d = self.make_request('GET', '', params=params)
-        d.addCallback(cb_recv_resp, load_body=True)
-        d.addCallback(cb_json_decode)
+        if entry_callback:
+            d.addCallback(cb_recv_json_listing, entry_callback)
+        else:
+            d.addCallback(cb_recv_resp, load_body=True)
+            d.addCallback(cb_json_decode)
         return d
 
     def head_container(self, container):
@@ -275,8 +602,9 @@ class SwiftConnection(object):
         return d
 
     def get_container(self, container, limit=None, marker=None,
-                      end_marker=None, prefix=None, path=None, delimiter=None):
-        """ Create a container
+                      end_marker=None, prefix=None, path=None, delimiter=None,
+                      entry_callback=None):
+        """ Get listing of objects in a container
 
         :param container: The container name
         :param int limit: The max number of results to return
@@ -284,8 +612,10 @@ class SwiftConnection(object):
         :param end_marker: object names less than this value
         :param prefix: return objects with names that start with this value
         :param delimiter: Delimiter to use for hierarchy
+        :param entry_callback: if given, called with each object as it is
+                               received instead of returning the list
 
-        :returns t.w.c.Response, list:
+        :returns t.w.c.Response, list: (t.w.c.Response, None when streaming)
 
         """
         params = {'format': 'json'}
@@ -303,8 +633,11 @@ class SwiftConnection(object):
             params['delimiter'] = quote(delimiter)
 
         d = self.make_request('GET', quote(container), params=params)
-        d.addCallback(cb_recv_resp, load_body=True)
-        d.addCallback(cb_json_decode)
+        if entry_callback:
+            d.addCallback(cb_recv_json_listing, entry_callback)
+        else:
+            d.addCallback(cb_recv_resp, load_body=True)
+            d.addCallback(cb_json_decode)
         return d
 
     def put_container(self, container, headers=None):
@@ -361,16 +694,37 @@ class SwiftConnection(object):
         """
         _path = "/".join((quote(container), quote(path)))
         d = self.make_request('GET', _path, headers=headers)
+        if receiver and self.retry_policy:
+            receiver = ResumingReceiver(self, _path, headers, receiver)
+            d.addCallback(receiver.cb_response)
         d.addCallback(cb_recv_resp, receiver=receiver)
         return d
 
-    def put_object(self, container, path, headers=None, body=None):
+    def get_slo_manifest(self, container, path):
+        """ Get the list of segments of a Static Large Object
+
+        :param container: The container name
+        :param path: The object name/path
+
+        :returns t.w.c.Response, list:
+
+        """
+        _path = "/".join((quote(container), quote(path)))
+        d = self.make_request('GET', _path,
+                              params={'multipart-manifest': 'get'})
+        d.addCallback(cb_recv_resp, load_body=True)
+        d.addCallback(cb_json_decode)
+        return d
+
+    def put_object(self, container, path, headers=None, body=None,
+                   params=None):
         """ Create a new object
 
         :param container: The container name
         :param path: The object name/path
         :param dict headers: Extra headers to use with the HTTP request
         :param body: Object which implements twisted.web.iweb.IBodyProducer
+        :param dict params: Query parameters, E.G. multipart-manifest
 
         :returns t.w.c.Response:
 
@@ -380,7 +734,8 @@ class SwiftConnection(object):
         if not body:
             headers['Content-Length'] = '0'
         _path = "/".join((quote(container), quote(path)))
-        d = self.make_request('PUT', _path, headers=headers, body=body)
+        d = self.make_request('PUT', _path, params=params, headers=headers,
+                              body=body)
         d.addCallback(cb_recv_resp, load_body=True)
         return d
 
@@ -398,6 +753,44 @@ class SwiftConnection(object):
         d.addCallback(cb_recv_resp)
         return d
 
+    def bulk_delete(self, paths):
+        """ Delete many objects and containers with one request. Requires
+        the bulk delete middleware (see get_info).
+
+        :param paths: '/container/object' or '/container' paths to delete
+
+        :returns t.w.c.Response, dict: (response, the middleware's result)
+
+        """
+        body = '\n'.join(quote(path) for path in paths)
+        d = self.make_request(
+            'POST', '', params={'bulk-delete': 'true'},
+            headers={'Content-Type': 'text/plain',
+                     'Accept': 'application/json'},
+            body=FileBodyProducer(StringIO(body)))
+        d.addCallback(cb_recv_resp, load_body=True)
+        d.addCallback(cb_json_decode)
+        d.addCallback(cb_bulk_delete_result)
+        return d
+
+    def get_info(self):
+        """ Get the capabilities of the cluster from its /info endpoint
+
+        :returns t.w.c.Response, dict:
+
+        """
+        parts = urlparse.urlsplit(self.storage_url)
+        url = urlparse.urlunsplit((parts.scheme, parts.netloc, '/info', '',
+                                   ''))
+        h = {'User-Agent': [self.user_agent]}
+        if self.extra_headers:
+            for k, v in self.extra_headers.iteritems():
+                h[k] = [v]
+        d = self.agent.request('GET', url, Headers(h), None)
+        d.addCallback(cb_recv_resp, load_body=True)
+        d.addCallback(cb_json_decode)
+        return d
+
 
 class ThrottledSwiftConnection(SwiftConnection):
     """ A SwiftConnection that has a list of locks that it needs to acquire
@@ -406,33 +799,61 @@ class ThrottledSwiftConnection(SwiftConnection):
         twisted.internet.defer._ConcurrencyPrimitive. Locks are acquired in the
         order in the list.
 
+        If a scheduler (swftp.utils.FairScheduler) is set, a slot is also
+        taken from it after the locks, under the connection's username.
+        HEADs and listings are given priority over other requests. The
+        scheduler is told how long each request without a body took and
+        whether swift was overloaded, for its limiter.
+
         :param locks: list of locks that implement
             twisted.internet.defer._ConcurrencyPrimitive
         :param \*args: same arguments as `SwiftConnection`
         :param \*\*args: same keyword arguments as `SwiftConnection`
     """
+    scheduler = None
+    scheduler_weight = 1
+
     def __init__(self, locks, *args, **kwargs):
         SwiftConnection.__init__(self, *args, **kwargs)
         self.locks = locks or []
 
-    def _release_all(self, result):
+    def _release_all(self, result, started=None):
+        if self.scheduler:
+            latency = None
+            if started is not None:
+                latency = self.scheduler.clock.seconds() - started
+            self.scheduler.release(latency, is_overloaded(result))
         for lock in self.locks:
             lock.release()
         return result
 
-    def _aquire_all(self):
+    def _aquire_all(self, priority=PRIORITY_TRANSFER):
         d = succeed(None)
         for lock in self.locks:
-            d.addCallback(lambda r: lock.acquire())
+            d.addCallback(lambda r, lock=lock: lock.acquire())
+        if self.scheduler:
+            d.addCallback(lambda r: self.scheduler.acquire(
+                self.username or self, priority, self.scheduler_weight))
         return d
 
-    def make_request(self, *args, **kwargs):
+    def _make_request(self, method, path, params=None, headers=None,
+                      body=None):
         def execute(ignored):
-            d = SwiftConnection.make_request(self, *args, **kwargs)
-            d.addBoth(self._release_all)
+            started = None
+            # How long a request with a body takes depends on the client
+            # sending it, so only the others tell the limiter how busy
+            # swift is
+            if self.scheduler and body is None:
+                started = self.scheduler.clock.seconds()
+            d = SwiftConnection._make_request(
+                self, method, path, params, headers, body)
+            d.addBoth(self._release_all, started)
             return d
 
-        d = self._aquire_all()
+        priority = PRIORITY_TRANSFER
+        if method == 'HEAD' or (method == 'GET' and '/' not in path):
+            priority = PRIORITY_METADATA
+        d = self._aquire_all(priority)
         d.addCallback(execute)
         return d
 
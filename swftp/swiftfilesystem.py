@@ -5,21 +5,47 @@ bit easier.
 See COPYING for license information.
 """
 import datetime
+import hashlib
+import json
 import stat
 import os
+import string
 import urlparse
 import time
+from collections import deque
+from cStringIO import StringIO
 
 from twisted.internet import defer, reactor, task
+from twisted.internet.error import ConnectionAborted, ConnectionLost
+from twisted.internet.protocol import Protocol
+from twisted.web.client import FileBodyProducer
 from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
-from twisted.internet.interfaces import IConsumer
-from twisted.python import log
+from twisted.web.error import PageRedirect
+from twisted.web.http import PotentialDataLoss
+from twisted.web._newclient import ResponseDone
+from twisted.internet.interfaces import IConsumer, IPushProducer
+from twisted.python import failure, log
 
 from zope import interface
 
-from swftp.utils import OrderedDict
+from swftp.utils import OrderedDict, LRUCache, ChunkBuffer, TransferBudget
 from swftp.utils import try_datetime_parse
-from swftp.swift import NotFound, Conflict
+from swftp.swift import (
+    NotFound, Conflict, RequestError, encode_utf8, parse_content_range)
+from swftp.objectcache import CachingReceiver, CachedFileReader
+from swftp.spool import SpooledUpload
+
+
+# Kinds of entries held in the SwiftFileSystem attribute cache
+ATTR_OBJECT = 'object'
+ATTR_DIRECTORY = 'directory'
+ATTR_MISSING = 'missing'
+
+# Characters used to pick the boundaries of parallel listing ranges
+LISTING_SPLIT_CHARS = sorted(string.digits + string.ascii_letters + '-._')
+# Names can't contain NUL, so nothing sorts between a name and the name
+# followed by this character
+NEXT_NAME_CHAR = u'\x01'
 
 
 def obj_to_path(path):
@@ -63,6 +89,81 @@ def cb_parse_object_headers(headers):
     }
 
 
+def parse_listing_entry(entry):
+    """ Converts an object listing entry into (kind, attrs), matching what a
+        HEAD request would return. Returns None if the listing can't be
+        trusted to match a HEAD (DLO manifests are listed as 0 bytes). """
+    if 'subdir' in entry:
+        return ATTR_DIRECTORY, {'content_type': 'application/directory'}
+    if entry['name'].endswith('/'):
+        return None
+    content_type, _, params = entry.get('content_type', '').partition(';')
+    size = entry.get('bytes', 0)
+    for param in params.split(';'):
+        key, _, value = param.strip().partition('=')
+        if key == 'swift_bytes':
+            size = int(value)
+    if not size and content_type != 'application/directory':
+        return None
+    return ATTR_OBJECT, {
+        'size': str(size),
+        'last_modified': entry.get('last_modified', 0),
+        'content_type': content_type,
+    }
+
+
+def listing_entry_name(entry):
+    " Returns the name a listing entry sorts by (subdirs have no 'name') "
+    return entry.get('name') or entry['subdir']
+
+
+def split_listing_range(prefix, first, last, end_marker, count):
+    """ Picks up to count - 1 names that split the part of a listing that
+        comes after `last` (and before end_marker) into count ranges.
+
+        `first` and `last` are the first and last names of a full page. The
+        split happens at the first character where the two differ, which is
+        where the rest of the listing is expected to vary. The boundaries
+        are spread over the characters of the same kind (digits, lower or
+        upper case letters) that sort after the one in `last`. If there
+        are none, the split moves back a character.
+
+        @returns sorted list of boundary names
+    """
+    if isinstance(prefix, str):
+        prefix = prefix.decode('utf-8')
+    prefix = prefix or u''
+    rest_first, rest_last = first[len(prefix):], last[len(prefix):]
+    pos = len(os.path.commonprefix([rest_first, rest_last]))
+    if count < 2 or pos >= len(rest_last):
+        return []
+    candidates = []
+    while pos >= 0 and not candidates:
+        char = rest_last[pos]
+        chars = LISTING_SPLIT_CHARS
+        for kind in (string.digits, string.ascii_lowercase,
+                     string.ascii_uppercase):
+            if char in kind:
+                chars = kind
+        base = prefix + rest_last[:pos]
+        candidates = [base + c for c in chars if c > char]
+        if end_marker:
+            candidates = [c for c in candidates
+                          if listing_end_marker_after(c) < end_marker]
+        pos -= 1
+    if not candidates:
+        return []
+    step = float(len(candidates)) / count
+    return sorted(set(candidates[int(step * i)] for i in range(1, count)))
+
+
+def listing_end_marker_after(name):
+    """ Returns an end_marker that makes a listing stop right after `name`.
+        A range that ends there and one that uses `name` as its marker
+        meet without overlapping or leaving a gap. """
+    return name + NEXT_NAME_CHAR
+
+
 def swift_stat(last_modified=None, content_type="application/directory",
                count=1, bytes=0, size=0, **kwargs):
     size = int(size) or int(bytes)
@@ -101,6 +202,11 @@ class SwiftWriteFile(object):
         self.consumer.write(data)
         log.msg(metric='transfer.ingress_bytes', count=len(data))
 
+    def abort(self, reason):
+        " Fails the PUT instead of finishing it "
+        if not self.finished.called:
+            self.finished.errback(reason)
+
     # IBodyProducer
     def startProducing(self, consumer):
         self.consumer = consumer
@@ -117,21 +223,1339 @@ class SwiftWriteFile(object):
         self.producer.stopProducing()
 
 
+class StreamedBody(object):
+    """ Body of a PUT that is sent while the upload is still being written.
+    The upload moves data into it with write() while it is ready for more.
+
+    :param upload: SegmentedUpload the data comes from
+    """
+    interface.implements(IBodyProducer)
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.length = UNKNOWN_LENGTH
+        self.consumer = None
+        self.paused = False
+        self.reason = None
+        self.finished = defer.Deferred()
+
+    @property
+    def ready(self):
+        " True while the PUT can take more data "
+        return self.consumer is not None and not self.paused \
+            and not self.finished.called
+
+    def write(self, data):
+        self.consumer.write(data)
+
+    def abort(self, reason):
+        " Fails the PUT instead of storing what was sent so far "
+        if self.consumer is None:
+            self.reason = reason
+        elif not self.finished.called:
+            self.finished.errback(reason)
+
+    # IBodyProducer
+    def startProducing(self, consumer):
+        if self.reason is not None:
+            return defer.fail(self.reason)
+        self.consumer = consumer
+        self.upload._feed_stream()
+        return self.finished
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.upload._feed_stream()
+
+    def stopProducing(self):
+        # The PUT failed, which fails the upload
+        self.paused = True
+
+
+class SegmentedUpload(object):
+    """ Consumer for an upload that is PUT as a single object while it is
+    small and as a Static Large Object once more than segment_size bytes have
+    been written to it.
+
+    Uploads of up to stream_threshold bytes are buffered and PUT in one go.
+    Past that, the upload is streamed into a PUT to the object's own name as
+    it is written, keeping a copy of what was sent. If it grows past
+    segment_size, that PUT is aborted before it completes, so Swift doesn't
+    store it. The copy becomes the first segment and the rest is cut into
+    segments every segment_size bytes. Segments are PUT to
+    `<container>_segments` up to `concurrency` at a time. The producer is
+    paused while a cut segment is waiting for a free PUT, which bounds the
+    memory used to about (concurrency + 2) * segment_size bytes. When the
+    producer unregisters, the last segment is sent and the manifest is PUT
+    to the object's own name. An upload fails once it needs more segments
+    than the cluster's max_manifest_segments (see set_info).
+
+    If anything fails, the segments that were uploaded are deleted again.
+    When the upload replaces a Static Large Object that was uploaded this
+    way, the old segments are deleted once the new object is in place.
+
+    :param swiftconn: swftp.swift.SwiftConnection used for the PUTs
+    :param int segment_size: size in bytes of each segment
+    :param int concurrency: max number of segment PUTs to make in parallel
+    :param budget: swftp.utils.TransferBudget the buffered data counts
+        against
+    """
+    interface.implements(IConsumer)
+    stream_threshold = 65536
+
+    def __init__(self, swiftconn, container, path, segment_size, concurrency,
+                 budget):
+        self.swiftconn = swiftconn
+        self.container = container
+        self.path = path
+        self.segment_size = segment_size
+        self.concurrency = concurrency
+        self.segment_container = '%s_segments' % container
+        self.segment_prefix = '%s/slo/%f/%s/' % (path, time.time(),
+                                                 segment_size)
+        self.max_segments = None
+        self.started = defer.succeed(self)
+        self.finished = defer.Deferred()
+        self.producer = None
+        self.head = []  # what was written while not segmented
+        self.head_size = 0
+        self.stream = None  # StreamedBody of the PUT to the object's name
+        self.sent = 0  # number of chunks of head sent into the stream
+        self.sent_size = 0
+        self.buffer = ChunkBuffer()
+        self.segmented = False
+        self.segments = []  # manifest entry per segment, None until PUT
+        self.waiting = deque()  # (index, data) of segments not PUT yet
+        self.uploading = 0
+        self.closed = False
+        self.committing = False
+        self.failure = None
+        self.paused = False
+        self.container_ready = False
+        self.old_lookup = None
+        self.replaced = []  # segments of the object being replaced
+        self.share = budget.share(self._check_pause)
+        self._held = 0  # bytes of segments that are waiting or being PUT
+        self.finished.addBoth(self._cb_finished)
+
+    def set_info(self, info):
+        " Applies the limits from the cluster's /info "
+        try:
+            self.max_segments = int(info['slo']['max_manifest_segments'])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    # IConsumer
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        assert streaming
+
+    def unregisterProducer(self):
+        self.producer = None
+        self.closed = True
+        if self.failure:
+            return
+        if self.segmented:
+            self._cut_segments(final=True)
+            self._check_done()
+        elif self.stream is None:
+            body = body_producer(''.join(self.head))
+            self._commit(lambda: self.swiftconn.put_object(
+                self.container, self.path, body=body))
+        else:
+            self._feed_stream()
+
+    def abort(self, reason):
+        " Fails the upload instead of finishing it "
+        self.producer = None
+        self._fail(reason)
+
+    def write(self, data):
+        log.msg(metric='transfer.ingress_bytes', count=len(data))
+        if self.failure:
+            return
+        if self.segmented:
+            self.buffer.write(data)
+            self._cut_segments()
+            return
+        self.head.append(data)
+        self.head_size += len(data)
+        if self.head_size > self.segment_size:
+            self._start_segments()
+            return
+        if self.stream is None and self.head_size > self._stream_limit():
+            self._start_stream()
+        self._feed_stream()
+
+    def _cb_finished(self, result):
+        self.share.close()
+        return result
+
+    def _stream_limit(self):
+        " Bytes to buffer before and while streaming to the object's name "
+        return min(self.stream_threshold, self.segment_size)
+
+    def _start_stream(self):
+        self.stream = StreamedBody(self)
+        self._old_segments()
+        d = self.swiftconn.put_object(
+            self.container, self.path, body=self.stream)
+        d.addCallbacks(self._cb_stream_put, self._eb_stream_put)
+
+    def _feed_stream(self):
+        " Moves written data into the PUT to the object's name "
+        stream = self.stream
+        if stream is not None and not self.failure:
+            while self.sent < len(self.head) and stream.ready:
+                stream.write(self.head[self.sent])
+                self.sent_size += len(self.head[self.sent])
+                self.sent += 1
+            if self.closed and self.sent == len(self.head) \
+                    and not self.committing:
+                # The PUT can't complete before the object it replaces has
+                # been looked at
+                self.committing = True
+                self._old_segments().addCallback(self._cb_finish_stream)
+        self._check_pause()
+
+    def _cb_finish_stream(self, old):
+        if self.failure:
+            return
+        self.replaced = old
+        self.stream.finished.callback(None)
+
+    def _cb_stream_put(self, result):
+        if self.failure:
+            return
+        self._cb_committed(result, self.replaced)
+        self.finished.callback(result)
+
+    def _eb_stream_put(self, reason):
+        # Expected once the upload switched to segments
+        if not self.segmented:
+            self._fail(reason)
+
+    def _start_segments(self):
+        " Switches to a Static Large Object, starting with what was written "
+        self.segmented = True
+        if self.stream is not None:
+            self.stream.abort(failure.Failure(ConnectionAborted(
+                'Upload is larger than a segment')))
+            self.stream = None
+        for data in self.head:
+            self.buffer.write(data)
+        self.head, self.head_size = [], 0
+        self._old_segments()
+        d = self.swiftconn.put_container(self.segment_container)
+        d.addCallbacks(self._cb_container_put, self._fail)
+        self._cut_segments()
+
+    def _cb_container_put(self, result):
+        if self.failure:
+            return
+        self.container_ready = True
+        self._cut_segments()
+
+    def _segment_name(self, index):
+        return '%s%08d' % (self.segment_prefix, index)
+
+    def _cut_segments(self, final=False):
+        while len(self.buffer) >= self.segment_size \
+                or (final and len(self.buffer)):
+            if self.max_segments and \
+                    len(self.segments) >= self.max_segments:
+                self._fail(failure.Failure(RequestError(
+                    413, 'Uploads are limited to %s segments of %s bytes' % (
+                        self.max_segments, self.segment_size))))
+                return
+            data = self.buffer.read(self.segment_size)
+            self._held += len(data)
+            self.waiting.append((len(self.segments), data))
+            self.segments.append(None)
+        while self.container_ready and self.waiting \
+                and self.uploading < self.concurrency:
+            index, data = self.waiting.popleft()
+            self._put_segment(index, data)
+        self._check_pause()
+
+    def _check_pause(self):
+        self.share.set(self.head_size + len(self.buffer) + self._held)
+        if self.producer is None or self.failure:
+            return
+        unsent = self.head_size - self.sent_size
+        paused = bool(self.waiting) or self.share.check() or \
+            (self.stream is not None and unsent >= self._stream_limit())
+        if paused and not self.paused:
+            self.paused = True
+            self.producer.pauseProducing()
+        elif not paused and self.paused:
+            self.paused = False
+            self.producer.resumeProducing()
+
+    def _put_segment(self, index, data):
+        self.uploading += 1
+        name = self._segment_name(index)
+        etag = hashlib.md5(data).hexdigest()
+        entry = {
+            'path': '/%s/%s' % (self.segment_container, name),
+            'etag': etag,
+            'size_bytes': len(data),
+        }
+        d = self.swiftconn.put_object(
+            self.segment_container, name, headers={'ETag': etag},
+            body=body_producer(data))
+        d.addBoth(self._release_held, len(data))
+        d.addCallbacks(self._cb_segment_put, self._fail,
+                       callbackArgs=(index, entry))
+
+    def _release_held(self, result, size):
+        self._held -= size
+        return result
+
+    def _cb_segment_put(self, result, index, entry):
+        self.uploading -= 1
+        self.segments[index] = entry
+        if self.failure:
+            self._delete_segment(entry['path'])
+            return
+        self._cut_segments()
+        self._check_done()
+
+    def _check_done(self):
+        if not self.closed or self.failure or self.uploading \
+                or self.waiting or self.committing:
+            return
+        self.committing = True
+        manifest = json.dumps(self.segments)
+        self._commit(lambda: self.swiftconn.put_object(
+            self.container, self.path, params={'multipart-manifest': 'put'},
+            body=body_producer(manifest)))
+
+    def _commit(self, put):
+        """ Writes the object with put() once the segments of the object it
+        replaces are known, and deletes those afterwards """
+        d = self._old_segments()
+        d.addCallback(lambda old: put().addCallback(self._cb_committed, old))
+        d.addCallbacks(self.finished.callback, self._fail)
+
+    def _cb_committed(self, result, replaced):
+        for path in replaced:
+            self._delete_segment(path)
+        return result
+
+    def _old_segments(self):
+        """ Returns a Deferred list of the paths of the segments that were
+        uploaded for the object that is about to be replaced. They are only
+        looked up once. """
+        if self.old_lookup is None:
+            self.old_lookup = self.swiftconn.head_object(
+                self.container, self.path)
+            self.old_lookup.addCallback(self._cb_old_head)
+            self.old_lookup.addErrback(self._eb_old_segments)
+        d = defer.Deferred()
+        self.old_lookup.addCallback(self._cb_pass_on, d)
+        return d
+
+    def _cb_pass_on(self, paths, d):
+        d.callback(list(paths))
+        return paths
+
+    def _cb_old_head(self, headers):
+        if headers.get('x-static-large-object', '').lower() != 'true':
+            return []
+        d = self.swiftconn.get_slo_manifest(self.container, self.path)
+        d.addCallback(self._cb_old_manifest)
+        return d
+
+    def _cb_old_manifest(self, result):
+        _, manifest = result
+        # Segments other clients put elsewhere may still be in use
+        prefix = '/%s/%s/slo/' % (self.segment_container, self.path)
+        paths = [encode_utf8(segment['name']) for segment in manifest]
+        return [path for path in paths if path.startswith(prefix)]
+
+    def _eb_old_segments(self, reason):
+        if not reason.check(NotFound):
+            log.err(reason, 'Could not look up the segments of %s/%s' % (
+                self.container, self.path))
+        return []
+
+    def _fail(self, reason):
+        if self.failure:
+            return
+        self.failure = reason
+        self.waiting.clear()
+        self.buffer.clear()
+        self.head, self.head_size = [], 0
+        if self.stream is not None:
+            self.stream.abort(reason)
+        for entry in self.segments:
+            if entry is not None:
+                self._delete_segment(entry['path'])
+        if self.producer is not None:
+            self.producer.stopProducing()
+        self.finished.errback(reason)
+
+    def _delete_segment(self, path):
+        container, name = path[1:].split('/', 1)
+        d = self.swiftconn.delete_object(container, name)
+        d.addErrback(log.err, 'Could not delete segment %s' % path)
+
+
+def body_producer(data):
+    " Returns an IBodyProducer for the string data, or None if it is empty "
+    if not data:
+        return None
+    return FileBodyProducer(StringIO(data))
+
+
+class DirectoryRename(object):
+    """ Moves every object under a pseudo-directory to a new name, with a
+    server-side copy (X-Copy-From) followed by a DELETE of the original, up
+    to `concurrency` objects at a time. The listing is paged through as the
+    objects are moved.
+
+    An original is only deleted once its copy is in place, so when a rename
+    fails part way through, the objects that haven't moved yet are still
+    under the old name and doing the same rename again picks up where it
+    left off. The directory object itself, if there is one, is copied before
+    and deleted after everything under it.
+
+    :param swiftconn: swftp.swift.SwiftConnection used for the requests
+    :param int concurrency: max number of objects to move in parallel
+    :param invalidate: callable(container, path) called for every name that
+        is changed
+    """
+    progress_interval = 1000
+
+    def __init__(self, swiftconn, container, path, newcontainer, newpath,
+                 concurrency, invalidate):
+        self.swiftconn = swiftconn
+        self.container = container
+        self.path = path
+        self.newcontainer = newcontainer
+        self.newpath = newpath
+        self.concurrency = concurrency
+        self.invalidate = invalidate
+        self.prefix = '%s/' % path
+        self.finished = defer.Deferred()
+        self.has_marker = False
+        self.names = deque()  # listed names that haven't been moved yet
+        self.marker = None
+        self.listing_done = False
+        self.fetching = False
+        self.moving = 0
+        self.moved = 0
+        self.failure = None
+        self.closing = False
+
+    def start(self, has_marker):
+        """ Starts moving objects. has_marker tells if there is an object
+        with the name of the directory itself.
+
+        @returns Deferred that fires with the number of objects moved
+        """
+        self.has_marker = has_marker
+        if has_marker:
+            d = self._copy(self.path, self.newpath)
+            d.addCallbacks(lambda _: self._fill(), self._fail)
+        else:
+            self._fill()
+        return self.finished
+
+    def _copy(self, name, newname):
+        return self.swiftconn.put_object(
+            self.newcontainer, newname,
+            headers={'X-Copy-From': '%s/%s' % (self.container, name)})
+
+    def _fill(self):
+        while self.names and self.moving < self.concurrency \
+                and not self.failure:
+            self._move(self.names.popleft())
+        if len(self.names) < self.concurrency and not self.listing_done \
+                and not self.fetching and not self.failure:
+            self.fetching = True
+            d = self.swiftconn.get_container(
+                self.container, prefix=self.prefix, marker=self.marker)
+            d.addCallbacks(self._cb_page, self._eb_page)
+        self._check_done()
+
+    def _cb_page(self, result):
+        self.fetching = False
+        _, objects = result
+        if not objects:
+            self.listing_done = True
+        for obj in objects:
+            self.names.append(encode_utf8(obj['name']))
+        if objects:
+            self.marker = self.names[-1]
+        self._fill()
+
+    def _eb_page(self, reason):
+        self.fetching = False
+        self._fail(reason)
+
+    def _move(self, name):
+        self.moving += 1
+        newname = self.newpath + name[len(self.path):]
+        d = self._copy(name, newname)
+        d.addCallback(
+            lambda _: self.swiftconn.delete_object(self.container, name))
+        d.addErrback(self._eb_gone)
+        d.addCallbacks(self._cb_moved, self._eb_move,
+                       callbackArgs=(name, newname))
+
+    def _eb_gone(self, reason):
+        # The object was removed by someone else while this was running
+        reason.trap(NotFound)
+
+    def _cb_moved(self, result, name, newname):
+        self.moving -= 1
+        self.moved += 1
+        self.invalidate(self.container, name)
+        self.invalidate(self.newcontainer, newname)
+        log.msg(metric='rename.objects')
+        if self.moved % self.progress_interval == 0:
+            log.msg('Renaming %s/%s to %s/%s: %s objects moved' % (
+                self.container, self.path, self.newcontainer, self.newpath,
+                self.moved))
+        self._fill()
+
+    def _eb_move(self, reason):
+        self.moving -= 1
+        self._fail(reason)
+
+    def _fail(self, reason):
+        if self.failure is None:
+            self.failure = reason
+        self._check_done()
+
+    def _check_done(self):
+        if self.moving or self.fetching or self.closing:
+            return
+        if self.failure:
+            log.msg('Renaming %s/%s to %s/%s failed after %s objects were '
+                    'moved. Renaming it again resumes it.' % (
+                        self.container, self.path, self.newcontainer,
+                        self.newpath, self.moved))
+            self.closing = True
+            self.finished.errback(self.failure)
+        elif self.listing_done and not self.names:
+            self.closing = True
+            d = defer.succeed(None)
+            if self.has_marker:
+                d.addCallback(lambda _: self.swiftconn.delete_object(
+                    self.container, self.path))
+                d.addErrback(self._eb_gone)
+            d.addCallback(lambda _: self.moved)
+            d.chainDeferred(self.finished)
+
+
+class RecursiveDelete(object):
+    """ Deletes every object in a container, or under a prefix of it, while
+    paging through its listing.
+
+    With a batch_size, objects are deleted batch_size at a time with the
+    bulk delete middleware. Without one, each object gets its own DELETE.
+    Either way up to `concurrency` requests are made in parallel. Objects
+    that are already gone are skipped, so when a delete fails part way
+    through, doing it again deletes whatever is left.
+
+    :param swiftconn: swftp.swift.SwiftConnection used for the requests
+    :param prefix: prefix of the objects to delete, or None for all of them
+    :param int batch_size: max number of objects per bulk delete, or 0 to
+        make one DELETE per object
+    :param int concurrency: max number of requests to make in parallel
+    :param invalidate: callable(container, path) called for every object
+        that is deleted
+    """
+    def __init__(self, swiftconn, container, prefix, batch_size, concurrency,
+                 invalidate):
+        self.swiftconn = swiftconn
+        self.container = container
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.invalidate = invalidate
+        self.finished = defer.Deferred()
+        self.names = deque()  # listed names that haven't been deleted yet
+        self.marker = None
+        self.listing_done = False
+        self.fetching = False
+        self.deleting = 0
+        self.deleted = 0
+        self.failure = None
+
+    def start(self):
+        """ @returns Deferred that fires with the number of objects deleted
+        """
+        self._fill()
+        return self.finished
+
+    def _fill(self):
+        batch = max(self.batch_size, 1)
+        while self.deleting < self.concurrency and not self.failure and (
+                len(self.names) >= batch or
+                (self.names and self.listing_done)):
+            names = [self.names.popleft()
+                     for _ in range(min(batch, len(self.names)))]
+            self._delete(names)
+        if len(self.names) < batch * self.concurrency \
+                and not self.listing_done and not self.fetching \
+                and not self.failure:
+            self.fetching = True
+            d = self.swiftconn.get_container(
+                self.container, prefix=self.prefix, marker=self.marker)
+            d.addCallbacks(self._cb_page, self._eb_page)
+        self._check_done()
+
+    def _cb_page(self, result):
+        self.fetching = False
+        _, objects = result
+        if not objects:
+            self.listing_done = True
+        for obj in objects:
+            self.names.append(encode_utf8(obj['name']))
+        if objects:
+            self.marker = self.names[-1]
+        self._fill()
+
+    def _eb_page(self, reason):
+        self.fetching = False
+        self._fail(reason)
+
+    def _delete(self, names):
+        self.deleting += 1
+        if self.batch_size:
+            d = self.swiftconn.bulk_delete(
+                ['/%s/%s' % (self.container, name) for name in names])
+        else:
+            d = self.swiftconn.delete_object(self.container, names[0])
+            d.addErrback(lambda reason: reason.trap(NotFound))
+        d.addCallbacks(self._cb_deleted, self._eb_delete,
+                       callbackArgs=(names,))
+
+    def _cb_deleted(self, result, names):
+        self.deleting -= 1
+        self.deleted += len(names)
+        for name in names:
+            self.invalidate(self.container, name)
+        log.msg(metric='delete.objects', count=len(names))
+        self._fill()
+
+    def _eb_delete(self, reason):
+        self.deleting -= 1
+        self._fail(reason)
+
+    def _fail(self, reason):
+        if self.failure is None:
+            self.failure = reason
+        self._check_done()
+
+    def _check_done(self):
+        if self.deleting or self.fetching or self.finished.called:
+            return
+        if self.failure:
+            self.finished.errback(self.failure)
+        elif self.listing_done and not self.names:
+            self.finished.callback(self.deleted)
+
+
+class RangeReceiver(Protocol):
+    " Receives the body of one ranged GET made by a ParallelDownload "
+    def __init__(self, download, start, end):
+        self.download = download
+        self.start = start
+        self.end = end
+        self.buffer = ChunkBuffer()
+        self.received = 0
+        self.verified = False  # response was a 206 for the requested range
+        self.done = False
+        self.paused = False
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        self.buffer.write(data)
+        self.download._range_data(self)
+
+    def connectionLost(self, reason):
+        self.download._range_lost(self, reason)
+
+
+class ParallelDownload(object):
+    """ Downloads an object with up to `concurrency` ranged GETs at a time and
+    hands the data to `consumer` in order, as if it were the body of one GET.
+    It is the consumer's transport, so the consumer can pause, resume and
+    stop it like an HTTP response.
+
+    Ranges after the first one are buffered until the consumer gets to them,
+    which bounds the memory used to concurrency * range_size bytes. They are
+    paused while the transfer budget is used up.
+
+    They are only requested once the first range's response is in, with
+    If-Match set to its ETag. If the object is overwritten part way through,
+    those GETs fail with 412 and so does the download, instead of mixing
+    data from two versions of the object. The size of the object is also
+    taken from that response's Content-Range, since the one passed in may
+    be out of date.
+
+    :param swiftconn: swftp.swift.SwiftConnection used for the GETs
+    :param consumer: twisted.internet.protocol.Protocol to deliver data to
+    :param int offset: where in the object to start
+    :param int size: size of the object, as far as the caller knows
+    :param budget: swftp.utils.TransferBudget the buffered data counts
+        against
+    """
+    interface.implements(IPushProducer)
+
+    def __init__(self, swiftconn, container, path, consumer, offset, size,
+                 range_size, concurrency, budget):
+        self.swiftconn = swiftconn
+        self.container = container
+        self.path = path
+        self.consumer = consumer
+        self.size = size
+        self.range_size = range_size
+        self.concurrency = concurrency
+        self.first_start = self.next_start = offset
+        self.etag = None
+        self.ranges = deque()
+        self.started = defer.Deferred()
+        self.paused = False
+        self.stopped = False
+        self.share = budget.share(self._update_pause)
+        self._delivering = False
+
+    def start(self):
+        """ Starts the download.
+
+        @returns Deferred that fires with the response to the first range
+        """
+        self.consumer.makeConnection(self)
+        self._start_range()
+        return self.started
+
+    def _start_range(self):
+        if self.stopped or self.next_start >= self.size \
+                or len(self.ranges) >= self.concurrency:
+            return
+        if self.ranges and not self.started.called:
+            # The ETag of the first range isn't known yet
+            return
+        start = self.next_start
+        end = min(start + self.range_size, self.size) - 1
+        self.next_start = end + 1
+        receiver = RangeReceiver(self, start, end)
+        self.ranges.append(receiver)
+        headers = {'Range': 'bytes=%s-%s' % (start, end)}
+        if self.etag:
+            headers['If-Match'] = self.etag
+        d = self.swiftconn.get_object(
+            self.container, self.path, headers=headers, receiver=receiver)
+        d.addCallbacks(self._cb_range_started, self._eb_range_started,
+                       callbackArgs=(receiver,))
+
+    def _cb_range_started(self, response, receiver):
+        if self.stopped:
+            return
+        if response.code != 206:
+            # Swift ignored the Range header, so the body isn't this range
+            self._fail(failure.Failure(ConnectionLost(
+                'Expected a partial response, got %s' % response.code)))
+            return
+        if not self.started.called and receiver.start == self.first_start:
+            content_range = parse_content_range(
+                response.headers.getRawHeaders('content-range', [None])[0])
+            if content_range is None or content_range[2] is None \
+                    or content_range[0] != receiver.start:
+                self._fail(failure.Failure(ConnectionLost(
+                    'Expected the size of the object in Content-Range')))
+                return
+            # The object may have changed size since the caller looked
+            _, receiver.end, self.size = content_range
+            self.next_start = receiver.end + 1
+        receiver.verified = True
+        self._update_pause()
+        if not self.started.called and receiver.start == self.first_start:
+            self.etag = response.headers.getRawHeaders('etag', [None])[0]
+            self.started.callback(response)
+            for _ in range(self.concurrency):
+                self._start_range()
+        self._deliver()
+
+    def _eb_range_started(self, reason):
+        if reason.check(RequestError) and int(reason.value.status) == 412:
+            # The object no longer has the ETag of the first range
+            reason = failure.Failure(ConnectionLost(
+                'Object changed during the download'))
+        self._fail(reason)
+
+    def _range_data(self, receiver):
+        if self.stopped:
+            return
+        if receiver is self.ranges[0]:
+            self._deliver()
+        else:
+            self._update_pause()
+
+    def _range_lost(self, receiver, reason):
+        if self.stopped:
+            return
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            self._fail(reason)
+            return
+        if receiver.received != receiver.end - receiver.start + 1:
+            self._fail(failure.Failure(ConnectionLost(
+                'Range %s-%s ended early' % (receiver.start, receiver.end))))
+            return
+        receiver.done = True
+        self._deliver()
+
+    def _deliver(self):
+        " Hands buffered data to the consumer, in order "
+        if self._delivering:
+            return
+        self._delivering = True
+        try:
+            while self.ranges and not self.paused and not self.stopped:
+                head = self.ranges[0]
+                if not head.verified:
+                    break
+                if len(head.buffer):
+                    self.consumer.dataReceived(head.buffer.read_chunk())
+                    continue
+                if not head.done:
+                    break
+                self.ranges.popleft()
+                self._start_range()
+            if not self.ranges and not self.stopped:
+                self.stopped = True
+                self.share.close()
+                self.consumer.connectionLost(failure.Failure(ResponseDone()))
+        finally:
+            self._delivering = False
+        self._update_pause()
+
+    def _update_pause(self):
+        """ Pauses every range while the consumer is paused, and every range
+        but the one being delivered while the transfer budget is used up """
+        if self.stopped:
+            return
+        self.share.set(sum(len(receiver.buffer) for receiver in self.ranges))
+        over = self.share.check()
+        for index, receiver in enumerate(self.ranges):
+            if not receiver.transport or receiver.done:
+                continue
+            paused = self.paused or (over and index > 0)
+            if paused != receiver.paused:
+                receiver.paused = paused
+                if paused:
+                    receiver.transport.pauseProducing()
+                else:
+                    receiver.transport.resumeProducing()
+
+    def _fail(self, reason):
+        if self.stopped:
+            return
+        self._stop_ranges()
+        if not self.started.called:
+            self.started.errback(reason)
+        else:
+            self.consumer.connectionLost(reason)
+
+    def _stop_ranges(self):
+        self.stopped = True
+        self.share.close()
+        ranges, self.ranges = self.ranges, deque()
+        for receiver in ranges:
+            if receiver.transport and not receiver.done:
+                receiver.transport.stopProducing()
+
+    # IPushProducer
+    def pauseProducing(self):
+        self.paused = True
+        self._update_pause()
+
+    def resumeProducing(self):
+        self.paused = False
+        self._deliver()
+
+    def stopProducing(self):
+        if self.stopped:
+            return
+        self._stop_ranges()
+        self.consumer.connectionLost(failure.Failure(ConnectionAborted()))
+
+
+class ListingRange(object):
+    " A marker/end_marker slice of a listing that is paged through in order "
+    def __init__(self, marker=None, end_marker=None):
+        self.marker = marker
+        self.end_marker = end_marker
+        self.pages = deque()
+        self.fetching = False
+        self.done = False
+
+
+class SwiftListing(object):
+    """ Pages through an account or container listing as the consumer asks
+    for pages, fetching at most `readahead` pages ahead of it.
+
+    When a page comes back with at least split_threshold entries and fewer
+    than `concurrency` ranges are being fetched, the rest of that range is
+    split up and the pieces are fetched in parallel. Pages are still handed
+    out in listing order.
+
+    An object and a pseudo-directory with the same name show up as just the
+    directory. To do that, an object is held back until the listing has
+    moved past where its directory would be, up to max_held entries.
+
+    :param fetch_page: callable(marker, end_marker, entry_callback) that
+        requests one page of the listing and calls entry_callback with a
+        (formatted_name, entry) tuple for each entry in it
+    :param prefix: prefix of every name in the listing
+    :param int readahead: max number of pages to buffer per range, or None
+        for no limit
+    :param int concurrency: max number of ranges to fetch in parallel
+    :param int split_threshold: number of entries that makes a page full
+    """
+    max_held = 10000
+
+    def __init__(self, fetch_page, prefix=None, readahead=1, concurrency=1,
+                 split_threshold=1000):
+        self.fetch_page = fetch_page
+        self.prefix = prefix
+        self.readahead = readahead
+        self.concurrency = concurrency
+        self.split_threshold = split_threshold
+        self.ranges = [ListingRange()]
+        self.waiting = []
+        self.failure = None
+        self.closed = False
+        self._held = deque()
+        self._unresolved = deque()  # (name, cell) of held objects
+        self._filling = False
+        self._refill = False
+        self._delivering = False
+
+    @property
+    def done(self):
+        " True once every page has been handed out "
+        return not self.ranges and not self._held
+
+    def next_page(self):
+        """ Returns a Deferred that fires with the next list of
+            (formatted_name, entry) tuples, or an empty list at the end. """
+        d = defer.Deferred()
+        self.waiting.append(d)
+        self._fill()
+        self._deliver()
+        return d
+
+    def close(self):
+        " Stops fetching pages. Responses that are in flight are dropped. "
+        self.closed = True
+        self.ranges = []
+        self._held.clear()
+        self._unresolved.clear()
+
+    def _fill(self):
+        " Starts a fetch for every range that has room for another page "
+        if self._filling:
+            self._refill = True
+            return
+        self._filling = True
+        try:
+            self._refill = True
+            while self._refill:
+                self._refill = False
+                for listing_range in list(self.ranges):
+                    if self.closed or self.failure:
+                        return
+                    if listing_range.done or listing_range.fetching:
+                        continue
+                    if self.readahead is not None and \
+                            len(listing_range.pages) >= self.readahead:
+                        continue
+                    self._fetch(listing_range)
+        finally:
+            self._filling = False
+
+    def _fetch(self, listing_range):
+        listing_range.fetching = True
+        page = []
+        d = self.fetch_page(
+            listing_range.marker, listing_range.end_marker, page.append)
+        d.addCallbacks(self._cb_got_page, self._eb_got_page,
+                       callbackArgs=(listing_range, page),
+                       errbackArgs=(listing_range,))
+
+    def _cb_got_page(self, result, listing_range, page):
+        listing_range.fetching = False
+        if self.closed:
+            return
+        if not page:
+            listing_range.done = True
+        else:
+            listing_range.pages.append(page)
+            first = listing_entry_name(page[0][1])
+            listing_range.marker = listing_entry_name(page[-1][1])
+            if len(page) >= self.split_threshold:
+                self._split(listing_range, first)
+        self._fill()
+        self._deliver()
+
+    def _eb_got_page(self, failure, listing_range):
+        listing_range.fetching = False
+        if self.failure is None and not self.closed:
+            self.failure = failure
+        self._deliver()
+
+    def _split(self, listing_range, first):
+        live = len([r for r in self.ranges if not r.done])
+        if live >= self.concurrency:
+            return
+        bounds = split_listing_range(
+            self.prefix, first, listing_range.marker,
+            listing_range.end_marker, self.concurrency - live + 1)
+        if not bounds:
+            return
+        log.msg(metric='listing.split', count=len(bounds))
+        end_markers = [listing_end_marker_after(bound)
+                       for bound in bounds[1:]] + [listing_range.end_marker]
+        new_ranges = [ListingRange(bound, end_marker)
+                      for bound, end_marker in zip(bounds, end_markers)]
+        listing_range.end_marker = listing_end_marker_after(bounds[0])
+        idx = self.ranges.index(listing_range) + 1
+        self.ranges[idx:idx] = new_ranges
+
+    def _deliver(self):
+        " Hands out pages to whoever is waiting on next_page "
+        if self._delivering:
+            return
+        self._delivering = True
+        try:
+            while self.waiting:
+                if self.failure:
+                    self.waiting.pop(0).errback(self.failure)
+                    continue
+                page = self._take_page()
+                if page is None:
+                    break
+                self.waiting.pop(0).callback(page)
+        finally:
+            self._delivering = False
+
+    def _take_page(self):
+        " Returns the next page, [] at the end or None if none is ready "
+        while not self.failure:
+            while self.ranges and self.ranges[0].done \
+                    and not self.ranges[0].pages:
+                self.ranges.pop(0)
+            if not self.ranges:
+                page = [item for item, _ in self._held]
+                self._held.clear()
+                self._unresolved.clear()
+                return page
+            first = self.ranges[0]
+            if first.pages:
+                page = self._release(first.pages.popleft())
+                self._fill()
+                if page:
+                    return page
+                continue
+            self._fill()
+            if first.fetching or (not first.pages and not first.done):
+                return None
+
+    def _release(self, page):
+        """ Returns the entries of page that are ready to be handed out,
+            replacing any held object with a directory of the same name.
+
+            Names come in order, so every object that is still waiting for
+            its directory is a prefix of the latest name, and _unresolved
+            goes from the shortest of them to the longest. Only its end has
+            to be checked against each new name. """
+        for item in page:
+            name = listing_entry_name(item[1])
+            replaced = False
+            while self._unresolved:
+                held_name, cell = self._unresolved[-1]
+                directory_name = held_name + u'/'
+                if name < directory_name:
+                    break
+                if name == directory_name:
+                    cell[0] = item
+                    replaced = True
+                cell[1] = True
+                self._unresolved.pop()
+            if not replaced:
+                cell = [item, name.endswith(u'/')]
+                self._held.append(cell)
+                if not cell[1]:
+                    self._unresolved.append((name, cell))
+        ready = []
+        while self._held and (
+                self._held[0][1] or len(self._held) > self.max_held):
+            item, resolved = self._held.popleft()
+            if not resolved:
+                self._unresolved.popleft()
+            ready.append(item)
+        return ready
+
+
 class SwiftFileSystem(object):
-    "Defines a common interface used to create Swift similar to a filesystem"
+    """ Defines a common interface used to create Swift similar to a
+    filesystem.
+
+    Results of getAttrs and checkFileExistance are kept in an attribute cache
+    for attr_cache_ttl seconds (0 disables it). The cache is per-session
+    unless shared_attr_cache is set, in which case that cache is used by every
+    session. Entries are keyed by username and invalidated by writes made
+    through this class.
+
+    Listings are paged through serially unless listing_concurrency is more
+    than 1. In that case, a page with at least listing_split_threshold
+    entries causes the rest of the listing to be split into marker and
+    end_marker ranges that are fetched in parallel.
+
+    Downloads of objects larger than download_range_size are split into
+    ranges fetched download_concurrency at a time, when that is more than 1.
+
+    Renaming a pseudo-directory moves the objects under it
+    rename_concurrency at a time.
+
+    With recursive_rmdir, removing a directory first deletes everything
+    under it, in batches if the cluster has the bulk delete middleware and
+    with delete_concurrency parallel DELETEs otherwise.
+    """
+    attr_cache_ttl = 0
+    attr_cache_size = 10000
+    shared_attr_cache = None
+    listing_concurrency = 1
+    listing_split_threshold = 1000
+    download_concurrency = 1
+    download_range_size = 16 * 1024 * 1024
+    upload_segment_size = 0
+    upload_concurrency = 2
+    transfer_budget = TransferBudget()
+    object_cache = None
+    upload_spool = None
+    rename_concurrency = 4
+    recursive_rmdir = False
+    delete_concurrency = 10
+    # What /info says about each cluster, keyed by netloc. {} means the
+    # cluster has no /info.
+    cluster_info = {}
+
     def __init__(self, swiftconn):
         self.swiftconn = swiftconn
+        self.attr_cache = self.shared_attr_cache
+        if self.attr_cache is None and self.attr_cache_ttl:
+            self.attr_cache = LRUCache(
+                max_size=self.attr_cache_size, ttl=self.attr_cache_ttl)
+
+    def _attr_cache_key(self, container, path):
+        return (self.swiftconn.username, container, path)
+
+    def _children_cache_key(self, container, path):
+        return (self.swiftconn.username, container, path, 'children')
+
+    def _get_cached_attrs(self, container, path, listed=True):
+        """ Returns a cached (kind, attrs) tuple or None
+
+        :param bool listed: whether attributes taken from a listing will do.
+            Listings can lag behind writes, so they don't say how much of an
+            object there is to read
+        """
+        if self.attr_cache is None:
+            return None
+        cached = self.attr_cache.get(self._attr_cache_key(container, path))
+        if cached is None:
+            return None
+        kind, attrs, from_listing = cached
+        if from_listing and not listed:
+            return None
+        if attrs is not None:
+            attrs = dict(attrs)
+        return kind, attrs
+
+    def _cache_attrs(self, container, path, kind, attrs, listed=False):
+        if self.attr_cache is not None:
+            if attrs is not None:
+                attrs = dict(attrs)
+            self.attr_cache.set(
+                self._attr_cache_key(container, path), (kind, attrs, listed))
+
+    def _get_cached_children(self, container, path):
+        """ Returns whether the path is known to have children (making it a
+            pseudo-directory), or None if that isn't known """
+        if self.attr_cache is None:
+            return None
+        return self.attr_cache.get(self._children_cache_key(container, path))
+
+    def _cache_children(self, container, path, has_children):
+        if self.attr_cache is not None and path:
+            self.attr_cache.set(
+                self._children_cache_key(container, path), has_children)
+
+    def _cache_listing_entry(self, container, entry):
+        if self.attr_cache is None:
+            return
+        if container is None:
+            self._cache_attrs(entry['name'], None, ATTR_DIRECTORY, {
+                'count': entry.get('count', 0),
+                'size': entry.get('bytes', 0),
+                'content_type': 'application/directory',
+            }, listed=True)
+            return
+        parsed = parse_listing_entry(entry)
+        if parsed is None:
+            return
+        kind, attrs = parsed
+        path = entry.get('subdir', entry.get('name')).rstrip('/')
+        if kind == ATTR_DIRECTORY:
+            self._cache_children(container, path, True)
+            # An object 'dir' is listed just before the 'dir/' subdir, don't
+            # let the subdir hide that the object exists
+            cached = self._get_cached_attrs(container, path)
+            if cached is not None and cached[0] == ATTR_OBJECT:
+                return
+        self._cache_attrs(container, path, kind, attrs, listed=True)
+
+    def invalidate(self, container, path):
+        """ Drops cached attributes for a path and each of its parents, since
+            their existence, size or object count can change with it """
+        if self.attr_cache is None:
+            return
+        while path:
+            self.attr_cache.delete(self._attr_cache_key(container, path))
+            self.attr_cache.delete(self._children_cache_key(container, path))
+            path = path.rpartition('/')[0]
+        self.attr_cache.delete(self._attr_cache_key(container, None))
+        self.attr_cache.delete(self._attr_cache_key(None, None))
+
+    def _cb_invalidate(self, result, container, path):
+        self.invalidate(container, path)
+        return result
 
     def startFileUpload(self, fullpath):
-        "returns IConsumer to write to object data to"
+        """ returns IConsumer to write to object data to
+
+            With an upload_spool that isn't full, the data is written to
+            local disk first and uploaded from there. Otherwise it goes
+            straight to Swift with uploadObject.
+        """
         container, path = obj_to_path(fullpath)
-        consumer = SwiftWriteFile()
-        d = self.swiftconn.put_object(container, path, body=consumer)
+        self.invalidate(container, path)
+        if self.upload_spool is not None:
+            if self.upload_spool.full:
+                log.msg(metric='spool.full')
+            else:
+                try:
+                    consumer = SpooledUpload(
+                        self.upload_spool, self, container, path)
+                except (IOError, OSError):
+                    log.err(None, 'Could not create a spool file')
+                else:
+                    d = consumer.finished
+                    d.addBoth(self._cb_invalidate, container, path)
+                    return d, consumer
+        return self.uploadObject(container, path)
+
+    def uploadObject(self, container, path, length=None):
+        """ returns (Deferred, IConsumer) for a PUT straight to Swift
+
+            If upload_segment_size is set, uploads larger than that are
+            stored as a Static Large Object made of segments of that size.
+        """
+        if self.upload_segment_size > 0:
+            consumer = SegmentedUpload(
+                self.swiftconn, container, path, self.upload_segment_size,
+                self.upload_concurrency, self.transfer_budget)
+            self._get_info().addCallback(consumer.set_info)
+            d = consumer.finished
+        else:
+            consumer = SwiftWriteFile(length)
+            d = self.swiftconn.put_object(container, path, body=consumer)
+        d.addBoth(self._cb_invalidate, container, path)
         return d, consumer
 
-    def startFileDownload(self, fullpath, consumer, offset=0):
-        "consumer: Protocol"
+    def startFileDownload(self, fullpath, consumer, offset=0, size=None):
+        """ consumer: Protocol
+
+            If the size of the object is given and more than
+            download_range_size bytes are left after offset, the object is
+            fetched as up to download_concurrency parallel ranged GETs.
+
+            With an object_cache, objects are served from the cache when a
+            conditional GET shows they haven't changed, and whole objects
+            that are downloaded are added to it.
+        """
         container, path = obj_to_path(fullpath)
+        if self.object_cache is None:
+            return self._start_download(container, path, consumer, offset,
+                                        size)
+
+        key = (self.swiftconn.storage_url, container, path)
+        receiver = consumer
+        if offset == 0:
+            receiver = CachingReceiver(self.object_cache, key, consumer, size)
+        entry = self.object_cache.get(key)
+        if entry is None:
+            log.msg(metric='cache.miss')
+            d = self._start_download(container, path, receiver, offset, size)
+            if receiver is not consumer:
+                d.addCallback(receiver.cb_response)
+            return d
+
+        headers = entry.conditional_headers()
+        if offset > 0:
+            headers['Range'] = 'bytes=%s-' % offset
+        d = self.swiftconn.get_object(container, path, headers=headers,
+                                      receiver=receiver)
+        d.addCallbacks(self._cb_modified, self._eb_not_modified,
+                       callbackArgs=(key, receiver, consumer),
+                       errbackArgs=(key, entry, consumer, offset))
+        return d
+
+    def _cb_modified(self, response, key, receiver, consumer):
+        " The object changed since it was cached "
+        log.msg(metric='cache.miss')
+        self.object_cache.remove(key)
+        if receiver is not consumer:
+            receiver.cb_response(response)
+        return response
+
+    def _eb_not_modified(self, err, key, entry, consumer, offset):
+        " Serves the cached copy if the conditional GET found no changes "
+        if not err.check(PageRedirect) or int(err.value.status) != 304:
+            if err.check(NotFound):
+                self.object_cache.remove(key)
+            return err
+        try:
+            d = CachedFileReader(entry, consumer, offset).start()
+        except (IOError, OSError):
+            log.err(None, 'Could not read from the object cache')
+            self.object_cache.remove(key)
+            log.msg(metric='cache.miss')
+            _, container, path = key
+            return self._start_download(container, path, consumer, offset,
+                                        entry.size)
+        log.msg(metric='cache.hit')
+        return d
+
+    def _start_download(self, container, path, consumer, offset, size):
+        if size is not None and self.download_concurrency > 1 \
+                and size - offset > self.download_range_size:
+            download = ParallelDownload(
+                self.swiftconn, container, path, consumer, offset, size,
+                self.download_range_size, self.download_concurrency,
+                self.transfer_budget)
+            return download.start()
         headers = {}
         if offset > 0:
             headers['Range'] = 'bytes=%s-' % offset
@@ -141,15 +1565,29 @@ class SwiftFileSystem(object):
 
     def touchFile(self, fullpath):
         container, path = obj_to_path(fullpath)
-        return self.swiftconn.put_object(container, path, body=None)
+        d = self.swiftconn.put_object(container, path, body=None)
+        d.addBoth(self._cb_invalidate, container, path)
+        return d
 
     def checkFileExistance(self, fullpath):
         container, path = obj_to_path(fullpath)
         if container is None or path is None:
             raise NotImplementedError
 
+        # The size found here limits how much of the object is read
+        cached = self._get_cached_attrs(container, path, listed=False)
+        if cached is not None and cached[0] == ATTR_OBJECT:
+            return defer.succeed(cached[1])
+        if cached is not None and cached[0] == ATTR_MISSING:
+            return defer.fail(NotFound(404, 'Not Found'))
+
         d = self.swiftconn.head_object(container, path)
         d.addCallback(cb_parse_object_headers)
+
+        def cb(attrs):
+            self._cache_attrs(container, path, ATTR_OBJECT, attrs)
+            return attrs
+        d.addCallback(cb)
         return d
 
     def removeFile(self, fullpath):
@@ -157,6 +1595,7 @@ class SwiftFileSystem(object):
         if container is None or path is None:
             raise NotImplementedError
         d = self.swiftconn.delete_object(container, path)
+        d.addBoth(self._cb_invalidate, container, path)
         return d
 
     @defer.inlineCallbacks
@@ -166,60 +1605,92 @@ class SwiftFileSystem(object):
         if not container or not newcontainer:
             raise NotImplementedError
 
+        try:
+            yield self._renameFile(container, path, newcontainer, newpath)
+        finally:
+            self.invalidate(container, path)
+            self.invalidate(newcontainer, newpath)
+
+    @defer.inlineCallbacks
+    def _renameFile(self, container, path, newcontainer, newpath):
         if not path and not newpath:
             # Attempt to 'rename' a container (metadata is lost)
             yield self.swiftconn.delete_container(container)
             yield self.swiftconn.put_container(newcontainer)
             defer.returnValue(None)
         else:
-            # If the object doesn't actually exist, ABORT
             path = path or ''
             newpath = newpath or ''
             try:
                 yield self.swiftconn.head_object(container, path)
+                exists = True
             except NotFound:
-                raise NotImplementedError
+                exists = False
 
-            # List out children of this path. If there are any, ABORT
             prefix = None
             if path:
                 prefix = "%s/" % path
             _, children = yield self.swiftconn.get_container(
                 container, prefix=prefix, limit=1)
-            if len(children) > 0:
-                raise NotImplementedError
+            if len(children) == 0:
+                if not exists:
+                    raise NotFound(404, 'Not Found')
+                # This is an actual object with no children. Free to rename.
+                yield self.swiftconn.put_object(
+                    newcontainer, newpath,
+                    headers={'X-Copy-From': '%s/%s' % (container, path)})
+                yield self.swiftconn.delete_object(container, path)
+                defer.returnValue(None)
 
-            # This is an actual object with no children. Free to rename.
-            yield self.swiftconn.put_object(
-                newcontainer, newpath,
-                headers={'X-Copy-From': '%s/%s' % (container, path)})
-            yield self.swiftconn.delete_object(container, path)
+            # A pseudo-directory. Containers with objects in them can't be
+            # renamed, and neither can a directory into itself or its parent.
+            if not path or not newpath:
+                raise NotImplementedError
+            if container == newcontainer and (
+                    newpath.startswith(prefix) or
+                    path.startswith('%s/' % newpath)):
+                raise NotImplementedError
+            if container != newcontainer:
+                yield self.swiftconn.head_container(newcontainer)
+            rename = DirectoryRename(
+                self.swiftconn, container, path, newcontainer, newpath,
+                self.rename_concurrency, self.invalidate)
+            yield rename.start(exists)
 
     @defer.inlineCallbacks
     def getAttrs(self, fullpath):
         container, path = obj_to_path(fullpath)
+        cached = self._get_cached_attrs(container, path)
+        if cached is not None:
+            if cached[0] == ATTR_MISSING:
+                raise NotFound(404, 'Not Found')
+            defer.returnValue(cached[1])
+
         if path:
             try:
                 headers = yield self.swiftconn.head_object(container, path)
-                defer.returnValue(
-                    cb_parse_object_headers(headers))
+                kind, attrs = ATTR_OBJECT, cb_parse_object_headers(headers)
             except NotFound:
-                prefix = None
-                if path:
-                    prefix = "%s/" % path
-                _, children = yield self.swiftconn.get_container(
-                    container, prefix=prefix, limit=1)
-                if len(children) == 0:
+                # Not an object, but it may be a pseudo-directory
+                has_children = self._get_cached_children(container, path)
+                if has_children is None:
+                    _, children = yield self.swiftconn.get_container(
+                        container, prefix="%s/" % path, limit=1)
+                    has_children = len(children) > 0
+                    self._cache_children(container, path, has_children)
+                if not has_children:
+                    self._cache_attrs(container, path, ATTR_MISSING, None)
                     raise NotFound(404, 'Not Found')
-                defer.returnValue(
-                    {'content_type': 'application/directory'})
-
+                kind = ATTR_DIRECTORY
+                attrs = {'content_type': 'application/directory'}
         elif container:
             headers = yield self.swiftconn.head_container(container)
-            defer.returnValue(cb_parse_container_headers(headers))
+            kind, attrs = ATTR_DIRECTORY, cb_parse_container_headers(headers)
         else:
             headers = yield self.swiftconn.head_account()
-            defer.returnValue(cb_parse_account_headers(headers))
+            kind, attrs = ATTR_DIRECTORY, cb_parse_account_headers(headers)
+        self._cache_attrs(container, path, kind, attrs)
+        defer.returnValue(attrs)
 
     def makeDirectory(self, fullpath, attrs=None):
         container, path = obj_to_path(fullpath)
@@ -228,13 +1699,35 @@ class SwiftFileSystem(object):
             d = self.swiftconn.put_object(container, path, headers=headers)
         else:
             d = self.swiftconn.put_container(container)
+        d.addBoth(self._cb_invalidate, container, path)
         return d
 
-    @defer.inlineCallbacks
     def removeDirectory(self, fullpath):
         container, path = obj_to_path(fullpath)
+        d = self._removeDirectory(container, path)
+        d.addBoth(self._cb_invalidate, container, path)
+        return d
+
+    @defer.inlineCallbacks
+    def _removeDirectory(self, container, path):
+        deleted = 0
+        if self.recursive_rmdir:
+            batch_size = yield self._bulk_delete_size()
+            prefix = None
+            if path:
+                prefix = path + '/'
+            delete = RecursiveDelete(
+                self.swiftconn, container, prefix, batch_size,
+                self.delete_concurrency, self.invalidate)
+            deleted = yield delete.start()
         if path:
-            yield self.swiftconn.delete_object(container, path)
+            try:
+                yield self.swiftconn.delete_object(container, path)
+            except NotFound:
+                # Directories that only exist because of their contents
+                # have no marker object
+                if not deleted:
+                    raise
         else:
             try:
                 yield self.swiftconn.delete_container(container)
@@ -243,6 +1736,50 @@ class SwiftFileSystem(object):
                 yield task.deferLater(
                     reactor, 2, self.swiftconn.delete_container, container)
 
+    @defer.inlineCallbacks
+    def _get_info(self):
+        """ Returns the capabilities of the cluster from its /info, or {}
+        if they aren't known. Only an answer and a 404 are cached, so after
+        any other error /info is asked for again next time. """
+        netloc = urlparse.urlsplit(self.swiftconn.storage_url).netloc
+        if netloc not in self.cluster_info:
+            try:
+                _, info = yield self.swiftconn.get_info()
+            except NotFound:
+                info = {}
+            except Exception:
+                log.err(None, 'Could not get /info from %s' % netloc)
+                defer.returnValue({})
+            self.cluster_info[netloc] = info
+        defer.returnValue(self.cluster_info[netloc])
+
+    @defer.inlineCallbacks
+    def _bulk_delete_size(self):
+        """ Returns how many objects can be deleted with one bulk delete
+        request, or 0 if the cluster doesn't support it """
+        info = yield self._get_info()
+        try:
+            size = info['bulk_delete']['max_deletes_per_request']
+        except (KeyError, TypeError):
+            size = 0
+        defer.returnValue(size)
+
+    def get_listing(self, fullpath, readahead=1):
+        """
+            Returns a SwiftListing that pages through the listing of objects,
+            collapsed into a directory structure. Works for account, container
+            and object prefix listings. Nothing is requested until the first
+            page is asked for.
+
+            :param int readahead: max number of pages to fetch ahead of the
+                consumer, or None for no limit
+        """
+        container, path = obj_to_path(fullpath)
+        if container:
+            return self._container_listing(container, path, readahead)
+        else:
+            return self._account_listing(readahead)
+
     def get_full_listing(self, fullpath):
         """
             Return a full listing of objects, collapsed into a directory
@@ -251,56 +1788,76 @@ class SwiftFileSystem(object):
 
             @returns dict of {name: property} values
         """
-        container, path = obj_to_path(fullpath)
-        if container:
-            return self.get_container_listing(container, path)
-        else:
-            return self.get_account_listing()
+        return self._read_listing(
+            self.get_listing(fullpath, readahead=None))
+
+    def get_container_listing(self, container, path):
+        return self._read_listing(
+            self._container_listing(container, path, None))
 
-    def get_container_listing(self, container, path, marker=None,
-                              all_files=None):
-        if all_files is None:
-            all_files = OrderedDict()
+    def get_account_listing(self):
+        return self._read_listing(self._account_listing(None))
+
+    @defer.inlineCallbacks
+    def _read_listing(self, listing):
+        all_files = OrderedDict()
+        while True:
+            page = yield listing.next_page()
+            if not page:
+                break
+            all_files.update(page)
+        defer.returnValue(all_files)
+
+    def _container_listing(self, container, path, readahead):
         prefix = None
         if path:
             prefix = "%s/" % path
-        d = self.swiftconn.get_container(
-            container, prefix=prefix, delimiter='/', marker=marker)
-
-        def cb(results):
-            _, files = results
-            next_marker = None
-            for f in files:
-                if 'subdir' in f:
-                    f['name'] = f['subdir']
-                    f['content-type'] = 'application/directory'
-                f['formatted_name'] = os.path.basename(
-                    f['name'].encode("utf-8").rstrip('/'))
-                all_files[f['formatted_name']] = f
-                next_marker = f['name']
-            if len(files) > 0:
-                return self.get_container_listing(
-                    container, path, marker=next_marker, all_files=all_files)
-            return all_files
-        d.addCallback(cb)
-        return d
-
-    def get_account_listing(self, marker=None, all_files=None):
-        if all_files is None:
-            all_files = OrderedDict()
-        d = self.swiftconn.get_account(marker=marker)
 
-        def cb(results):
-            _, files = results
-            next_marker = None
-            for f in files:
+        def format_entry(f):
+            self._cache_listing_entry(container, f)
+            if 'subdir' in f:
+                f['name'] = f['subdir']
                 f['content-type'] = 'application/directory'
-                f['formatted_name'] = f['name'].encode("utf-8")
-                all_files[f['formatted_name']] = f
-                next_marker = f['name']
-            if len(files) > 0:
-                return self.get_account_listing(
-                    marker=next_marker, all_files=all_files)
-            return all_files
-        d.addCallback(cb)
-        return d
+            f['formatted_name'] = os.path.basename(
+                f['name'].encode("utf-8").rstrip('/'))
+            return f['formatted_name'], f
+
+        def fetch_page(marker, end_marker, callback):
+            count = [0]
+
+            def entry_cb(f):
+                count[0] += 1
+                callback(format_entry(f))
+
+            d = self.swiftconn.get_container(
+                container, prefix=prefix, delimiter='/', marker=marker,
+                end_marker=end_marker, entry_callback=entry_cb)
+            if marker is None:
+                d.addCallback(self._cb_cache_children, container, path, count)
+            return d
+
+        return SwiftListing(
+            fetch_page, prefix=prefix, readahead=readahead,
+            concurrency=self.listing_concurrency,
+            split_threshold=self.listing_split_threshold)
+
+    def _cb_cache_children(self, result, container, path, count):
+        self._cache_children(container, path, count[0] > 0)
+        return result
+
+    def _account_listing(self, readahead):
+        def format_entry(f):
+            self._cache_listing_entry(None, f)
+            f['content-type'] = 'application/directory'
+            f['formatted_name'] = f['name'].encode("utf-8")
+            return f['formatted_name'], f
+
+        def fetch_page(marker, end_marker, callback):
+            return self.swiftconn.get_account(
+                marker=marker, end_marker=end_marker,
+                entry_callback=lambda f: callback(format_entry(f)))
+
+        return SwiftListing(
+            fetch_page, readahead=readahead,
+            concurrency=self.listing_concurrency,
+            split_threshold=self.listing_split_threshold)
@@ -0,0 +1,69 @@
+"""
+Micro-benchmark for the SFTP download receive buffer. Feeds Swift-sized
+chunks into a buffer and drains it with SFTP-sized reads, the way
+SwiftFileReceiver does, and reports throughput for the old string buffer and
+ChunkBuffer.
+
+Usage: python -m swftp.test.bench_receive_buffer [total MB]
+
+See COPYING for license information.
+"""
+import sys
+import time
+
+from swftp.utils import ChunkBuffer
+
+CHUNK_SIZE = 64 * 1024  # size of the chunks read from Swift
+READ_SIZE = 32 * 1024  # size of the reads most SFTP clients make
+BUFFER_LIMIT = 1024 * 1024  # SwiftFileReceiver.download_buffer_limit
+
+
+class StringBuffer(object):
+    " The str concatenate-and-slice buffer SwiftFileReceiver used to have "
+    def __init__(self):
+        self._buffer = ''
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def write(self, data):
+        self._buffer += data
+
+    def read(self, length):
+        data = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+        return data
+
+
+def run(buffer_class, total):
+    """ Writes `total` bytes through a buffer, keeping about BUFFER_LIMIT
+        bytes buffered. Returns the number of seconds it took. """
+    buf = buffer_class()
+    chunk = 'x' * CHUNK_SIZE
+    written = read = 0
+    start = time.time()
+    while read < total:
+        while written < total and len(buf) < BUFFER_LIMIT:
+            buf.write(chunk)
+            written += CHUNK_SIZE
+        while len(buf) >= READ_SIZE or (written == total and len(buf)):
+            read += len(buf.read(READ_SIZE))
+    return time.time() - start
+
+
+def main():
+    total_mb = 256
+    if len(sys.argv) > 1:
+        total_mb = int(sys.argv[1])
+    total = total_mb * 1024 * 1024
+    results = {}
+    for buffer_class in (StringBuffer, ChunkBuffer):
+        elapsed = run(buffer_class, total)
+        results[buffer_class] = elapsed
+        print "%-12s %8.3fs %10.1f MB/s" % (
+            buffer_class.__name__, elapsed, total_mb / elapsed)
+    print "speedup: %.1fx" % (results[StringBuffer] / results[ChunkBuffer])
+
+
+if __name__ == '__main__':
+    main()
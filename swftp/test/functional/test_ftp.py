@@ -147,23 +147,37 @@ class RenameTests(FTPFuncTest):
     def test_rename_object(self):
         yield self.swift.put_container('ftp_tests')
         yield self.swift.put_object('ftp_tests', 'a')
+
+        self.ftp.rename('ftp_tests/a', 'ftp_tests/a1')
+
+        r, listing = yield self.swift.get_container('ftp_tests')
+
+        self.assertTrue(has_item('a1', listing))
+        self.assertFalse(has_item('a', listing))
+
+    @defer.inlineCallbacks
+    def test_rename_directory(self):
+        yield self.swift.put_container('ftp_tests')
         yield self.swift.put_object(
             'ftp_tests', 'b',
             headers={'Content-Type': 'application/directory'})
         yield self.swift.put_object('ftp_tests', 'b/nested')
         yield self.swift.put_object('ftp_tests', 'c/nested')
 
-        self.ftp.rename('ftp_tests/a', 'ftp_tests/a1')
+        self.ftp.rename('ftp_tests/b', 'ftp_tests/b1')
+        self.ftp.rename('ftp_tests/c', 'ftp_tests/c1')
 
         r, listing = yield self.swift.get_container('ftp_tests')
+        self.assertEqual(sorted(obj['name'] for obj in listing),
+                         ['b1', 'b1/nested', 'c1/nested'])
 
-        self.assertTrue(has_item('a1', listing))
-        self.assertFalse(has_item('a', listing))
+    @defer.inlineCallbacks
+    def test_rename_directory_into_itself(self):
+        yield self.swift.put_container('ftp_tests')
+        yield self.swift.put_object('ftp_tests', 'b/nested')
 
         self.assertRaises(ftplib.error_perm, self.ftp.rename, 'ftp_tests/b',
-                          'ftp_tests/b1')
-        self.assertRaises(ftplib.error_perm, self.ftp.rename, 'ftp_tests/c',
-                          'ftp_tests/c1')
+                          'ftp_tests/b/b1')
 
     def test_rename_object_not_found(self):
         self.assertRaises(ftplib.error_perm, self.ftp.rename, 'ftp_tests/a',
@@ -155,23 +155,37 @@ class RenameTests(SFTPFuncTest):
     def test_rename_object(self):
         yield self.swift.put_container('sftp_tests')
         yield self.swift.put_object('sftp_tests', 'a')
+
+        self.sftp.rename('sftp_tests/a', 'sftp_tests/a1')
+
+        r, listing = yield self.swift.get_container('sftp_tests')
+
+        self.assertTrue(has_item('a1', listing))
+        self.assertFalse(has_item('a', listing))
+
+    @defer.inlineCallbacks
+    def test_rename_directory(self):
+        yield self.swift.put_container('sftp_tests')
         yield self.swift.put_object(
             'sftp_tests', 'b',
             headers={'Content-Type': 'application/directory'})
         yield self.swift.put_object('sftp_tests', 'b/nested')
         yield self.swift.put_object('sftp_tests', 'c/nested')
 
-        self.sftp.rename('sftp_tests/a', 'sftp_tests/a1')
+        self.sftp.rename('sftp_tests/b', 'sftp_tests/b1')
+        self.sftp.rename('sftp_tests/c', 'sftp_tests/c1')
 
         r, listing = yield self.swift.get_container('sftp_tests')
+        self.assertEqual(sorted(obj['name'] for obj in listing),
+                         ['b1', 'b1/nested', 'c1/nested'])
 
-        self.assertTrue(has_item('a1', listing))
-        self.assertFalse(has_item('a', listing))
+    @defer.inlineCallbacks
+    def test_rename_directory_into_itself(self):
+        yield self.swift.put_container('sftp_tests')
+        yield self.swift.put_object('sftp_tests', 'b/nested')
 
         self.assertRaises(IOError, self.sftp.rename, 'sftp_tests/b',
-                          'sftp_tests/b1')
-        self.assertRaises(IOError, self.sftp.rename, 'sftp_tests/c',
-                          'sftp_tests/c1')
+                          'sftp_tests/b/b1')
 
     def test_rename_object_not_found(self):
         self.assertRaises(IOError, self.sftp.rename, 'sftp_tests/a',
@@ -3,7 +3,7 @@ See COPYING for license information.
 """
 from twisted.trial import unittest
 
-from mock import patch, MagicMock
+from mock import patch, MagicMock, Mock
 from twisted.cred.credentials import UsernamePassword
 from twisted.cred.error import UnauthorizedLogin
 from twisted.internet import defer
@@ -73,12 +73,82 @@ class AuthenticateTest(unittest.TestCase):
             self.assertEquals(conn.pool.maxPersistentPerHost, 2)
             self.assertEquals(conn.pool.persistent, False)
             self.assertEquals(conn.locks, [])
+            self.assertEquals(conn.scheduler, None)
 
         creds = UsernamePassword('username', 'password')
         d = auth_db.requestAvatarId(creds)
         d.addCallback(check_connection)
         return d
 
+    @patch('swftp.auth.ThrottledSwiftConnection.authenticate',
+           authenticate_good)
+    def test_shared_pool(self):
+        auth_db = SwiftBasedAuthDB(
+            'http://127.0.0.1:8080/v1/auth',
+            global_max_concurrency=20,
+            max_concurrency=5,
+        )
+        self.assertEquals(auth_db.pool.persistent, True)
+        self.assertEquals(auth_db.pool.maxPersistentPerHost, 20)
+
+        creds = UsernamePassword('username', 'password')
+        d = defer.gatherResults([
+            auth_db.requestAvatarId(creds),
+            auth_db.requestAvatarId(creds),
+        ])
+
+        def check_connections(conns):
+            conn1, conn2 = conns
+            self.assertIs(conn1.pool, auth_db.pool)
+            self.assertIs(conn2.pool, auth_db.pool)
+            # The session lock is per-connection, the scheduler is shared
+            self.assertIsNot(conn1.locks[0], conn2.locks[0])
+            self.assertIs(conn1.scheduler, auth_db.scheduler)
+            self.assertIs(conn2.scheduler, auth_db.scheduler)
+            self.assertEquals(auth_db.scheduler.max_concurrency, 20)
+            self.assertEquals(auth_db.scheduler.limiter, None)
+            self.assertEquals(conn1.retry_policy, None)
+            self.assertEquals(conn1.balancer, None)
+        d.addCallback(check_connections)
+        return d
+
+    def test_retry_policy(self):
+        auth_db = SwiftBasedAuthDB(
+            'http://127.0.0.1:8080/v1/auth',
+            max_retries=3,
+            retry_backoff=0.5,
+            retry_budget=0.2,
+        )
+        self.assertEquals(auth_db.retry_policy.max_retries, 3)
+        self.assertEquals(auth_db.retry_policy.backoff, 0.5)
+        self.assertEquals(auth_db.retry_policy.budget_ratio, 0.2)
+        conn = auth_db.token_connection(
+            'http://127.0.0.1:8080/v1/AUTH_user', 'token')
+        self.assertIs(conn.retry_policy, auth_db.retry_policy)
+
+    def test_storage_endpoints(self):
+        auth_db = SwiftBasedAuthDB(
+            'http://127.0.0.1:8080/v1/auth',
+            storage_endpoints=['http://proxy1:8080', 'http://proxy2:8080'],
+            endpoint_eject_time=60,
+        )
+        self.assertEquals(
+            [e.netloc for e in auth_db.balancer.endpoints],
+            ['proxy1:8080', 'proxy2:8080'])
+        self.assertEquals(auth_db.balancer.eject_time, 60)
+        conn = auth_db.token_connection(
+            'http://127.0.0.1:8080/v1/AUTH_user', 'token')
+        self.assertIs(conn.balancer, auth_db.balancer)
+
+    def test_adaptive_concurrency(self):
+        auth_db = SwiftBasedAuthDB(
+            'http://127.0.0.1:8080/v1/auth',
+            global_max_concurrency=20,
+            adaptive_max_concurrency=50,
+        )
+        self.assertEquals(auth_db.scheduler.limit, 20)
+        self.assertEquals(auth_db.scheduler.limiter.max_limit, 50)
+
     @patch('swftp.auth.ThrottledSwiftConnection.authenticate',
            authenticate_bad)
     def test_request_avatar_id_fail(self):
@@ -90,6 +160,88 @@ class AuthenticateTest(unittest.TestCase):
         return self.assertFailure(
             self.auth_db.requestAvatarId('nope'), UnauthorizedLogin)
 
+    def test_token_connection(self):
+        conn = self.auth_db.token_connection(
+            'http://127.0.0.1:8080/v1/AUTH_user', 'token')
+        self.assertEquals(conn.storage_url,
+                          'http://127.0.0.1:8080/v1/AUTH_user')
+        self.assertEquals(conn.auth_token, 'token')
+        self.assertEquals(conn.username, None)
+        self.assertIs(conn.pool, self.auth_db.pool)
+        self.assertEquals(conn.locks, [])
+        self.assertIs(conn.scheduler, self.auth_db.scheduler)
+
+
+class TokenCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.auth_db = SwiftBasedAuthDB(
+            'http://127.0.0.1:8080/v1/auth', token_cache_ttl=60)
+        self.auth_calls = []
+
+        def authenticate(conn):
+            self.auth_calls.append(conn)
+            conn.storage_url = 'http://storage/v1/AUTH_user'
+            conn.auth_token = 'TOKEN_%s' % len(self.auth_calls)
+            return defer.succeed(None)
+        patcher = patch('swftp.auth.ThrottledSwiftConnection.authenticate',
+                        authenticate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_disabled_by_default(self):
+        auth_db = SwiftBasedAuthDB('http://127.0.0.1:8080/v1/auth')
+        self.assertEquals(auth_db.token_cache, None)
+
+    @defer.inlineCallbacks
+    def test_cache_hit(self):
+        creds = UsernamePassword('username', 'password')
+        conn1 = yield self.auth_db.requestAvatarId(creds)
+        conn2 = yield self.auth_db.requestAvatarId(creds)
+        self.assertEquals(len(self.auth_calls), 1)
+        self.assertEquals(conn2.auth_token, 'TOKEN_1')
+        self.assertEquals(conn2.storage_url, conn1.storage_url)
+        self.assertIsNot(conn1, conn2)
+
+    @defer.inlineCallbacks
+    def test_cache_miss_other_password(self):
+        yield self.auth_db.requestAvatarId(
+            UsernamePassword('username', 'password'))
+        conn = yield self.auth_db.requestAvatarId(
+            UsernamePassword('username', 'wrong'))
+        self.assertEquals(len(self.auth_calls), 2)
+        self.assertEquals(conn.auth_token, 'TOKEN_2')
+
+    @defer.inlineCallbacks
+    def test_password_not_stored(self):
+        yield self.auth_db.requestAvatarId(
+            UsernamePassword('username', 'password'))
+        for key, value in self.auth_db.token_cache._entries.items():
+            self.assertNotIn('password', repr(key))
+            self.assertNotIn('password', repr(value))
+
+    @defer.inlineCallbacks
+    def test_reauth_refreshes_cache(self):
+        creds = UsernamePassword('username', 'password')
+        conn = yield self.auth_db.requestAvatarId(creds)
+        # Simulate make_request refreshing an expired token
+        conn.auth_token = 'NEW_TOKEN'
+        conn.reauth_callback(None)
+
+        conn2 = yield self.auth_db.requestAvatarId(creds)
+        self.assertEquals(conn2.auth_token, 'NEW_TOKEN')
+        self.assertEquals(len(self.auth_calls), 1)
+
+    @defer.inlineCallbacks
+    def test_metrics(self):
+        observer = Mock()
+        with patch('swftp.auth.log.msg', observer):
+            creds = UsernamePassword('username', 'password')
+            yield self.auth_db.requestAvatarId(creds)
+            yield self.auth_db.requestAvatarId(creds)
+        metrics = [c[1].get('metric') for c in observer.call_args_list]
+        self.assertEquals(metrics.count('auth.cache_miss'), 1)
+        self.assertEquals(metrics.count('auth.cache_hit'), 1)
+
 
 class StorageUrlRewriteTest(unittest.TestCase):
 
@@ -0,0 +1,124 @@
+"""
+See COPYING for license information.
+"""
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
+
+from swftp.balancer import EndpointBalancer, ProbeService, HEALTHCHECK_PATH
+
+
+class StubAgent(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, *args):
+        d = defer.Deferred()
+        self.requests.append((d, args))
+        return d
+
+
+class StubResponse(object):
+    def __init__(self, code=200):
+        self.code = code
+        self.protocol = None
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(self)
+
+    def finish(self):
+        self.protocol.connectionLost(Failure(ResponseDone()))
+
+    def stopProducing(self):
+        pass
+
+
+class EndpointBalancerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.balancer = EndpointBalancer(
+            ['http://proxy1:8080', 'https://proxy2'], eject_time=30,
+            clock=self.clock)
+        self.proxy1, self.proxy2 = self.balancer.endpoints
+
+    def request(self, endpoint):
+        d = defer.Deferred()
+        self.balancer.track(endpoint, d)
+        return d
+
+    def test_rewrite(self):
+        self.assertEqual(
+            self.balancer.rewrite(
+                'http://storage/v1/AUTH_user/container?format=json',
+                self.proxy2),
+            'https://proxy2/v1/AUTH_user/container?format=json')
+
+    def test_least_outstanding(self):
+        d = self.request(self.proxy1)
+        self.assertIs(self.balancer.pick(), self.proxy2)
+        self.request(self.proxy2)
+        self.request(self.balancer.pick())
+        self.assertEqual(
+            (self.proxy1.outstanding, self.proxy2.outstanding), (2, 1))
+
+        # Requests count until their body has been received
+        response = StubResponse()
+        d.callback(response)
+        self.assertEqual(self.proxy1.outstanding, 2)
+        response.deliverBody(Protocol())
+        response.finish()
+        self.assertEqual(self.proxy1.outstanding, 1)
+
+    def test_ties_take_turns(self):
+        picked = [self.balancer.pick() for _ in range(4)]
+        self.assertEqual(picked, [self.proxy2, self.proxy1] * 2)
+
+    def test_eject_on_connection_error(self):
+        d = self.request(self.proxy1)
+        d.errback(ConnectionRefusedError())
+        self.failureResultOf(d, ConnectionRefusedError)
+        self.assertEqual(self.proxy1.outstanding, 0)
+        self.assertEqual(self.balancer.healthy(), [self.proxy2])
+        self.request(self.proxy2)
+        self.assertIs(self.balancer.pick(), self.proxy2)
+        self.assertEqual(self.balancer.gauges()['endpoint.healthy'](), 1)
+
+        self.clock.advance(30)
+        self.assertEqual(self.balancer.healthy(), [self.proxy1, self.proxy2])
+
+    def test_all_ejected(self):
+        self.balancer.eject(self.proxy1)
+        self.balancer.eject(self.proxy2)
+        self.assertIn(self.balancer.pick(), [self.proxy1, self.proxy2])
+
+    def test_probes(self):
+        agent = StubAgent()
+        self.balancer.start_probes(10, agent=agent)
+        self.addCleanup(self.balancer.stop_probes)
+        self.balancer.eject(self.proxy1)
+        self.clock.advance(10)
+        self.assertEqual(
+            [args[:2] for _, args in agent.requests],
+            [('HEAD', 'http://proxy1:8080' + HEALTHCHECK_PATH),
+             ('HEAD', 'https://proxy2' + HEALTHCHECK_PATH)])
+        agent.requests[0][0].callback(StubResponse(200))
+        agent.requests[1][0].errback(ConnectionRefusedError())
+        self.assertEqual(self.balancer.healthy(), [self.proxy1])
+
+    def test_probe_service(self):
+        agent = StubAgent()
+        probes = ProbeService(self.balancer, 10, agent=agent)
+        self.clock.advance(10)
+        self.assertEqual(agent.requests, [])
+        probes.startService()
+        self.clock.advance(10)
+        self.assertEqual(len(agent.requests), 2)
+        probes.stopService()
+        self.clock.advance(10)
+        self.assertEqual(len(agent.requests), 2)
+        self.assertFalse(self.balancer.probes.running)
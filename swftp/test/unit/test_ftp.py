@@ -5,8 +5,15 @@ import os.path
 import socket
 
 from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.protocols.ftp import DTP, FileNotFoundError, TXFR_COMPLETE_OK
+from twisted.test.proto_helpers import StringTransport
 
 from swftp.ftp.service import makeService, Options
+from swftp.ftp import server
+from swftp.ftp.server import SwftpFTPProtocol, SwiftFTPShell, ListingProducer
+from swftp.test.unit.test_swiftfilesystem import (
+    FakeSwiftConnection, make_object)
 
 
 TEST_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -28,3 +35,107 @@ class FTPServiceTest(unittest.TestCase):
     def test_service_listen(self):
         sock = socket.socket()
         sock.connect(('127.0.0.1', 6021))
+
+
+class ListTest(unittest.TestCase):
+    def setUp(self):
+        self.names = ['obj%02d' % i for i in range(20)]
+        self.conn = FakeSwiftConnection({
+            'container': dict((name, make_object()) for name in self.names),
+        })
+        self.shell = SwiftFTPShell(self.conn)
+        self.proto = SwftpFTPProtocol()
+        self.proto.transport = StringTransport()
+        self.proto.shell = self.shell
+        self.proto.workingDirectory = []
+        self.proto.dtpInstance = DTP()
+        self.proto.dtpInstance.isConnected = True
+        self.proto.dtpInstance.transport = StringTransport()
+
+    def sent_lines(self):
+        return self.proto.dtpInstance.transport.value().splitlines()
+
+    def listing_requests(self):
+        return [r for r in self.conn.requests if r[0] == 'GET']
+
+    @defer.inlineCallbacks
+    def test_list(self):
+        result = yield self.proto.ftp_LIST('-la container')
+        self.assertEqual(result, (TXFR_COMPLETE_OK,))
+        lines = self.sent_lines()
+        self.assertEqual(len(lines), len(self.names))
+        self.assertTrue(lines[0].endswith(' obj00'))
+        self.assertTrue(lines[0].startswith('-rw-------'))
+        self.assertTrue(self.proto.dtpInstance.transport.disconnecting)
+
+    def test_list_older_twisted(self):
+        def formatOneListResponse(dtp, name, size, directory, permissions,
+                                  *args):
+            # Older releases formatted the plain mode
+            return ''.join(permissions & (256 >> n) and 'rwx'[n % 3] or '-'
+                           for n in range(9))
+        self.patch(DTP, '_formatOneListResponse', formatOneListResponse)
+        self.patch(server, 'LIST_PERMISSIONS', server._list_permissions())
+        self.assertIs(server.LIST_PERMISSIONS, int)
+        permissions = server.stat_format(
+            ['permissions'], make_object(size=10))[0]
+        self.assertEqual(
+            DTP()._formatOneListResponse('obj', 10, False, permissions),
+            'rw-------')
+
+    def test_list_not_found(self):
+        d = self.proto.ftp_LIST('missing')
+        return self.assertFailure(d, FileNotFoundError)
+
+    @defer.inlineCallbacks
+    def test_nlst(self):
+        result = yield self.proto.ftp_NLST('container')
+        self.assertEqual(result, (TXFR_COMPLETE_OK,))
+        self.assertEqual(self.sent_lines(), self.names)
+
+    @defer.inlineCallbacks
+    def test_nlst_glob(self):
+        yield self.proto.ftp_NLST('container/obj1*')
+        self.assertEqual(
+            self.sent_lines(), ['obj%02d' % i for i in range(10, 20)])
+
+    @defer.inlineCallbacks
+    def test_nlst_not_found(self):
+        result = yield self.proto.ftp_NLST('missing')
+        self.assertEqual(result, (TXFR_COMPLETE_OK,))
+        self.assertEqual(self.sent_lines(), [])
+
+    @defer.inlineCallbacks
+    def test_producer_pauses(self):
+        page, listing = yield self.shell.listPages(['container'])
+        consumer = StringTransport()
+        sent = []
+
+        def send_entry(name, props):
+            sent.append(name)
+            if len(sent) == 5:
+                producer.pauseProducing()
+
+        producer = ListingProducer(listing, send_entry, consumer)
+        d = producer.start(page)
+        self.assertIdentical(consumer.producer, producer)
+        requests = len(self.listing_requests())
+        self.assertEqual(len(sent), 5)
+        self.assertFalse(d.called)
+
+        producer.resumeProducing()
+        self.assertEqual(sent, self.names)
+        self.assertTrue(d.called)
+        self.assertIdentical(consumer.producer, None)
+        self.assertTrue(len(self.listing_requests()) > requests)
+
+    @defer.inlineCallbacks
+    def test_producer_stopped(self):
+        page, listing = yield self.shell.listPages(['container'])
+        producer = ListingProducer(listing, lambda *args: None,
+                                   StringTransport())
+        producer.pauseProducing()
+        d = producer.start(page)
+        producer.stopProducing()
+        self.assertTrue(listing.done)
+        yield self.assertFailure(d, Exception)
@@ -0,0 +1,228 @@
+"""
+See COPYING for license information.
+"""
+import os
+
+from twisted.trial import unittest
+from twisted.internet.error import ConnectionAborted
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+from swftp.objectcache import (
+    ObjectCache, CacheEntry, CachingReceiver, CachedFileReader)
+
+
+class StubResponse(object):
+    def __init__(self, code=200, headers=None, length=None):
+        self.code = code
+        self.headers = Headers(headers or {})
+        self.length = length
+
+
+class RecordingProtocol(object):
+    def __init__(self):
+        self.transport = None
+        self.data = []
+        self.reason = None
+
+    def makeConnection(self, transport):
+        self.transport = transport
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        self.reason = reason
+
+
+def add_object(cache, key, data, etag='etag'):
+    f, filename = cache.temp_file()
+    f.write(data)
+    f.close()
+    cache.add(key, filename, len(data), etag)
+
+
+class ObjectCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.cache = ObjectCache(self.path, 10)
+
+    def read(self, key):
+        with open(self.cache.get(key).filename) as f:
+            return f.read()
+
+    def test_add(self):
+        add_object(self.cache, 'a', 'abcd', etag='1')
+        entry = self.cache.get('a')
+        self.assertEqual((entry.size, entry.etag), (4, '1'))
+        self.assertEqual(self.read('a'), 'abcd')
+        self.assertEqual(self.cache.size, 4)
+
+    def test_replace(self):
+        add_object(self.cache, 'a', 'abcd')
+        add_object(self.cache, 'a', 'efg')
+        self.assertEqual(self.read('a'), 'efg')
+        self.assertEqual(self.cache.size, 3)
+        self.assertEqual(len(os.listdir(self.path)), 1)
+
+    def test_evict_least_recently_used(self):
+        add_object(self.cache, 'a', 'aaaa')
+        add_object(self.cache, 'b', 'bbbb')
+        self.cache.get('a')
+        add_object(self.cache, 'c', 'cccc')
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.read('a'), 'aaaa')
+        self.assertEqual(self.read('c'), 'cccc')
+        self.assertEqual(self.cache.size, 8)
+        self.assertEqual(len(os.listdir(self.path)), 2)
+
+    def test_too_big(self):
+        add_object(self.cache, 'a', 'x' * 11)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_remove(self):
+        add_object(self.cache, 'a', 'abcd')
+        self.cache.remove('a')
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.size, 0)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_old_files_removed(self):
+        add_object(self.cache, 'a', 'abcd')
+        self.cache.temp_file()[0].close()
+        open(os.path.join(self.path, 'other'), 'w').close()
+        ObjectCache(self.path, 10)
+        self.assertEqual(os.listdir(self.path), ['other'])
+
+    def test_conditional_headers(self):
+        entry = CacheEntry('a', 'filename', 4, '"etag"', 'yesterday')
+        self.assertEqual(entry.conditional_headers(), {
+            'If-None-Match': '"etag"', 'If-Modified-Since': 'yesterday'})
+
+
+class CachingReceiverTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ObjectCache(self.mktemp(), 10)
+        self.consumer = RecordingProtocol()
+        self.receiver = CachingReceiver(self.cache, 'a', self.consumer)
+
+    def receive(self, response, chunks, reason=ResponseDone):
+        self.receiver.cb_response(response)
+        self.receiver.makeConnection(object())
+        for chunk in chunks:
+            self.receiver.dataReceived(chunk)
+        self.receiver.connectionLost(Failure(reason()))
+
+    def test_cached(self):
+        self.receive(StubResponse(headers={'etag': ['1']}, length=6),
+                     ['abc', 'def'])
+        self.assertEqual(self.consumer.data, ['abc', 'def'])
+        self.assertTrue(self.consumer.reason.check(ResponseDone))
+        self.assertEqual(self.cache.get('a').etag, '1')
+        self.assertEqual(self.cache.size, 6)
+
+    def test_body_before_response(self):
+        self.receiver.makeConnection(object())
+        self.receiver.dataReceived('abc')
+        self.receiver.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(self.cache.get('a'), None)
+        self.receiver.cb_response(
+            StubResponse(headers={'etag': ['1']}, length=3))
+        self.assertEqual(self.cache.get('a').etag, '1')
+        self.assertEqual(os.listdir(self.cache.path),
+                         [os.path.basename(self.cache.get('a').filename)])
+
+    def test_short_body_not_cached(self):
+        self.receive(StubResponse(headers={'etag': ['1']}, length=6),
+                     ['abc'])
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+    def test_size_from_response(self):
+        self.receiver = CachingReceiver(self.cache, 'a', self.consumer, 3)
+        self.receive(StubResponse(206, headers={
+            'etag': ['1'], 'content-range': ['bytes 0-2/6']}, length=3),
+            ['abc', 'def'])
+        self.assertEqual(self.cache.get('a').size, 6)
+
+    def test_failed_body_not_cached(self):
+        self.receive(StubResponse(headers={'etag': ['1']}, length=3),
+                     ['abc'], reason=PotentialDataLoss)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+    def test_no_etag_not_cached(self):
+        self.receive(StubResponse(length=3), ['abc'])
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_too_big_not_cached(self):
+        self.receive(StubResponse(headers={'etag': ['1']}, length=11),
+                     ['x' * 11])
+        self.assertEqual(self.consumer.data, ['x' * 11])
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+
+class CachedFileReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.patch(CachedFileReader, 'chunk_size', 4)
+        self.patch(CachedFileReader, 'chunks_per_turn', 2)
+        self.cache = ObjectCache(self.mktemp(), 100)
+        add_object(self.cache, 'a', 'abcdefghijklmnopqrst')
+        self.clock = Clock()
+        self.consumer = RecordingProtocol()
+
+    def start(self, offset=0):
+        reader = CachedFileReader(self.cache.get('a'), self.consumer,
+                                  offset=offset, clock=self.clock)
+        self.successResultOf(reader.start())
+        return reader
+
+    def turn(self, count=1):
+        " Runs the calls scheduled for the next `count` reactor turns "
+        for _ in range(count):
+            call = self.clock.getDelayedCalls()[0]
+            self.clock.calls.remove(call)
+            call.func(*call.args, **call.kw)
+
+    def test_read(self):
+        self.start()
+        self.assertEqual(self.consumer.data, [])
+        self.turn()
+        self.assertEqual(self.consumer.data, ['abcd', 'efgh'])
+        self.turn(2)
+        self.assertEqual(''.join(self.consumer.data), 'abcdefghijklmnopqrst')
+        self.assertTrue(self.consumer.reason.check(ResponseDone))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_offset(self):
+        self.start(offset=14)
+        self.turn(2)
+        self.assertEqual(''.join(self.consumer.data), 'opqrst')
+        self.assertTrue(self.consumer.reason.check(ResponseDone))
+
+    def test_pause(self):
+        self.start()
+        self.consumer.transport.pauseProducing()
+        self.clock.advance(0)
+        self.assertEqual(self.consumer.data, [])
+        self.consumer.transport.resumeProducing()
+        self.turn()
+        self.assertEqual(self.consumer.data, ['abcd', 'efgh'])
+
+    def test_stop(self):
+        self.start()
+        self.consumer.transport.stopProducing()
+        self.assertTrue(self.consumer.reason.check(ConnectionAborted))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_empty_object(self):
+        add_object(self.cache, 'a', '')
+        self.start()
+        self.clock.advance(0)
+        self.assertEqual(self.consumer.data, [])
+        self.assertTrue(self.consumer.reason.check(ResponseDone))
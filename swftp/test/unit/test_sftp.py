@@ -8,6 +8,11 @@ from twisted.trial import unittest
 from twisted.internet import threads, defer
 
 from swftp.sftp.service import makeService, Options
+from swftp.sftp.server import (
+    SwiftSFTPUser, SwiftFileTransferServer, SwiftSessionChannel)
+from swftp.sftp.swiftdirectory import SwiftDirectory
+from swftp.test.unit.test_swiftfilesystem import (
+    FakeSwiftConnection, make_object)
 
 
 TEST_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -36,3 +41,50 @@ class SFTPServiceTest(unittest.TestCase):
 
     def test_service_listen(self):
         return threads.deferToThread(self._defer_test_service_listen)
+
+
+class SwiftDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.names = ['obj%02d' % i for i in range(20)]
+        self.conn = FakeSwiftConnection({
+            'container': dict((name, make_object()) for name in self.names),
+        })
+        user = SwiftSFTPUser(self.conn)
+        user.conn = None
+        self.server = SwiftFileTransferServer(avatar=user)
+
+    def listing_requests(self):
+        return [r for r in self.conn.requests if r[0] == 'GET']
+
+    @defer.inlineCallbacks
+    def test_open_fetches_first_pages(self):
+        yield self.server.client.openDirectory('/container')
+        self.assertEqual(
+            len(self.listing_requests()), 1 + SwiftDirectory.readahead)
+
+    @defer.inlineCallbacks
+    def test_scan_directory(self):
+        directory = yield self.server.client.openDirectory('/container')
+        entries = yield self.server._scanDirectory(iter(directory), [])
+        self.assertEqual(
+            [entry[0] for entry in entries], ['.', '..'] + self.names)
+        d = defer.maybeDeferred(self.server._scanDirectory, directory, [])
+        yield self.assertFailure(d, EOFError)
+
+    @defer.inlineCallbacks
+    def test_close_stops_fetching(self):
+        directory = yield self.server.client.openDirectory('/container')
+        directory.close()
+        requests = len(self.listing_requests())
+        self.assertRaises(StopIteration, directory.next)
+        self.assertEqual(len(self.listing_requests()), requests)
+
+
+class SwiftSessionChannelTest(unittest.TestCase):
+    def test_window_listeners(self):
+        channel = SwiftSessionChannel()
+        calls = []
+        channel.window_listeners.append(lambda: calls.append(
+            channel.remoteWindowLeft))
+        channel.addWindowBytes(100)
+        self.assertEqual(calls, [100])
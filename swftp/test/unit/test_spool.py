@@ -0,0 +1,261 @@
+"""
+See COPYING for license information.
+"""
+import json
+import os
+import stat
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.internet.task import Clock
+
+from swftp.spool import (
+    UploadSpool, SpooledUpload, SpoolFull, ACK_ON_SPOOL, META_SUFFIX)
+from swftp.swift import RequestError
+from swftp.swiftfilesystem import SwiftFileSystem, SwiftWriteFile
+
+
+class FakeConnection(object):
+    storage_url = 'http://127.0.0.1:8080/v1/AUTH_user'
+    auth_token = 'token'
+    username = 'username'
+
+    def put_object(self, container, path, headers=None, body=None,
+                   params=None):
+        return defer.Deferred()
+
+
+class RecordingConsumer(object):
+    def __init__(self):
+        self.started = defer.succeed(self)
+        self.producer = None
+        self.data = []
+        self.done = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.done = True
+
+    def write(self, data):
+        self.data.append(data)
+
+
+class FakeFileSystem(object):
+    " Holds uploads until the test finishes them "
+    def __init__(self, swiftconn=None):
+        self.swiftconn = swiftconn or FakeConnection()
+        self.uploads = []
+
+    def uploadObject(self, container, path, length=None):
+        d, consumer = defer.Deferred(), RecordingConsumer()
+        self.uploads.append((container, path, length, consumer, d))
+        return d, consumer
+
+
+class FakeProducer(object):
+    def __init__(self):
+        self.state = 'producing'
+
+    def pauseProducing(self):
+        self.state = 'paused'
+
+    def resumeProducing(self):
+        self.state = 'producing'
+
+    def stopProducing(self):
+        self.state = 'stopped'
+
+
+class SpoolTestCase(unittest.TestCase):
+    ack = 'commit'
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.clock = Clock()
+        self.patch(UploadSpool, 'cooperator', task.Cooperator(
+            scheduler=lambda f: self.clock.callLater(0, f)))
+        self.spool = UploadSpool(self.path, 10, ack=self.ack)
+        self.fs = FakeFileSystem()
+
+    def start(self, data='', path='obj'):
+        upload = SpooledUpload(self.spool, self.fs, 'container', path)
+        producer = FakeProducer()
+        upload.registerProducer(producer, True)
+        if data:
+            upload.write(data)
+        return upload, producer
+
+    def uploaded(self, index=0):
+        " Runs the PUT of a spooled file and returns what was sent "
+        self.clock.advance(0)
+        self.clock.advance(0)
+        consumer = self.fs.uploads[index][3]
+        self.assertTrue(consumer.done)
+        return ''.join(consumer.data)
+
+
+class UploadSpoolTest(SpoolTestCase):
+    def test_upload(self):
+        upload, producer = self.start('abc')
+        upload.write('def')
+        self.assertEqual(self.spool.used, 6)
+        self.assertEqual(self.fs.uploads, [])
+        upload.unregisterProducer()
+        self.assertEqual(self.fs.uploads[0][:3], ('container', 'obj', 6))
+        self.assertEqual(self.uploaded(), 'abcdef')
+        self.assertEqual(self.spool.uploading, 1)
+        self.assertNoResult(upload.finished)
+        self.fs.uploads[0][-1].callback(None)
+        self.successResultOf(upload.finished)
+        self.assertEqual(self.spool.used, 0)
+        self.assertEqual(self.spool.uploading, 0)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_upload_failed(self):
+        upload, producer = self.start('abc')
+        upload.unregisterProducer()
+        self.uploaded()
+        self.fs.uploads[0][-1].errback(RequestError(500, 'Error'))
+        self.failureResultOf(upload.finished, RequestError)
+        self.assertEqual(self.spool.used, 0)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_abort(self):
+        upload, producer = self.start('abc')
+        upload.abort(RequestError(500, 'Error'))
+        self.failureResultOf(upload.finished, RequestError)
+        self.assertEqual(self.fs.uploads, [])
+        self.assertEqual(self.spool.used, 0)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_full_waits_for_uploads(self):
+        first, _ = self.start('a' * 6)
+        first.unregisterProducer()
+        upload, producer = self.start('b' * 4)
+        self.assertEqual(producer.state, 'paused')
+        self.uploaded()
+        self.fs.uploads[0][-1].callback(None)
+        self.assertEqual(producer.state, 'producing')
+        self.assertEqual(self.spool.used, 4)
+
+    def test_writes_while_paused_wait_once(self):
+        first, _ = self.start('a' * 6)
+        first.unregisterProducer()
+        upload, producer = self.start('b' * 4)
+        upload.write('b')
+        upload.write('b')
+        self.assertEqual(self.spool.waiting, [upload])
+        self.uploaded()
+        self.fs.uploads[0][-1].callback(None)
+        self.assertEqual(self.spool.waiting, [])
+        self.assertEqual(producer.state, 'producing')
+
+    def test_full_without_uploads(self):
+        upload, producer = self.start('a' * 10)
+        self.failureResultOf(upload.finished, SpoolFull)
+        self.assertEqual(producer.state, 'stopped')
+        self.assertEqual(self.spool.used, 0)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_waiting_fails_when_uploads_end(self):
+        first, _ = self.start('a' * 6)
+        first.unregisterProducer()
+        upload, producer = self.start('b' * 2)
+        upload.write('b' * 4)
+        self.assertEqual(producer.state, 'paused')
+        self.uploaded()
+        self.fs.uploads[0][-1].callback(None)
+        self.assertEqual(self.spool.used, 6)
+        self.assertNoResult(upload.finished)
+        upload.write('b' * 4)
+        self.failureResultOf(upload.finished, SpoolFull)
+
+    def test_leftover_files_removed(self):
+        upload, producer = self.start('abc')
+        open(os.path.join(self.path, 'other'), 'w').close()
+        spool = UploadSpool(self.path, 10)
+        self.assertEqual(os.listdir(self.path), ['other'])
+        self.assertEqual((spool.used, spool.recovered), (0, []))
+
+
+class AckOnSpoolTest(SpoolTestCase):
+    ack = ACK_ON_SPOOL
+
+    def test_acknowledged(self):
+        upload, producer = self.start('abc')
+        upload.unregisterProducer()
+        self.successResultOf(upload.finished)
+        meta_filename = upload.filename + META_SUFFIX
+        self.assertEqual(stat.S_IMODE(os.stat(meta_filename).st_mode), 0600)
+        with open(meta_filename) as f:
+            self.assertEqual(json.load(f), {
+                'storage_url': FakeConnection.storage_url,
+                'auth_token': 'token',
+                'container': 'container',
+                'path': 'obj',
+                'size': 3,
+            })
+        self.assertEqual(self.uploaded(), 'abc')
+        self.fs.uploads[0][-1].callback(None)
+        self.assertEqual(self.spool.used, 0)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_failed_upload_kept(self):
+        upload, producer = self.start('abc')
+        upload.unregisterProducer()
+        self.uploaded()
+        self.fs.uploads[0][-1].errback(RequestError(500, 'Error'))
+        self.assertEqual(len(self.flushLoggedErrors(RequestError)), 1)
+        self.assertEqual(self.spool.used, 3)
+        self.assertEqual(len(os.listdir(self.path)), 2)
+
+    def test_recover(self):
+        for path in ('obj1', 'obj2'):
+            upload, producer = self.start('abc', path=path)
+            upload.unregisterProducer()
+        self.start('unacknowledged')
+
+        spool = UploadSpool(self.path, 10, ack=ACK_ON_SPOOL)
+        self.assertEqual(spool.used, 6)
+        self.assertEqual(len(os.listdir(self.path)), 4)
+        filesystems = []
+
+        def filesystem_factory(storage_url, auth_token):
+            conn = FakeConnection()
+            conn.storage_url, conn.auth_token = storage_url, auth_token
+            filesystems.append(FakeFileSystem(conn))
+            return filesystems[-1]
+
+        spool.recover(filesystem_factory)
+        self.assertEqual(
+            sorted(fs.uploads[0][:3] for fs in filesystems),
+            [('container', 'obj1', 3), ('container', 'obj2', 3)])
+        self.assertEqual(filesystems[0].swiftconn.auth_token, 'token')
+        self.clock.pump([0] * 3)
+        for fs in filesystems:
+            self.assertEqual(''.join(fs.uploads[0][3].data), 'abc')
+            fs.uploads[0][-1].callback(None)
+        self.assertEqual(spool.used, 0)
+        self.assertEqual(os.listdir(self.path), [])
+
+
+class SpoolFileSystemTest(unittest.TestCase):
+    def setUp(self):
+        self.spool = UploadSpool(self.mktemp(), 10)
+        self.patch(SwiftFileSystem, 'upload_spool', self.spool)
+        self.fs = SwiftFileSystem(FakeConnection())
+
+    def test_spooled(self):
+        d, consumer = self.fs.startFileUpload('/container/obj')
+        self.assertIsInstance(consumer, SpooledUpload)
+        self.assertEqual((consumer.container, consumer.path),
+                         ('container', 'obj'))
+        consumer.abort(RequestError(500, 'Error'))
+        self.failureResultOf(d, RequestError)
+
+    def test_full(self):
+        self.spool.add(10)
+        d, consumer = self.fs.startFileUpload('/container/obj')
+        self.assertIsInstance(consumer, SwiftWriteFile)
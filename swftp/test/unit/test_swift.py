@@ -1,19 +1,27 @@
 """
 See COPYING for license information.
 """
+import json
+
 from mock import MagicMock
 
 from twisted.python.failure import Failure
 from twisted.trial import unittest
 from twisted.internet import defer, protocol
+from twisted.internet.error import ConnectionLost, TimeoutError
+from twisted.internet.task import Clock
 from twisted.web.http_headers import Headers
 from twisted.web._newclient import ResponseDone
+from twisted.web.client import ResponseFailed, ResponseNeverReceived
 from twisted.web import error
 
 from swftp.swift import (
     SwiftConnection, ThrottledSwiftConnection, ResponseReceiver,
-    ResponseIgnorer, cb_recv_resp, cb_process_resp, NotFound, UnAuthenticated,
-    UnAuthorized, Conflict, RequestError)
+    ResponseIgnorer, JSONListingReceiver, cb_recv_resp, cb_process_resp,
+    NotFound, UnAuthenticated, UnAuthorized, Conflict, RequestError,
+    is_overloaded, parse_content_range)
+from swftp.balancer import EndpointBalancer
+from swftp.utils import FairScheduler, AIMDLimiter, RetryPolicy
 
 
 class StubWebAgent(protocol.Protocol):
@@ -112,6 +120,9 @@ class SwiftConnectionTest(unittest.TestCase):
         return make_request
 
     def test_make_request_failed_auth(self):
+        reauth_results = []
+        self.conn.reauth_callback = \
+            lambda result: reauth_results.append(result) or result
         # Make initial request
         make_request = self.conn.make_request('method', 'path/to/resource',
                                               params={'param': 'value'},
@@ -156,6 +167,7 @@ class SwiftConnectionTest(unittest.TestCase):
         # Make sure authentication has been performed successfully
         self.assertEqual(self.conn.storage_url, 'AUTHED_STORAGE_URL')
         self.assertEqual(self.conn.auth_token, 'AUTHED_TOKEN')
+        self.assertEqual(len(reauth_results), 1)
 
         # Check to make sure there's a second attempt at the original request
         self.assertEqual(len(self.agent.requests), 3)
@@ -392,6 +404,52 @@ class SwiftConnectionTest(unittest.TestCase):
         make_request.addCallback(cbCheckResponse)
         return make_request
 
+    def test_get_container_streaming(self):
+        entries = []
+        make_request = self.conn.get_container(
+            'container', entry_callback=entries.append)
+        d, args, kwargs = self.agent.requests[0]
+        response = StubResponse(200, body='''[
+   {"name":"test_obj_1", "bytes":14},
+   {"subdir":"test_dir/"}
+]''')
+        d.callback(response)
+
+        def cbCheckResponse(resp):
+            self.assertEqual(resp, (response, None))
+            self.assertEqual(entries, [
+                {u'bytes': 14, u'name': u'test_obj_1'},
+                {u'subdir': u'test_dir/'},
+            ])
+        make_request.addCallback(cbCheckResponse)
+        return make_request
+
+    def test_get_container_streaming_not_found(self):
+        entries = []
+        make_request = self.conn.get_container(
+            'container', entry_callback=entries.append)
+        d, args, kwargs = self.agent.requests[0]
+        d.callback(StubResponse(404, body='Not Found'))
+        self.assertEqual(entries, [])
+        return self.assertFailure(make_request, NotFound)
+
+    def test_get_account_streaming(self):
+        entries = []
+        make_request = self.conn.get_account(
+            marker='test_container_0', entry_callback=entries.append)
+        d, args, kwargs = self.agent.requests[0]
+        # end_marker is only sent when it is given
+        self.assertEqual(
+            args[1],
+            'http://127.0.0.1:8080/v1/AUTH_user/?marker=test_container_0'
+            '&format=json')
+        d.callback(StubResponse(204))
+
+        def cbCheckResponse(resp):
+            self.assertEqual(entries, [])
+        make_request.addCallback(cbCheckResponse)
+        return make_request
+
     def test_put_container(self):
         make_request = self.conn.put_container('container')
         self.assertEqual(len(self.agent.requests), 1)
@@ -513,6 +571,31 @@ class SwiftConnectionTest(unittest.TestCase):
         received.addCallback(cbCheckResponseBody)
         return defer.gatherResults([make_request, received])
 
+    def test_get_slo_manifest(self):
+        make_request = self.conn.get_slo_manifest('container', 'object')
+        d, args, kwargs = self.agent.requests[0]
+        self.assertEqual(args[:2], (
+            'GET', 'http://127.0.0.1:8080/v1/AUTH_user/container/object'
+                   '?multipart-manifest=get'))
+        d.callback(StubResponse(200, body=json.dumps([
+            {'name': '/container_segments/object/1', 'bytes': 10}])))
+
+        def cbCheckResponse(resp):
+            self.assertEqual(
+                resp[1][0]['name'], '/container_segments/object/1')
+        make_request.addCallback(cbCheckResponse)
+        return make_request
+
+    def test_get_object_error_not_received(self):
+        received = defer.Deferred()
+        receiver = ResponseReceiver(received)
+        make_request = self.conn.get_object('container', 'object',
+                                            receiver=receiver)
+        d, args, kwargs = self.agent.requests[0]
+        d.callback(StubResponse(404, body='Not Found'))
+        self.assertNoResult(received)
+        return self.assertFailure(make_request, NotFound)
+
     def test_put_object(self):
         make_request = self.conn.put_object('container', 'object')
         self.assertEqual(len(self.agent.requests), 1)
@@ -536,6 +619,14 @@ class SwiftConnectionTest(unittest.TestCase):
         make_request.addCallback(cbCheckResponse)
         return make_request
 
+    def test_put_object_params(self):
+        self.conn.put_object('container', 'object',
+                             params={'multipart-manifest': 'put'})
+        d, args, kwargs = self.agent.requests[0]
+        self.assertEqual(
+            args[1], 'http://127.0.0.1:8080/v1/AUTH_user/container/object'
+            '?multipart-manifest=put')
+
     def test_delete_object(self):
         make_request = self.conn.delete_object('container', 'object')
         self.assertEqual(len(self.agent.requests), 1)
@@ -559,6 +650,70 @@ class SwiftConnectionTest(unittest.TestCase):
         return make_request
 
 
+    def test_bulk_delete(self):
+        make_request = self.conn.bulk_delete(
+            ['/container/object 1', '/container/object2'])
+        d, args, kwargs = self.agent.requests[0]
+        self.assertEqual(args[:3], (
+            'POST',
+            'http://127.0.0.1:8080/v1/AUTH_user/?bulk-delete=true',
+            Headers({
+                'user-agent': ['Twisted Swift'],
+                'x-auth-token': ['TOKEN_123'],
+                'content-type': ['text/plain'],
+                'accept': ['application/json'],
+                'extra': ['header']})))
+        self.assertEqual(args[3]._inputFile.getvalue(),
+                         '/container/object%201\n/container/object2')
+
+        d.callback(StubResponse(200, body=json.dumps({
+            'Response Status': '200 OK', 'Number Deleted': 1,
+            'Number Not Found': 1, 'Errors': []})))
+
+        def cbCheckResponse(resp):
+            self.assertEqual(resp[1]['Number Deleted'], 1)
+        make_request.addCallback(cbCheckResponse)
+        return make_request
+
+    def test_bulk_delete_errors(self):
+        make_request = self.conn.bulk_delete(['/container'])
+        d, args, kwargs = self.agent.requests[0]
+        d.callback(StubResponse(200, body=json.dumps({
+            'Response Status': '400 Bad Request', 'Number Deleted': 0,
+            'Errors': [['/container', '409 Conflict']]})))
+        return self.assertFailure(make_request, RequestError)
+
+    def test_get_info(self):
+        make_request = self.conn.get_info()
+        d, args, kwargs = self.agent.requests[0]
+        self.assertEqual(args, (
+            'GET',
+            'http://127.0.0.1:8080/info',
+            Headers({
+                'user-agent': ['Twisted Swift'],
+                'extra': ['header']}),
+            None))
+        d.callback(StubResponse(200, body=json.dumps({
+            'bulk_delete': {'max_deletes_per_request': 10000}})))
+
+        def cbCheckResponse(resp):
+            self.assertEqual(
+                resp[1]['bulk_delete']['max_deletes_per_request'], 10000)
+        make_request.addCallback(cbCheckResponse)
+        return make_request
+
+    def test_balancer(self):
+        self.conn.balancer = EndpointBalancer(['https://proxy:443'])
+        make_request = self.conn.head_object('container', 'object')
+        d, args, kwargs = self.agent.requests[0]
+        self.assertEqual(
+            args[1], 'https://proxy:443/v1/AUTH_user/container/object')
+        self.assertEqual(self.conn.balancer.endpoints[0].outstanding, 1)
+        d.callback(StubResponse(200))
+        self.assertEqual(self.conn.balancer.endpoints[0].outstanding, 0)
+        return make_request
+
+
 class ThrottledSwiftConnectionTest(unittest.TestCase):
     def setUp(self):
         self.agent = StubWebAgent()
@@ -615,8 +770,217 @@ class ThrottledSwiftConnectionTest(unittest.TestCase):
         self.assertEqual(lock.locked, 0)
         self.assertEqual(sem.tokens, 2)
 
+    def test_each_lock_acquired(self):
+        sem = defer.DeferredSemaphore(2)
+        lock = defer.DeferredLock()
+        conn = ThrottledSwiftConnection(
+            [sem, lock],
+            'http://127.0.0.1:8080/auth/v1.0', 'username', 'api_key')
+        conn.agent = self.agent
+        conn.storage_url = 'http://127.0.0.1:8080/v1/AUTH_user'
+        conn.auth_token = 'TOKEN_123'
+
+        conn.make_request('method', 'path')
+        self.assertEqual(sem.tokens, 1)
+        self.assertEqual(lock.locked, 1)
+        d, args, kwargs = self.agent.requests[0]
+        d.callback(StubResponse(200))
+        self.assertEqual(sem.tokens, 2)
+        self.assertEqual(lock.locked, 0)
+
+    def test_scheduler(self):
+        scheduler = FairScheduler(1)
+        conn = ThrottledSwiftConnection(
+            [], 'http://127.0.0.1:8080/auth/v1.0', 'username', 'api_key')
+        conn.agent = self.agent
+        conn.storage_url = 'http://127.0.0.1:8080/v1/AUTH_user'
+        conn.auth_token = 'TOKEN_123'
+        conn.scheduler = scheduler
+
+        conn.make_request('GET', 'container/object')
+        conn.make_request('PUT', 'container/object')
+        conn.make_request('GET', 'container')
+        self.assertEqual(len(self.agent.requests), 1)
+        self.assertEqual(scheduler.queued, 2)
+
+        # The listing goes before the upload that was queued first
+        self.agent.requests[0][0].callback(StubResponse(200))
+        self.assertEqual(self.agent.requests[1][1][:2], (
+            'GET', 'http://127.0.0.1:8080/v1/AUTH_user/container'))
+        self.agent.requests[1][0].callback(StubResponse(200))
+        self.assertEqual(self.agent.requests[2][1][0], 'PUT')
+        self.agent.requests[2][0].callback(StubResponse(200))
+        self.assertEqual((scheduler.active, scheduler.queued), (0, 0))
+
+    def test_scheduler_limiter(self):
+        clock = Clock()
+        limiter = AIMDLimiter(2, clock=clock)
+        conn = ThrottledSwiftConnection(
+            [], 'http://127.0.0.1:8080/auth/v1.0', 'username', 'api_key')
+        conn.agent = self.agent
+        conn.storage_url = 'http://127.0.0.1:8080/v1/AUTH_user'
+        conn.auth_token = 'TOKEN_123'
+        conn.scheduler = FairScheduler(2, clock=clock, limiter=limiter)
+
+        conn.make_request('GET', 'container/object')
+        clock.advance(0.5)
+        self.agent.requests[0][0].callback(StubResponse(200))
+        self.assertEqual(limiter.latency, 0.5)
+
+        conn.make_request('GET', 'container/object')
+        self.agent.requests[1][0].callback(StubResponse(503))
+        self.assertEqual(limiter.limit, 1)
+        self.assertEqual(limiter.latency, 0.5)
+
+        # Uploads take as long as the client takes to send the body
+        conn.make_request('PUT', 'container/object', body=object())
+        clock.advance(10)
+        self.agent.requests[2][0].callback(StubResponse(201))
+        self.assertEqual(limiter.latency, 0.5)
+        self.assertEqual(conn.scheduler.active, 0)
+
+
+class CutOffResponse(StubResponse):
+    " Delivers its body and then loses the connection "
+    def deliverBody(self, receiver):
+        receiver.makeConnection(self)
+        receiver.dataReceived(self.body)
+        receiver.connectionLost(Failure(ResponseFailed(
+            [Failure(ConnectionLost())])))
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.conn = SwiftConnection(
+            'http://127.0.0.1:8080/auth/v1.0', 'username', 'api_key')
+        self.agent = StubWebAgent()
+        self.conn.agent = self.agent
+        self.conn.storage_url = 'http://127.0.0.1:8080/v1/AUTH_user'
+        self.conn.auth_token = 'TOKEN_123'
+        self.conn.retry_policy = RetryPolicy(
+            max_retries=2, backoff=1, clock=self.clock, rand=lambda: 1.0)
+
+    def respond(self, index, result):
+        d = self.agent.requests[index][0]
+        if isinstance(result, Exception):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def test_retry(self):
+        d = self.conn.head_object('container', 'object')
+        self.respond(0, StubResponse(503))
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.agent.requests), 1)
+        self.clock.advance(0.5)
+        self.respond(1, ResponseNeverReceived([]))
+        self.clock.advance(2)
+        self.respond(2, StubResponse(200))
+        self.successResultOf(d)
+
+    def test_max_retries(self):
+        d = self.conn.delete_object('container', 'object')
+        for i, delay in enumerate([1, 2]):
+            self.respond(i, StubResponse(500))
+            self.clock.advance(delay)
+        self.respond(2, StubResponse(500))
+        self.assertEqual(len(self.agent.requests), 3)
+        self.failureResultOf(d, RequestError)
+
+    def test_retried_delete_not_found(self):
+        d = self.conn.delete_object('container', 'object')
+        self.respond(0, StubResponse(503))
+        self.clock.advance(1)
+        self.respond(1, StubResponse(404))
+        self.successResultOf(d)
+
+        d = self.conn.delete_object('container', 'object')
+        self.respond(2, StubResponse(404))
+        self.failureResultOf(d, NotFound)
+
+    def test_not_retried(self):
+        d = self.conn.put_object('container', 'object')
+        self.respond(0, StubResponse(503))
+        self.failureResultOf(d, RequestError)
+
+        d = self.conn.head_object('container', 'object')
+        self.respond(1, StubResponse(404))
+        self.failureResultOf(d, NotFound)
+        self.assertEqual(len(self.agent.requests), 2)
+
+    def test_budget(self):
+        self.conn.retry_policy.tokens = 0
+        d = self.conn.head_object('container', 'object')
+        self.respond(0, StubResponse(503))
+        self.failureResultOf(d, RequestError)
+
+    def test_resume_download(self):
+        received = defer.Deferred()
+        d = self.conn.get_object('container', 'object',
+                                 receiver=ResponseReceiver(received))
+        response = CutOffResponse(200, headers=Headers({
+            'ETag': ['etag']}), body='abc')
+        response.length = 6
+        self.respond(0, response)
+        self.successResultOf(d)
+        self.clock.advance(1)
+        self.assertEqual(
+            self.agent.requests[1][1][2].getRawHeaders('range'),
+            ['bytes=3-5'])
+        self.respond(1, StubResponse(206, headers=Headers({
+            'ETag': ['etag'], 'Content-Range': ['bytes 3-5/6']}),
+            body='def'))
+        self.assertEqual(self.successResultOf(received), 'abcdef')
+
+    def test_resume_ranged_download(self):
+        received = defer.Deferred()
+        self.conn.get_object('container', 'object',
+                             headers={'Range': 'bytes=2-7',
+                                      'If-None-Match': 'etag'},
+                             receiver=ResponseReceiver(received))
+        self.respond(0, CutOffResponse(206, headers=Headers({
+            'ETag': ['etag'], 'Content-Range': ['bytes 2-7/10']}),
+            body='cd'))
+        self.clock.advance(1)
+        headers = self.agent.requests[1][1][2]
+        self.assertEqual(headers.getRawHeaders('range'), ['bytes=4-7'])
+        self.assertFalse(headers.hasHeader('if-none-match'))
+        self.respond(1, StubResponse(206, headers=Headers({
+            'ETag': ['etag'], 'Content-Range': ['bytes 4-7/10']}),
+            body='efgh'))
+        self.assertEqual(self.successResultOf(received), 'cdefgh')
+
+    def test_resume_object_changed(self):
+        received = defer.Deferred()
+        self.conn.get_object('container', 'object',
+                             receiver=ResponseReceiver(received))
+        response = CutOffResponse(200, headers=Headers({
+            'ETag': ['etag']}), body='abc')
+        response.length = 6
+        self.respond(0, response)
+        self.clock.advance(1)
+        self.respond(1, StubResponse(206, headers=Headers({
+            'ETag': ['other'], 'Content-Range': ['bytes 3-5/6']}),
+            body='def'))
+        self.failureResultOf(received, ResponseFailed)
+
 
 class HelpersTest(unittest.TestCase):
+    def test_is_overloaded(self):
+        self.assertTrue(is_overloaded(StubResponse(503)))
+        self.assertTrue(is_overloaded(StubResponse(429)))
+        self.assertFalse(is_overloaded(StubResponse(500)))
+        self.assertFalse(is_overloaded(StubResponse(200)))
+        self.assertTrue(is_overloaded(Failure(TimeoutError())))
+        self.assertFalse(is_overloaded(Failure(NotFound(404, 'Not Found'))))
+
+    def test_parse_content_range(self):
+        self.assertEqual(parse_content_range('bytes 0-99/300'), (0, 99, 300))
+        self.assertEqual(parse_content_range('bytes 5-9/*'), (5, 9, None))
+        self.assertEqual(parse_content_range('bytes */300'), None)
+        self.assertEqual(parse_content_range(None), None)
+
 
     def test_cb_process_resp(self):
         resp = StubResponse(200)
@@ -674,3 +1038,62 @@ class HelpersTest(unittest.TestCase):
             self.assertRaises(error.Error, result.raiseException)
         finished.addBoth(checkError)
         return finished
+
+
+class JSONListingReceiverTest(unittest.TestCase):
+    body = (
+        '[{"name": "obj1", "bytes": 1},\n'
+        ' {"name": "obj2, \\"quoted\\" ]", "bytes": 2},\n'
+        ' {"name": "\xe2\x98\x83", "bytes": 3}]')
+
+    def setUp(self):
+        self.entries = []
+        self.finished = defer.Deferred()
+        self.recv = JSONListingReceiver(self.finished, self.entries.append)
+        self.recv.makeConnection(MagicMock())
+
+    def check_entries(self, result):
+        self.assertEqual(self.entries, [
+            {u'name': u'obj1', u'bytes': 1},
+            {u'name': u'obj2, "quoted" ]', u'bytes': 2},
+            {u'name': u'\u2603', u'bytes': 3},
+        ])
+
+    def test_single_chunk(self):
+        self.recv.dataReceived(self.body)
+        self.recv.connectionLost(Failure(ResponseDone()))
+        self.finished.addCallback(self.check_entries)
+        return self.finished
+
+    def test_byte_chunks(self):
+        for i, char in enumerate(self.body):
+            self.recv.dataReceived(char)
+            # Entries are delivered as soon as they are complete
+            if i == self.body.index('}'):
+                self.assertEqual(len(self.entries), 1)
+        self.recv.connectionLost(Failure(ResponseDone()))
+        self.finished.addCallback(self.check_entries)
+        return self.finished
+
+    def test_empty_list(self):
+        self.recv.dataReceived('[ ]')
+        self.recv.connectionLost(Failure(ResponseDone()))
+        return self.finished
+
+    def test_truncated(self):
+        self.recv.dataReceived(self.body[:40])
+        self.recv.connectionLost(Failure(ResponseDone()))
+        return self.assertFailure(self.finished, ValueError)
+
+    def test_invalid(self):
+        self.recv.dataReceived('not json')
+        self.recv.transport.stopProducing.assert_called_with()
+        self.recv.dataReceived('[]')
+        self.recv.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(self.entries, [])
+        return self.assertFailure(self.finished, ValueError)
+
+    def test_connection_error(self):
+        self.recv.dataReceived(self.body[:40])
+        self.recv.connectionLost(Failure(error.Error('Something Happened')))
+        return self.assertFailure(self.finished, error.Error)
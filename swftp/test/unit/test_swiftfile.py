@@ -0,0 +1,321 @@
+"""
+See COPYING for license information.
+"""
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.conch.ssh.filetransfer import (
+    SFTPError, FX_NO_SUCH_FILE, FX_FAILURE)
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.web._newclient import ResponseDone
+
+from swftp.swift import NotFound, RequestError
+from swftp.utils import TransferBudget
+from swftp.sftp.swiftfile import (
+    SwiftFileReceiver, SwiftFileSender, RecentRanges)
+
+
+class FakeConnection(object):
+    " Stands in for session.conn, the SSH connection "
+    def __init__(self):
+        self.transport = StringTransport()
+        self.transport.transport = StringTransport()
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.buf = ''
+        self.window_listeners = []
+        self.conn = FakeConnection()
+
+    def addWindowBytes(self, buf):
+        self.buf = buf
+        for listener in list(self.window_listeners):
+            listener()
+
+
+class FakeWriter(object):
+    " Upload consumer that keeps what is written to it "
+    def __init__(self):
+        self.started = defer.Deferred()
+        self.finished = defer.Deferred()
+        self.data = []
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.finished.callback(''.join(self.data))
+
+    def write(self, data):
+        self.data.append(data)
+
+    def abort(self, reason):
+        self.finished.errback(reason)
+
+
+class FakeFileSystem(object):
+    " Records downloads and uploads instead of making them "
+    def __init__(self):
+        self.downloads = []
+        self.writer = FakeWriter()
+        self.transfer_budget = TransferBudget()
+
+    def startFileUpload(self, fullpath):
+        return self.writer.finished, self.writer
+
+    def startFileDownload(self, fullpath, consumer, offset=0, size=None):
+        d = defer.Deferred()
+        self.downloads.append((consumer, offset, d))
+        return d
+
+
+class SwiftFileReceiverTest(unittest.TestCase):
+    def setUp(self):
+        self.data = ''.join(chr(ord('a') + i % 26) for i in range(100))
+        self.fs = FakeFileSystem()
+        self.receiver = SwiftFileReceiver(
+            len(self.data), FakeSession(), self.fs, '/container/object')
+
+    def start_download(self, index=-1):
+        " Connects the download and returns (stream, transport) "
+        stream, offset, _ = self.fs.downloads[index]
+        transport = StringTransport()
+        stream.makeConnection(transport)
+        return stream, transport
+
+    def test_read_in_order(self):
+        d1 = self.receiver.read(0, 4)
+        d2 = self.receiver.read(4, 4)
+        stream, _ = self.start_download()
+        stream.dataReceived(self.data[:6])
+        self.assertEqual(self.successResultOf(d1), 'abcd')
+        self.assertNoResult(d2)
+        stream.dataReceived(self.data[6:10])
+        self.assertEqual(self.successResultOf(d2), 'efgh')
+        self.assertEqual(len(self.fs.downloads), 1)
+
+    def test_read_out_of_order(self):
+        d1 = self.receiver.read(0, 4)
+        d3 = self.receiver.read(8, 4)
+        stream, _ = self.start_download()
+        stream.dataReceived(self.data[:12])
+        self.assertEqual(self.successResultOf(d1), 'abcd')
+        self.assertEqual(self.successResultOf(d3), 'ijkl')
+        d2 = self.receiver.read(4, 4)
+        self.assertEqual(self.successResultOf(d2), 'efgh')
+        self.assertEqual(len(self.fs.downloads), 1)
+
+    def test_seek_backward(self):
+        self.patch(SwiftFileReceiver, 'read_cache_size', 0)
+        self.receiver = SwiftFileReceiver(
+            len(self.data), FakeSession(), self.fs, '/container/object')
+        self.receiver.read(40, 4)
+        stream, transport = self.start_download()
+        stream.dataReceived(self.data[40:50])
+        d = self.receiver.read(10, 4)
+        self.assertEqual(transport.producerState, 'stopped')
+        self.assertEqual(len(self.fs.downloads), 2)
+        self.assertEqual(self.fs.downloads[-1][1], 10)
+        stream, _ = self.start_download()
+        stream.dataReceived(self.data[10:20])
+        self.assertEqual(self.successResultOf(d), self.data[10:14])
+
+    def test_seek_forward(self):
+        self.patch(SwiftFileReceiver, 'seek_limit', 10)
+        self.receiver.read(0, 4)
+        stream, _ = self.start_download()
+        stream.dataReceived(self.data[:10])
+        d = self.receiver.read(50, 4)
+        self.assertEqual(self.fs.downloads[-1][1], 50)
+        stream, _ = self.start_download()
+        stream.dataReceived(self.data[50:60])
+        self.assertEqual(self.successResultOf(d), self.data[50:54])
+
+    def test_skip_within_stream(self):
+        self.receiver.read(0, 4)
+        stream, _ = self.start_download()
+        d = self.receiver.read(20, 4)
+        stream.dataReceived(self.data[:30])
+        self.assertEqual(self.successResultOf(d), self.data[20:24])
+        self.assertEqual(len(self.fs.downloads), 1)
+
+    def test_stale_stream_stopped(self):
+        d = self.receiver.read(0, 4)
+        old_stream = self.fs.downloads[-1][0]
+        self.receiver.close()
+        self.failureResultOf(d, SFTPError)
+        self.receiver.read(50, 4)
+        transport = StringTransport()
+        old_stream.makeConnection(transport)
+        old_stream.dataReceived(self.data[:10])
+        self.assertEqual(transport.producerState, 'stopped')
+
+    def test_eof(self):
+        self.assertRaises(EOFError, self.receiver.read, 100, 4)
+        d = self.receiver.read(96, 10)
+        stream, _ = self.start_download()
+        stream.dataReceived(self.data[96:])
+        self.assertEqual(self.successResultOf(d), self.data[96:])
+
+    def test_short_object(self):
+        d1 = self.receiver.read(0, 4)
+        d2 = self.receiver.read(4, 4)
+        stream, _ = self.start_download()
+        stream.dataReceived(self.data[:6])
+        stream.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(self.successResultOf(d1), 'abcd')
+        self.assertEqual(self.successResultOf(d2), 'ef')
+        d3 = self.receiver.read(8, 4)
+        self.failureResultOf(d3, EOFError)
+
+    def test_not_found(self):
+        d = self.receiver.read(0, 4)
+        self.fs.downloads[-1][2].errback(NotFound(404, 'Not Found'))
+        err = self.failureResultOf(d, SFTPError)
+        self.assertEqual(err.value.code, FX_NO_SUCH_FILE)
+
+    def test_pause_when_buffer_full(self):
+        self.patch(SwiftFileReceiver, 'download_buffer_limit', 8)
+        self.receiver.read(0, 1)
+        stream, transport = self.start_download()
+        stream.dataReceived(self.data[:12])
+        self.assertEqual(transport.producerState, 'paused')
+        d = self.receiver.read(1, 4)
+        self.assertEqual(self.successResultOf(d), self.data[1:5])
+        self.assertEqual(transport.producerState, 'producing')
+
+    def test_pause_when_session_full(self):
+        self.patch(SwiftFileReceiver, 'upload_buffer_limit', 8)
+        session = self.receiver.session
+        session.buf = 'x' * 10
+        self.receiver.read(0, 4)
+        stream, transport = self.start_download()
+        stream.dataReceived(self.data[:4])
+        self.assertEqual(transport.producerState, 'paused')
+        session.addWindowBytes('x' * 9)
+        self.assertEqual(transport.producerState, 'paused')
+        session.addWindowBytes('')
+        self.assertEqual(transport.producerState, 'producing')
+        self.assertEqual(session.window_listeners, [])
+
+    def test_pause_when_budget_used_up(self):
+        self.fs.transfer_budget.limit = 8
+        other = self.fs.transfer_budget.share(lambda: None)
+        other.set(6)
+        self.receiver.read(0, 1)
+        stream, transport = self.start_download()
+        stream.dataReceived(self.data[:6])
+        self.assertEqual(transport.producerState, 'paused')
+        other.close()
+        self.assertEqual(transport.producerState, 'producing')
+        self.receiver.close()
+        self.assertEqual(self.fs.transfer_budget.used, 0)
+
+
+class SwiftFileSenderTest(unittest.TestCase):
+    def setUp(self):
+        self.fs = FakeFileSystem()
+        self.writer = self.fs.writer
+        self.session = FakeSession()
+        self.sender = SwiftFileSender(
+            self.fs, '/container/object', self.session)
+
+    def ssh_state(self):
+        return self.session.conn.transport.transport.producerState
+
+    def test_in_order(self):
+        self.assertEqual(self.sender.write(0, 'abcd'), 4)
+        self.writer.started.callback(self.writer)
+        self.assertEqual(self.writer.data, ['abcd'])
+        self.assertEqual(self.sender.write(4, 'efgh'), 4)
+        self.assertEqual(self.writer.data, ['abcd', 'efgh'])
+        d = self.sender.close()
+        self.assertEqual(self.successResultOf(d), 'abcdefgh')
+
+    def test_out_of_order(self):
+        self.sender.write(8, 'ijkl')
+        self.sender.write(4, 'efgh')
+        self.writer.started.callback(self.writer)
+        self.assertEqual(self.writer.data, [])
+        self.sender.write(0, 'abcd')
+        d = self.sender.close()
+        self.assertEqual(self.successResultOf(d), 'abcdefghijkl')
+
+    def test_close_before_started(self):
+        self.sender.write(0, 'abcd')
+        d = self.sender.close()
+        self.assertNoResult(d)
+        self.writer.started.callback(self.writer)
+        self.assertEqual(self.successResultOf(d), 'abcd')
+
+    def test_buffer_while_swift_paused(self):
+        self.patch(SwiftFileSender, 'max_buffer_bytes', 8)
+        self.patch(SwiftFileSender, 'buffer_bytes_resume', 4)
+        self.sender.write(0, 'abcd')
+        self.writer.started.callback(self.writer)
+        self.sender.pauseProducing()
+        self.sender.write(4, 'efgh')
+        self.sender.write(8, 'ijkl')
+        self.assertEqual(self.ssh_state(), 'producing')
+        self.sender.write(12, 'mnop')
+        self.assertEqual(self.ssh_state(), 'paused')
+        self.assertEqual(self.writer.data, ['abcd'])
+        self.sender.resumeProducing()
+        self.assertEqual(''.join(self.writer.data), 'abcdefghijklmnop')
+        self.assertEqual(self.ssh_state(), 'producing')
+
+    def test_pause_when_budget_used_up(self):
+        self.fs.transfer_budget.limit = 8
+        self.sender.write(0, 'abcd')
+        self.sender.write(4, 'efghijkl')
+        self.assertEqual(self.ssh_state(), 'paused')
+        self.assertEqual(self.fs.transfer_budget.used, 12)
+        self.writer.started.callback(self.writer)
+        self.assertEqual(self.ssh_state(), 'producing')
+        self.successResultOf(self.sender.close())
+        self.assertEqual(self.fs.transfer_budget.used, 0)
+
+    def test_upload_failure(self):
+        self.sender.write(0, 'abcd')
+        self.writer.finished.errback(RequestError(500, 'Error'))
+        err = self.assertRaises(SFTPError, self.sender.write, 4, 'efgh')
+        self.assertEqual(err.code, FX_FAILURE)
+        self.failureResultOf(self.sender.close(), RequestError)
+
+    def test_overlapping_write(self):
+        self.sender.write(0, 'abcd')
+        self.assertRaises(SFTPError, self.sender.write, 2, 'cdef')
+        self.sender.write(8, 'ijkl')
+        self.assertRaises(SFTPError, self.sender.write, 8, 'ijkl')
+
+    def test_beyond_window(self):
+        self.patch(SwiftFileSender, 'max_reorder_bytes', 8)
+        self.sender.write(4, 'efgh')
+        err = self.assertRaises(SFTPError, self.sender.write, 8, 'ijkl')
+        self.assertEqual(err.code, FX_FAILURE)
+
+    def test_gap_on_close(self):
+        self.sender.write(0, 'abcd')
+        self.sender.write(8, 'ijkl')
+        self.writer.started.callback(self.writer)
+        d = self.sender.close()
+        err = self.failureResultOf(d, SFTPError)
+        self.assertEqual(err.value.message, 'Missing data at offset 4')
+
+
+class RecentRangesTest(unittest.TestCase):
+    def test_get(self):
+        recent = RecentRanges(100)
+        recent.add(0, 'abcd')
+        recent.add(4, 'efgh')
+        self.assertEqual(recent.get(2, 4), 'cdef')
+        self.assertEqual(recent.get(6, 4), None)
+
+    def test_max_size(self):
+        recent = RecentRanges(8)
+        recent.add(0, 'abcd')
+        recent.add(4, 'efgh')
+        recent.add(8, 'ijkl')
+        self.assertEqual(recent.get(0, 4), None)
+        self.assertEqual(recent.get(4, 8), 'efghijkl')
@@ -0,0 +1,1455 @@
+"""
+See COPYING for license information.
+"""
+import hashlib
+import json
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.error import ConnectionAborted, ConnectionLost
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.web._newclient import ResponseDone
+from twisted.web.error import PageRedirect
+from twisted.web.http_headers import Headers
+
+from swftp.swift import NotFound, Conflict, RequestError
+from swftp.swiftfilesystem import (
+    SwiftFileSystem, SwiftListing, SegmentedUpload, StreamedBody,
+    parse_listing_entry, split_listing_range, listing_end_marker_after,
+    ATTR_OBJECT, ATTR_DIRECTORY, LISTING_SPLIT_CHARS)
+from swftp import objectcache
+from swftp.objectcache import ObjectCache
+from swftp.utils import LRUCache, TransferBudget
+
+
+class FakeSwiftConnection(object):
+    """ In-memory stand-in for SwiftConnection that records every request.
+
+    :param dict containers: {container: {object name: properties}}
+    :param int listing_limit: max number of results per listing page
+    """
+    username = 'username'
+
+    def __init__(self, containers=None, listing_limit=2):
+        self.containers = containers or {}
+        self.listing_limit = listing_limit
+        self.requests = []
+        self.listing_ranges = []
+
+    def _listing(self, names, limit, marker, end_marker, prefix, delimiter):
+        results = []
+        for name in sorted(names):
+            if prefix and not name.startswith(prefix):
+                continue
+            if delimiter:
+                idx = name.find(delimiter, len(prefix or ''))
+                if idx != -1:
+                    name = name[:idx + 1]
+            if marker and name <= marker:
+                continue
+            if end_marker and name >= end_marker:
+                continue
+            if results and results[-1] == name:
+                continue
+            results.append(name)
+        return results[:min(limit or self.listing_limit, self.listing_limit)]
+
+    def head_account(self):
+        self.requests.append(('HEAD', None, None))
+        return defer.succeed({
+            'x-account-container-count': len(self.containers)})
+
+    def get_account(self, limit=None, marker=None, end_marker=None,
+                    entry_callback=None):
+        self.requests.append(('GET', None, marker))
+        self.listing_ranges.append((marker, end_marker))
+        results = [{'name': name, 'count': len(self.containers[name])}
+                   for name in self._listing(
+                       self.containers, limit, marker, end_marker, None, None)]
+        if entry_callback:
+            for result in results:
+                entry_callback(result)
+            return defer.succeed((None, None))
+        return defer.succeed((None, results))
+
+    def head_container(self, container):
+        self.requests.append(('HEAD', container, None))
+        if container not in self.containers:
+            return defer.fail(NotFound(404, 'Not Found'))
+        return defer.succeed({
+            'x-container-object-count': len(self.containers[container])})
+
+    def get_container(self, container, limit=None, marker=None,
+                      end_marker=None, prefix=None, path=None, delimiter=None,
+                      entry_callback=None):
+        self.requests.append(('GET', container, prefix))
+        self.listing_ranges.append((marker, end_marker))
+        if container not in self.containers:
+            return defer.fail(NotFound(404, 'Not Found'))
+        objects = self.containers[container]
+        results = []
+        for name in self._listing(
+                objects, limit, marker, end_marker, prefix, delimiter):
+            if name in objects:
+                result = dict(objects[name])
+                result['name'] = name
+            else:
+                result = {'subdir': name}
+            results.append(result)
+        if entry_callback:
+            for result in results:
+                entry_callback(result)
+            return defer.succeed((None, None))
+        return defer.succeed((None, results))
+
+    def put_container(self, container, headers=None):
+        self.requests.append(('PUT', container, None))
+        self.containers.setdefault(container, {})
+        return defer.succeed((None, None))
+
+    def delete_container(self, container):
+        self.requests.append(('DELETE', container, None))
+        if container not in self.containers:
+            return defer.fail(NotFound(404, 'Not Found'))
+        if self.containers[container]:
+            return defer.fail(Conflict(409, 'Conflict'))
+        del self.containers[container]
+        return defer.succeed((None, None))
+
+    def head_object(self, container, path):
+        self.requests.append(('HEAD', container, path))
+        try:
+            props = self.containers[container][path]
+        except KeyError:
+            return defer.fail(NotFound(404, 'Not Found'))
+        return defer.succeed({
+            'content-length': str(props['bytes']),
+            'content-type': props['content_type'],
+            'last-modified': props['last_modified'],
+        })
+
+    def put_object(self, container, path, headers=None, body=None):
+        self.requests.append(('PUT', container, path))
+        if container not in self.containers:
+            return defer.fail(NotFound(404, 'Not Found'))
+        headers = headers or {}
+        if 'X-Copy-From' in headers:
+            source_container, source = headers['X-Copy-From'].split('/', 1)
+            try:
+                props = self.containers[source_container][source]
+            except KeyError:
+                return defer.fail(NotFound(404, 'Not Found'))
+            self.containers[container][path] = dict(props)
+            return defer.succeed((None, ''))
+        self.containers[container][path] = {
+            'bytes': 0,
+            'content_type': headers.get(
+                'Content-Type', 'application/octet-stream'),
+            'last_modified': '2014-01-01T00:00:00.000000',
+        }
+        return defer.succeed((None, ''))
+
+    def delete_object(self, container, path):
+        self.requests.append(('DELETE', container, path))
+        try:
+            del self.containers[container][path]
+        except KeyError:
+            return defer.fail(NotFound(404, 'Not Found'))
+        return defer.succeed((None, None))
+
+
+def make_object(size=10, content_type='application/octet-stream'):
+    return {
+        'bytes': size,
+        'content_type': content_type,
+        'last_modified': '2014-01-01T00:00:00.000000',
+    }
+
+
+class ListingTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeSwiftConnection({
+            'container': {
+                'a': make_object(),
+                'b': make_object(),
+                'dir/c': make_object(),
+                'dir/d/e': make_object(),
+                'f': make_object(),
+            },
+            'container2': {},
+        })
+        self.fs = SwiftFileSystem(self.conn)
+
+    @defer.inlineCallbacks
+    def test_container_listing(self):
+        listing = yield self.fs.get_full_listing('/container')
+        self.assertEqual(listing.keys(), ['a', 'b', 'dir', 'f'])
+        self.assertEqual(
+            listing['dir']['content-type'], 'application/directory')
+        self.assertEqual(listing['a']['bytes'], 10)
+
+    @defer.inlineCallbacks
+    def test_prefix_listing(self):
+        listing = yield self.fs.get_full_listing('/container/dir')
+        self.assertEqual(listing.keys(), ['c', 'd'])
+
+    @defer.inlineCallbacks
+    def test_account_listing(self):
+        listing = yield self.fs.get_full_listing('/')
+        self.assertEqual(listing.keys(), ['container', 'container2'])
+
+    def test_listing_not_found(self):
+        d = self.fs.get_full_listing('/missing')
+        return self.assertFailure(d, NotFound)
+
+
+class ParallelListingTest(unittest.TestCase):
+    def setUp(self):
+        self.names = ['file_%03d' % i for i in range(100)] + \
+            ['%04x' % (i * 331) for i in range(100)]
+        self.conn = FakeSwiftConnection({
+            'container': dict((name, make_object()) for name in self.names),
+        })
+        self.conn.containers['container']['dir/file_000'] = make_object()
+        self.conn.containers.update(
+            dict(('c%d' % i, {}) for i in range(20)))
+        self.fs = SwiftFileSystem(self.conn)
+        self.fs.listing_concurrency = 4
+        self.fs.listing_split_threshold = 2
+
+    @defer.inlineCallbacks
+    def test_container_listing(self):
+        listing = yield self.fs.get_full_listing('/container')
+        self.assertEqual(listing.keys(), sorted(self.names + ['dir']))
+        self.assertTrue(
+            any(end_marker for _, end_marker in self.conn.listing_ranges))
+
+    @defer.inlineCallbacks
+    def test_prefix_listing(self):
+        listing = yield self.fs.get_full_listing('/container/dir')
+        self.assertEqual(listing.keys(), ['file_000'])
+
+    @defer.inlineCallbacks
+    def test_sequential_names(self):
+        names = ['img_%04d.jpg' % i for i in range(1, 10000)]
+        self.conn = FakeSwiftConnection({
+            'photos': dict((name, make_object()) for name in names),
+        }, listing_limit=1000)
+        pages = []
+        _listing = self.conn._listing
+
+        def listing(names, limit, marker, end_marker, *args):
+            results = _listing(names, limit, marker, end_marker, *args)
+            pages.append((marker, end_marker, len(results)))
+            return results
+        self.conn._listing = listing
+        self.fs = SwiftFileSystem(self.conn)
+        self.fs.listing_concurrency = 4
+        self.fs.listing_split_threshold = 1000
+
+        listing = yield self.fs.get_full_listing('/photos')
+        self.assertEqual(listing.keys(), names)
+        # Every range the rest of the listing is split into has entries
+        first_pages = {}
+        for marker, end_marker, count in pages:
+            first_pages.setdefault(marker, count)
+        for marker in ['img_1000.jpg', 'img_4', 'img_6', 'img_8']:
+            self.assertTrue(first_pages[marker] > 0)
+
+    @defer.inlineCallbacks
+    def test_account_listing(self):
+        listing = yield self.fs.get_full_listing('/')
+        self.assertEqual(
+            listing.keys(),
+            sorted(['container'] + ['c%d' % i for i in range(20)]))
+
+    @defer.inlineCallbacks
+    def test_serial_by_default(self):
+        self.fs.listing_concurrency = 1
+        listing = yield self.fs.get_full_listing('/container')
+        self.assertEqual(listing.keys(), sorted(self.names + ['dir']))
+        self.assertFalse(
+            any(end_marker for _, end_marker in self.conn.listing_ranges))
+
+    @defer.inlineCallbacks
+    def test_ranges_dont_overlap(self):
+        # Names at and right below every possible boundary, which would be
+        # listed twice if two neighbouring ranges overlapped
+        names = self.conn.containers['container']
+        for char in LISTING_SPLIT_CHARS:
+            names[u'file_0' + char] = make_object()
+            names[u'file_0' + char + u'\U0010ffff-'] = make_object()
+
+        def fetch_page(marker, end_marker, callback):
+            return self.conn.get_container(
+                'container', marker=marker, end_marker=end_marker,
+                entry_callback=lambda f: callback((f['name'], f)))
+
+        listing = SwiftListing(fetch_page, concurrency=4, split_threshold=2)
+        listed = []
+        while not listing.done:
+            page = yield listing.next_page()
+            listed.extend(name for name, _ in page)
+        self.assertEqual(listed, sorted(names))
+        self.assertTrue(
+            any(end_marker for _, end_marker in self.conn.listing_ranges))
+
+    def test_not_found(self):
+        d = self.fs.get_full_listing('/missing')
+        return self.assertFailure(d, NotFound)
+
+
+class SwiftListingTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeSwiftConnection({
+            'container': dict(
+                ('obj%02d' % i, make_object()) for i in range(10)),
+        })
+        self.fs = SwiftFileSystem(self.conn)
+
+    def listing_requests(self):
+        return [r for r in self.conn.requests if r[0] == 'GET']
+
+    @defer.inlineCallbacks
+    def test_readahead(self):
+        listing = self.fs.get_listing('/container', readahead=1)
+        self.assertEqual(self.listing_requests(), [])
+        # The last object of each page is held back until the listing moves
+        # past where a directory of the same name would be
+        page = yield listing.next_page()
+        self.assertEqual([name for name, _ in page], ['obj00'])
+        self.assertEqual(len(self.listing_requests()), 2)
+        page = yield listing.next_page()
+        self.assertEqual([name for name, _ in page], ['obj01', 'obj02'])
+        self.assertEqual(len(self.listing_requests()), 3)
+
+    @defer.inlineCallbacks
+    def test_end(self):
+        listing = self.fs.get_listing('/container', readahead=1)
+        names = []
+        while not listing.done:
+            page = yield listing.next_page()
+            names.extend(name for name, _ in page)
+        self.assertEqual(names, ['obj%02d' % i for i in range(10)])
+        page = yield listing.next_page()
+        self.assertEqual(page, [])
+
+    @defer.inlineCallbacks
+    def test_close(self):
+        listing = self.fs.get_listing('/container', readahead=1)
+        yield listing.next_page()
+        listing.close()
+        requests = len(self.listing_requests())
+        page = yield listing.next_page()
+        self.assertEqual(page, [])
+        self.assertEqual(len(self.listing_requests()), requests)
+
+    @defer.inlineCallbacks
+    def test_object_and_directory_across_pages(self):
+        self.conn.containers['container2'] = {
+            'a': make_object(),
+            'a-1': make_object(),
+            'a/b': make_object(),
+            'c': make_object(),
+        }
+        listing = self.fs.get_listing('/container2', readahead=1)
+        entries = []
+        while not listing.done:
+            page = yield listing.next_page()
+            entries.extend(page)
+        self.assertEqual(
+            [name for name, _ in entries], ['a', 'a-1', 'c'])
+        self.assertEqual(entries[0][1]['subdir'], 'a/')
+        listing = yield self.fs.get_full_listing('/container2')
+        self.assertEqual(listing.keys(), ['a', 'a-1', 'c'])
+
+    @defer.inlineCallbacks
+    def test_nested_objects_and_directories(self):
+        self.conn.containers['container2'] = {
+            'a': make_object(),
+            'a-1': make_object(),
+            'a-1.txt': make_object(),
+            'a-1/b': make_object(),
+            'a/b': make_object(),
+            'b': make_object(),
+        }
+        listing = self.fs.get_listing('/container2', readahead=1)
+        entries = []
+        while not listing.done:
+            page = yield listing.next_page()
+            entries.extend(page)
+        self.assertEqual(
+            [(name, 'subdir' in entry) for name, entry in entries],
+            [('a', True), ('a-1', True), ('a-1.txt', False), ('b', False)])
+
+    @defer.inlineCallbacks
+    def test_max_held(self):
+        self.conn.containers['container2'] = {
+            'a': make_object(),
+            'a-1': make_object(),
+            'a-2': make_object(),
+            'a/b': make_object(),
+        }
+        listing = self.fs.get_listing('/container2', readahead=1)
+        listing.max_held = 1
+        entries = []
+        while not listing.done:
+            page = yield listing.next_page()
+            entries.extend(page)
+        # 'a' was handed out as an object before its directory was listed
+        self.assertEqual(
+            [(name, 'subdir' in entry) for name, entry in entries],
+            [('a', False), ('a-1', False), ('a-2', False), ('a', True)])
+
+    def test_not_found(self):
+        listing = self.fs.get_listing('/missing')
+        return self.assertFailure(listing.next_page(), NotFound)
+
+
+class SplitListingRangeTest(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(
+            split_listing_range(None, u'file0001', u'file1000', None, 4),
+            [u'file4', u'file6', u'file8'])
+        self.assertEqual(
+            split_listing_range(None, u'a0001', u'a0zzz', None, 2),
+            [u'a5'])
+
+    def test_split_moves_back(self):
+        self.assertEqual(
+            split_listing_range(None, u'file_000', u'file_009', None, 4),
+            [u'file_03', u'file_05', u'file_07'])
+
+    def test_split_prefix(self):
+        self.assertEqual(
+            split_listing_range('dir/', u'dir/a', u'dir/b', None, 2),
+            [u'dir/o'])
+
+    def test_end_marker(self):
+        self.assertEqual(
+            split_listing_range(None, u'a', u'b', u'c', 4), [])
+        self.assertEqual(
+            split_listing_range(None, u'a', u'b', u'e', 2), [u'd'])
+
+    def test_no_split(self):
+        self.assertEqual(split_listing_range(None, u'a', u'z', None, 4), [])
+        self.assertEqual(split_listing_range(None, u'a', u'b', None, 1), [])
+
+    def test_end_marker_after(self):
+        end_marker = listing_end_marker_after(u'file_5')
+        self.assertTrue(u'file_5' < end_marker < u'file_5-')
+
+
+class ParseListingEntryTest(unittest.TestCase):
+    def test_object(self):
+        self.assertEqual(parse_listing_entry({
+            'name': 'obj',
+            'bytes': 14,
+            'content_type': 'text/plain',
+            'last_modified': '2014-01-01T00:00:00.000000',
+        }), (ATTR_OBJECT, {
+            'size': '14',
+            'content_type': 'text/plain',
+            'last_modified': '2014-01-01T00:00:00.000000',
+        }))
+
+    def test_subdir(self):
+        self.assertEqual(
+            parse_listing_entry({'subdir': 'dir/'}),
+            (ATTR_DIRECTORY, {'content_type': 'application/directory'}))
+
+    def test_directory_marker(self):
+        kind, attrs = parse_listing_entry({
+            'name': 'dir', 'bytes': 0,
+            'content_type': 'application/directory'})
+        self.assertEqual(kind, ATTR_OBJECT)
+        self.assertEqual(attrs['content_type'], 'application/directory')
+
+    def test_swift_bytes(self):
+        kind, attrs = parse_listing_entry({
+            'name': 'slo', 'bytes': 120,
+            'content_type': 'text/plain;swift_bytes=10485760'})
+        self.assertEqual(attrs['size'], '10485760')
+        self.assertEqual(attrs['content_type'], 'text/plain')
+
+    def test_untrusted(self):
+        # Possibly a DLO manifest, whose listed size is always 0
+        self.assertEqual(parse_listing_entry({
+            'name': 'dlo', 'bytes': 0, 'content_type': 'text/plain'}), None)
+        self.assertEqual(parse_listing_entry({
+            'name': 'dir/', 'bytes': 10, 'content_type': 'text/plain'}), None)
+
+
+class AttrCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeSwiftConnection({
+            'container': {
+                'a': make_object(),
+                'dir/b': make_object(),
+            },
+        })
+        self.clock = Clock()
+        self.fs = SwiftFileSystem(self.conn)
+        self.fs.attr_cache = LRUCache(ttl=5, clock=self.clock)
+
+    def heads(self):
+        return [r for r in self.conn.requests if r[0] == 'HEAD']
+
+    def test_configuration(self):
+        self.patch(SwiftFileSystem, 'shared_attr_cache', None)
+        self.patch(SwiftFileSystem, 'attr_cache_ttl', 0)
+        fs = SwiftFileSystem(self.conn)
+        self.assertEqual(fs.attr_cache, None)
+
+        self.patch(SwiftFileSystem, 'attr_cache_ttl', 5)
+        self.patch(SwiftFileSystem, 'attr_cache_size', 20)
+        fs = SwiftFileSystem(self.conn)
+        self.assertEqual(fs.attr_cache.ttl, 5)
+        self.assertEqual(fs.attr_cache.max_size, 20)
+
+    @defer.inlineCallbacks
+    def test_get_attrs_cached(self):
+        attrs = yield self.fs.getAttrs('/container/a')
+        attrs2 = yield self.fs.getAttrs('/container/a')
+        self.assertEqual(attrs, attrs2)
+        self.assertEqual(attrs['size'], '10')
+        self.assertEqual(len(self.heads()), 1)
+
+        yield self.fs.getAttrs('/container')
+        yield self.fs.getAttrs('/container')
+        yield self.fs.getAttrs('/')
+        yield self.fs.getAttrs('/')
+        self.assertEqual(len(self.heads()), 3)
+
+    @defer.inlineCallbacks
+    def test_check_file_existance_cached(self):
+        yield self.fs.getAttrs('/container/a')
+        attrs = yield self.fs.checkFileExistance('/container/a')
+        self.assertEqual(attrs['size'], '10')
+        self.assertEqual(len(self.heads()), 1)
+
+    @defer.inlineCallbacks
+    def test_pseudo_directory_not_an_object(self):
+        attrs = yield self.fs.getAttrs('/container/dir')
+        self.assertEqual(attrs['content_type'], 'application/directory')
+        yield self.assertFailure(
+            self.fs.checkFileExistance('/container/dir'), NotFound)
+
+    @defer.inlineCallbacks
+    def test_ttl(self):
+        yield self.fs.getAttrs('/container/a')
+        self.clock.advance(5)
+        yield self.fs.getAttrs('/container/a')
+        self.assertEqual(len(self.heads()), 2)
+
+    @defer.inlineCallbacks
+    def test_remove_file_invalidates(self):
+        yield self.fs.getAttrs('/container/a')
+        yield self.fs.getAttrs('/container')
+        yield self.fs.removeFile('/container/a')
+        yield self.assertFailure(self.fs.getAttrs('/container/a'), NotFound)
+        yield self.fs.getAttrs('/container')
+        self.assertEqual(len(self.heads()), 4)
+
+    @defer.inlineCallbacks
+    def test_upload_invalidates(self):
+        yield self.fs.checkFileExistance('/container/a')
+        d, writer = self.fs.startFileUpload('/container/a')
+        yield d
+        yield self.fs.checkFileExistance('/container/a')
+        self.assertEqual(len(self.heads()), 2)
+
+    @defer.inlineCallbacks
+    def test_make_directory_invalidates(self):
+        yield self.fs.getAttrs('/container/dir')
+        yield self.fs.makeDirectory('/container/dir')
+        attrs = yield self.fs.checkFileExistance('/container/dir')
+        self.assertEqual(attrs['content_type'], 'application/directory')
+
+    @defer.inlineCallbacks
+    def test_rename_invalidates(self):
+        yield self.fs.getAttrs('/container/a')
+        yield self.assertFailure(self.fs.getAttrs('/container/new'), NotFound)
+        yield self.fs.renameFile('/container/a', '/container/new')
+        yield self.fs.getAttrs('/container/new')
+        yield self.assertFailure(self.fs.getAttrs('/container/a'), NotFound)
+
+    @defer.inlineCallbacks
+    def test_shared_cache(self):
+        shared = LRUCache(ttl=5, clock=self.clock)
+        self.patch(SwiftFileSystem, 'shared_attr_cache', shared)
+        fs1 = SwiftFileSystem(self.conn)
+        fs2 = SwiftFileSystem(self.conn)
+        yield fs1.getAttrs('/container/a')
+        yield fs2.getAttrs('/container/a')
+        self.assertEqual(len(self.heads()), 1)
+
+        # Different users never share entries
+        other_conn = FakeSwiftConnection(self.conn.containers)
+        other_conn.username = 'other'
+        fs3 = SwiftFileSystem(other_conn)
+        yield fs3.getAttrs('/container/a')
+        self.assertEqual(len(other_conn.requests), 1)
+
+    @defer.inlineCallbacks
+    def test_populated_from_listing(self):
+        self.conn.containers['container']['dir/c'] = make_object(size=20)
+        self.conn.containers['container']['dir/sub/d'] = make_object()
+        self.conn.containers['container']['dir/empty'] = make_object(size=0)
+        yield self.fs.get_full_listing('/container/dir')
+        requests = len(self.conn.requests)
+
+        attrs = yield self.fs.getAttrs('/container/dir/c')
+        self.assertEqual(attrs['size'], '20')
+        attrs = yield self.fs.getAttrs('/container/dir/sub')
+        self.assertEqual(attrs['content_type'], 'application/directory')
+        self.assertEqual(len(self.conn.requests), requests)
+
+        # Zero byte objects are always checked with a HEAD
+        yield self.fs.getAttrs('/container/dir/empty')
+        self.assertEqual(len(self.conn.requests), requests + 1)
+
+    @defer.inlineCallbacks
+    def test_listing_not_used_for_reads(self):
+        yield self.fs.get_full_listing('/container/dir')
+        # The listing says b is 10 bytes, but it has grown since
+        self.conn.containers['container']['dir/b'] = make_object(size=30)
+        attrs = yield self.fs.getAttrs('/container/dir/b')
+        self.assertEqual(attrs['size'], '10')
+        attrs = yield self.fs.checkFileExistance('/container/dir/b')
+        self.assertEqual(attrs['size'], '30')
+        self.assertEqual(self.heads()[-1], ('HEAD', 'container', 'dir/b'))
+
+    @defer.inlineCallbacks
+    def test_populated_from_account_listing(self):
+        yield self.fs.get_full_listing('/')
+        requests = len(self.conn.requests)
+        attrs = yield self.fs.getAttrs('/container')
+        self.assertEqual(attrs['content_type'], 'application/directory')
+        self.assertEqual(len(self.conn.requests), requests)
+
+    @defer.inlineCallbacks
+    def test_directory_marker_and_subdir(self):
+        self.conn.containers['container']['dir'] = make_object(
+            size=0, content_type='application/directory')
+        yield self.fs.get_full_listing('/container')
+        kind, _ = self.fs._get_cached_attrs('container', 'dir')
+        self.assertEqual(kind, ATTR_OBJECT)
+
+    @defer.inlineCallbacks
+    def test_negative_lookup(self):
+        yield self.assertFailure(
+            self.fs.getAttrs('/container/missing'), NotFound)
+        self.assertEqual(len(self.conn.requests), 2)
+        yield self.assertFailure(
+            self.fs.getAttrs('/container/missing'), NotFound)
+        yield self.assertFailure(
+            self.fs.checkFileExistance('/container/missing'), NotFound)
+        self.assertEqual(len(self.conn.requests), 2)
+
+    @defer.inlineCallbacks
+    def test_negative_lookup_invalidated_by_write(self):
+        yield self.assertFailure(
+            self.fs.getAttrs('/container/missing'), NotFound)
+        d, writer = self.fs.startFileUpload('/container/missing/file')
+        yield d
+        attrs = yield self.fs.getAttrs('/container/missing')
+        self.assertEqual(attrs['content_type'], 'application/directory')
+
+    @defer.inlineCallbacks
+    def test_known_prefix_skips_listing(self):
+        yield self.fs.get_full_listing('/container/dir')
+        # The listing only proves 'dir' has children, 'dir' may still be an
+        # object so it is HEADed, but no second listing is needed.
+        requests = len(self.conn.requests)
+        attrs = yield self.fs.getAttrs('/container/dir')
+        self.assertEqual(attrs['content_type'], 'application/directory')
+        self.assertEqual(
+            self.conn.requests[requests:], [('HEAD', 'container', 'dir')])
+
+    @defer.inlineCallbacks
+    def test_empty_prefix_listing(self):
+        yield self.fs.get_full_listing('/container/nothing')
+        requests = len(self.conn.requests)
+        yield self.assertFailure(
+            self.fs.getAttrs('/container/nothing'), NotFound)
+        self.assertEqual(
+            self.conn.requests[requests:], [('HEAD', 'container', 'nothing')])
+
+
+class HeldCopyConnection(FakeSwiftConnection):
+    " Holds server-side copies until the test finishes them "
+    def __init__(self, *args, **kwargs):
+        FakeSwiftConnection.__init__(self, *args, **kwargs)
+        self.copies = []
+
+    def finish_copies(self):
+        while not all(d.called for _, d in self.copies):
+            for _, d in self.copies:
+                if not d.called:
+                    d.callback(None)
+
+    def put_object(self, container, path, headers=None, body=None):
+        if 'X-Copy-From' not in (headers or {}):
+            return FakeSwiftConnection.put_object(
+                self, container, path, headers, body)
+        d = defer.Deferred()
+        self.copies.append((path, d))
+        d.addCallback(lambda _: FakeSwiftConnection.put_object(
+            self, container, path, headers, body))
+        return d
+
+
+class RenameTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeSwiftConnection({
+            'container': {
+                'dir': make_object(content_type='application/directory'),
+                'dir/a': make_object(size=1),
+                'dir/b': make_object(size=2),
+                'dir/sub/c': make_object(size=3),
+                'dirt': make_object(),
+                'implicit/d': make_object(),
+            },
+            'other': {},
+        })
+        self.fs = SwiftFileSystem(self.conn)
+
+    def names(self, container='container'):
+        return sorted(self.conn.containers[container])
+
+    @defer.inlineCallbacks
+    def test_rename_directory(self):
+        yield self.fs.renameFile('/container/dir', '/container/new')
+        self.assertEqual(self.names(), [
+            'dirt', 'implicit/d', 'new', 'new/a', 'new/b', 'new/sub/c'])
+        self.assertEqual(self.conn.containers['container']['new/b']['bytes'],
+                         2)
+        self.assertEqual(
+            self.conn.containers['container']['new']['content_type'],
+            'application/directory')
+        # The directory object is copied first and deleted last
+        changes = [r for r in self.conn.requests if r[0] != 'GET']
+        self.assertEqual(changes[1], ('PUT', 'container', 'new'))
+        self.assertEqual(changes[-1], ('DELETE', 'container', 'dir'))
+
+    @defer.inlineCallbacks
+    def test_rename_implicit_directory(self):
+        yield self.fs.renameFile('/container/implicit', '/container/new')
+        self.assertEqual(self.names(), [
+            'dir', 'dir/a', 'dir/b', 'dir/sub/c', 'dirt', 'new/d'])
+
+    @defer.inlineCallbacks
+    def test_rename_to_other_container(self):
+        yield self.fs.renameFile('/container/dir/sub', '/other/sub')
+        self.assertEqual(self.names('other'), ['sub/c'])
+        yield self.assertFailure(
+            self.fs.renameFile('/container/dir', '/missing/dir'), NotFound)
+        self.assertTrue('dir/a' in self.conn.containers['container'])
+
+    def test_rename_not_found(self):
+        return self.assertFailure(
+            self.fs.renameFile('/container/nothing', '/container/new'),
+            NotFound)
+
+    @defer.inlineCallbacks
+    def test_rename_unsupported(self):
+        yield self.assertFailure(
+            self.fs.renameFile('/container', '/new'), Conflict)
+        yield self.assertFailure(
+            self.fs.renameFile('/container/dir', '/container/dir/new'),
+            NotImplementedError)
+        yield self.assertFailure(
+            self.fs.renameFile('/container/dir/sub', '/container/dir'),
+            NotImplementedError)
+        self.assertEqual(len(self.names()), 6)
+
+    def test_concurrency(self):
+        self.conn = HeldCopyConnection(self.conn.containers)
+        self.fs = SwiftFileSystem(self.conn)
+        self.fs.rename_concurrency = 2
+        d = self.fs.renameFile('/container/dir', '/container/new')
+        self.assertEqual([path for path, _ in self.conn.copies], ['new'])
+        self.conn.copies[0][1].callback(None)
+        self.assertEqual([path for path, _ in self.conn.copies[1:]],
+                         ['new/a', 'new/b'])
+        self.conn.copies[1][1].callback(None)
+        self.assertEqual(self.conn.copies[3][0], 'new/sub/c')
+        self.conn.finish_copies()
+        self.successResultOf(d)
+        self.assertEqual(self.names(), [
+            'dirt', 'implicit/d', 'new', 'new/a', 'new/b', 'new/sub/c'])
+
+    def test_resume_after_failure(self):
+        self.conn = HeldCopyConnection(self.conn.containers)
+        self.fs = SwiftFileSystem(self.conn)
+        self.fs.rename_concurrency = 2
+        d = self.fs.renameFile('/container/dir', '/container/new')
+        self.conn.copies[0][1].callback(None)
+        self.conn.copies[1][1].errback(RequestError(500, 'Error'))
+        self.assertNoResult(d)
+        self.conn.copies[2][1].callback(None)
+        self.failureResultOf(d, RequestError)
+        self.assertEqual(len(self.conn.copies), 3)
+        # Only the object that was copied is gone from the old name
+        self.assertEqual(self.names(), [
+            'dir', 'dir/a', 'dir/sub/c', 'dirt', 'implicit/d', 'new',
+            'new/b'])
+
+        d = self.fs.renameFile('/container/dir', '/container/new')
+        self.conn.finish_copies()
+        self.successResultOf(d)
+        self.assertEqual(self.names(), [
+            'dirt', 'implicit/d', 'new', 'new/a', 'new/b', 'new/sub/c'])
+
+
+class BulkDeleteConnection(FakeSwiftConnection):
+    """ Adds the /info endpoint and the bulk delete middleware
+
+    :param int max_deletes: max_deletes_per_request of the middleware, or 0
+        if the cluster doesn't have it
+    """
+    storage_url = 'http://127.0.0.1:8080/v1/AUTH_user'
+
+    def __init__(self, containers=None, max_deletes=0):
+        FakeSwiftConnection.__init__(self, containers)
+        self.max_deletes = max_deletes
+        self.bulk_deletes = []
+
+    def get_info(self):
+        self.requests.append(('GET', 'info', None))
+        info = {'swift': {'version': '1.13.0'}}
+        if self.max_deletes:
+            info['bulk_delete'] = {
+                'max_deletes_per_request': self.max_deletes}
+        return defer.succeed((None, info))
+
+    def bulk_delete(self, paths):
+        self.bulk_deletes.append(paths)
+        for path in paths:
+            container, name = path[1:].split('/', 1)
+            self.containers[container].pop(name, None)
+        return defer.succeed((None, {'Response Status': '200 OK',
+                                     'Errors': []}))
+
+
+class HeldDeleteConnection(BulkDeleteConnection):
+    " Holds object deletes until the test finishes them "
+    def __init__(self, *args, **kwargs):
+        BulkDeleteConnection.__init__(self, *args, **kwargs)
+        self.deletes = []
+
+    def finish_deletes(self):
+        while not all(d.called for _, d in self.deletes):
+            for _, d in self.deletes:
+                if not d.called:
+                    d.callback(None)
+
+    def delete_object(self, container, path):
+        d = defer.Deferred()
+        self.deletes.append((path, d))
+        d.addCallback(lambda _: BulkDeleteConnection.delete_object(
+            self, container, path))
+        return d
+
+
+class RemoveDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.containers = {
+            'container': {
+                'dir': make_object(content_type='application/directory'),
+                'dir/a': make_object(),
+                'dir/b': make_object(),
+                'dir/sub/c': make_object(),
+                'dirt': make_object(),
+                'implicit/d': make_object(),
+            },
+        }
+        self.patch(SwiftFileSystem, 'cluster_info', {})
+        self.patch(SwiftFileSystem, 'recursive_rmdir', True)
+
+    def names(self):
+        return sorted(self.containers['container'])
+
+    @defer.inlineCallbacks
+    def test_not_recursive(self):
+        self.patch(SwiftFileSystem, 'recursive_rmdir', False)
+        conn = BulkDeleteConnection(self.containers, max_deletes=2)
+        yield SwiftFileSystem(conn).removeDirectory('/container/dir')
+        self.assertEqual(self.names(), [
+            'dir/a', 'dir/b', 'dir/sub/c', 'dirt', 'implicit/d'])
+        self.assertEqual(conn.bulk_deletes, [])
+
+    @defer.inlineCallbacks
+    def test_bulk_delete(self):
+        conn = BulkDeleteConnection(self.containers, max_deletes=2)
+        yield SwiftFileSystem(conn).removeDirectory('/container/dir')
+        self.assertEqual(self.names(), ['dirt', 'implicit/d'])
+        self.assertEqual(conn.bulk_deletes, [
+            ['/container/dir/a', '/container/dir/b'],
+            ['/container/dir/sub/c']])
+        self.assertEqual(
+            SwiftFileSystem.cluster_info['127.0.0.1:8080']['bulk_delete'],
+            {'max_deletes_per_request': 2})
+
+        # /info is only checked once per cluster
+        yield SwiftFileSystem(conn).removeDirectory('/container/implicit')
+        self.assertEqual(self.names(), ['dirt'])
+        info_requests = [r for r in conn.requests if r[1] == 'info']
+        self.assertEqual(len(info_requests), 1)
+
+    @defer.inlineCallbacks
+    def test_info_error_not_cached(self):
+        conn = BulkDeleteConnection(self.containers, max_deletes=2)
+        get_info = conn.get_info
+        conn.get_info = lambda: defer.fail(RequestError(503, 'Unavailable'))
+        yield SwiftFileSystem(conn).removeDirectory('/container/dir')
+        self.assertEqual(len(self.flushLoggedErrors(RequestError)), 1)
+        self.assertEqual(conn.bulk_deletes, [])
+        self.assertEqual(SwiftFileSystem.cluster_info, {})
+
+        conn.get_info = get_info
+        yield SwiftFileSystem(conn).removeDirectory('/container/implicit')
+        self.assertEqual(conn.bulk_deletes, [['/container/implicit/d']])
+
+    @defer.inlineCallbacks
+    def test_info_not_found_cached(self):
+        conn = BulkDeleteConnection(self.containers, max_deletes=2)
+        conn.get_info = lambda: defer.fail(NotFound(404, 'Not Found'))
+        yield SwiftFileSystem(conn).removeDirectory('/container/dir')
+        self.assertEqual(conn.bulk_deletes, [])
+        self.assertEqual(SwiftFileSystem.cluster_info, {'127.0.0.1:8080': {}})
+
+    @defer.inlineCallbacks
+    def test_parallel_deletes(self):
+        conn = BulkDeleteConnection(self.containers)
+        yield SwiftFileSystem(conn).removeDirectory('/container/dir')
+        self.assertEqual(self.names(), ['dirt', 'implicit/d'])
+        self.assertEqual(conn.bulk_deletes, [])
+        deletes = [r[2] for r in conn.requests if r[0] == 'DELETE']
+        self.assertEqual(deletes, ['dir/a', 'dir/b', 'dir/sub/c', 'dir'])
+
+    @defer.inlineCallbacks
+    def test_container(self):
+        conn = BulkDeleteConnection(self.containers, max_deletes=10)
+        yield SwiftFileSystem(conn).removeDirectory('/container')
+        self.assertEqual(self.containers, {})
+
+    def test_not_found(self):
+        conn = BulkDeleteConnection(self.containers)
+        return self.assertFailure(
+            SwiftFileSystem(conn).removeDirectory('/container/nothing'),
+            NotFound)
+
+    def test_failure(self):
+        conn = BulkDeleteConnection(self.containers, max_deletes=2)
+        conn.bulk_delete = lambda paths: defer.fail(RequestError(400, '[]'))
+        d = SwiftFileSystem(conn).removeDirectory('/container/dir')
+        self.failureResultOf(d, RequestError)
+        self.assertTrue('dir' in self.containers['container'])
+
+    def test_concurrency(self):
+        conn = HeldDeleteConnection(self.containers)
+        fs = SwiftFileSystem(conn)
+        fs.delete_concurrency = 2
+        d = fs.removeDirectory('/container/dir')
+        self.assertEqual([path for path, _ in conn.deletes],
+                         ['dir/a', 'dir/b'])
+        conn.deletes[0][1].callback(None)
+        self.assertEqual(conn.deletes[2][0], 'dir/sub/c')
+        conn.finish_deletes()
+        self.successResultOf(d)
+        self.assertEqual(self.names(), ['dirt', 'implicit/d'])
+
+
+class FakeResponse(object):
+    def __init__(self, code, etag='"etag"', content_range=None):
+        self.code = code
+        self.headers = Headers({'etag': [etag]})
+        if content_range:
+            self.headers.setRawHeaders('content-range', [content_range])
+
+
+class RangeConnection(object):
+    " Holds GETs until the test answers them "
+    username = 'username'
+
+    def __init__(self, data):
+        self.data = data
+        self.gets = []
+
+    def get_object(self, container, path, headers=None, receiver=None):
+        d = defer.Deferred()
+        self.gets.append((headers.get('Range'), receiver, d, headers))
+        return d
+
+    def respond(self, index, code=206, close=True):
+        header, receiver, d, _ = self.gets[index]
+        start, end = header[len('bytes='):].split('-')
+        start, end = int(start), min(int(end), len(self.data) - 1)
+        transport = StringTransport()
+        receiver.makeConnection(transport)
+        d.callback(FakeResponse(code, content_range='bytes %s-%s/%s' % (
+            start, end, len(self.data))))
+        receiver.dataReceived(self.data[start:end + 1])
+        if close:
+            receiver.connectionLost(Failure(ResponseDone()))
+        return transport
+
+
+class RecordingProtocol(Protocol):
+    def __init__(self):
+        self.data = []
+        self.reason = None
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        self.reason = reason
+
+
+class ParallelDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.data = ''.join(chr(ord('a') + i % 26) for i in range(100))
+        self.conn = RangeConnection(self.data)
+        self.fs = SwiftFileSystem(self.conn)
+        self.fs.download_concurrency = 3
+        self.fs.download_range_size = 30
+        self.consumer = RecordingProtocol()
+
+    def start(self, offset=0, size=None):
+        return self.fs.startFileDownload(
+            '/container/object', self.consumer, offset=offset,
+            size=size or len(self.data))
+
+    def test_ranges_in_order(self):
+        d = self.start()
+        self.assertEqual([get[0] for get in self.conn.gets], ['bytes=0-29'])
+        self.conn.respond(0, close=False)
+        self.successResultOf(d)
+        self.assertEqual([get[0] for get in self.conn.gets], [
+            'bytes=0-29', 'bytes=30-59', 'bytes=60-89'])
+        self.conn.respond(2)
+        self.assertEqual(''.join(self.consumer.data), self.data[:30])
+        self.conn.respond(1)
+        self.assertEqual(''.join(self.consumer.data), self.data[:30])
+        self.conn.gets[0][1].connectionLost(Failure(ResponseDone()))
+        self.assertEqual(self.conn.gets[-1][0], 'bytes=90-99')
+        self.conn.respond(3)
+        self.assertEqual(''.join(self.consumer.data), self.data)
+        self.assertTrue(self.consumer.reason.check(ResponseDone))
+
+    def test_if_match(self):
+        self.start()
+        self.assertNotIn('If-Match', self.conn.gets[0][3])
+        self.conn.respond(0, close=False)
+        self.assertEqual(
+            [get[3].get('If-Match') for get in self.conn.gets[1:]],
+            ['"etag"', '"etag"'])
+
+    def test_object_changed(self):
+        self.start()
+        self.conn.respond(0)
+        self.conn.gets[1][2].errback(RequestError(412, 'Precondition Failed'))
+        self.assertTrue(self.consumer.reason.check(ConnectionLost))
+        self.assertEqual(''.join(self.consumer.data), self.data[:30])
+
+    def test_object_grew(self):
+        self.data = self.conn.data = self.data * 3
+        d = self.start(size=100)
+        self.conn.respond(0)
+        self.successResultOf(d)
+        self.assertEqual(self.conn.gets[-1][0], 'bytes=90-119')
+        for index in range(1, 10):
+            self.conn.respond(index)
+        self.assertEqual(self.conn.gets[-1][0], 'bytes=270-299')
+        self.assertEqual(''.join(self.consumer.data), self.data)
+        self.assertTrue(self.consumer.reason.check(ResponseDone))
+
+    def test_object_shrank(self):
+        self.data = self.conn.data = self.data[:20]
+        d = self.start(size=100)
+        self.conn.respond(0)
+        self.successResultOf(d)
+        self.assertEqual(len(self.conn.gets), 1)
+        self.assertEqual(''.join(self.consumer.data), self.data)
+        self.assertTrue(self.consumer.reason.check(ResponseDone))
+
+    def test_no_content_range(self):
+        d = self.start()
+        self.conn.gets[0][2].callback(FakeResponse(206))
+        self.failureResultOf(d, ConnectionLost)
+
+    def test_offset(self):
+        self.start(offset=50)
+        self.conn.respond(0)
+        self.assertEqual([get[0] for get in self.conn.gets], [
+            'bytes=50-79', 'bytes=80-99'])
+        self.conn.respond(1)
+        self.assertEqual(''.join(self.consumer.data), self.data[50:])
+
+    def test_small_object_single_get(self):
+        self.fs.download_range_size = 100
+        self.start()
+        self.assertEqual(self.conn.gets[0][0], None)
+
+    def test_pause(self):
+        self.start()
+        transport = self.conn.respond(0, close=False)
+        self.consumer.transport.pauseProducing()
+        self.assertEqual(transport.producerState, 'paused')
+        self.conn.gets[0][1].connectionLost(Failure(ResponseDone()))
+        self.conn.respond(1)
+        self.assertEqual(''.join(self.consumer.data), self.data[:30])
+        self.consumer.transport.resumeProducing()
+        self.assertEqual(''.join(self.consumer.data), self.data[:60])
+
+    def test_budget_pauses_later_ranges(self):
+        self.fs.transfer_budget = TransferBudget(20)
+        self.start()
+        self.consumer.transport.pauseProducing()
+        head = self.conn.respond(0, close=False)
+        self.consumer.transport.resumeProducing()
+        later = self.conn.respond(1, close=False)
+        self.assertEqual(later.producerState, 'paused')
+        self.assertEqual(head.producerState, 'producing')
+        self.conn.gets[0][1].connectionLost(Failure(ResponseDone()))
+        self.assertEqual(later.producerState, 'producing')
+        self.assertEqual(''.join(self.consumer.data), self.data[:60])
+        self.assertEqual(self.fs.transfer_budget.used, 0)
+
+    def test_stop(self):
+        self.start()
+        transport = self.conn.respond(0, close=False)
+        self.consumer.transport.stopProducing()
+        self.assertEqual(transport.producerState, 'stopped')
+        self.assertTrue(self.consumer.reason.check(ConnectionAborted))
+
+    def test_first_range_fails(self):
+        d = self.start()
+        self.conn.gets[0][2].errback(RequestError(500, 'Error'))
+        self.failureResultOf(d, RequestError)
+
+    def test_later_range_fails(self):
+        d = self.start()
+        self.conn.respond(0)
+        self.successResultOf(d)
+        self.conn.gets[1][2].errback(RequestError(500, 'Error'))
+        self.assertTrue(self.consumer.reason.check(RequestError))
+
+    def test_range_ignored(self):
+        d = self.start()
+        self.conn.respond(0, code=200)
+        self.failureResultOf(d)
+        self.assertEqual(self.consumer.data, [])
+
+
+class UploadConnection(object):
+    """ Records PUTs and DELETEs and holds them until the test answers them
+
+    :param dict info: what /info says about the cluster
+    :param list manifest: segments of the Static Large Object that is
+        already at the upload's path, if any
+    """
+    username = 'username'
+    storage_url = 'http://127.0.0.1:8080/v1/AUTH_user'
+
+    def __init__(self, info=None, manifest=None):
+        self.info = info or {}
+        self.manifest = manifest
+        self.containers = []
+        self.puts = []
+        self.deletes = []
+        self.streams = []  # Deferreds of the streamed bodies being sent
+
+    def get_info(self):
+        return defer.succeed((None, self.info))
+
+    def head_object(self, container, path):
+        if self.manifest is None:
+            return defer.fail(NotFound(404, 'Not Found'))
+        return defer.succeed({'x-static-large-object': 'True'})
+
+    def get_slo_manifest(self, container, path):
+        return defer.succeed((None, self.manifest))
+
+    def put_container(self, container, headers=None):
+        d = defer.Deferred()
+        self.containers.append((container, d))
+        return d
+
+    def put_object(self, container, path, headers=None, body=None,
+                   params=None):
+        d = defer.Deferred()
+        if isinstance(body, StreamedBody):
+            # Sent once the test calls stream()
+            data = body
+        else:
+            data = body._inputFile.getvalue() if body else ''
+        self.puts.append((container, path, headers, params, data, d))
+        return d
+
+    def delete_object(self, container, path):
+        self.deletes.append((container, path))
+        return defer.succeed(None)
+
+    def stream(self, index=0):
+        " Starts sending the streamed body of a PUT, returns its transport "
+        transport = StringTransport()
+        self.streams.append(self.puts[index][4].startProducing(transport))
+        return transport
+
+
+class FakeProducer(object):
+    def __init__(self):
+        self.state = 'producing'
+
+    def pauseProducing(self):
+        self.state = 'paused'
+
+    def resumeProducing(self):
+        self.state = 'producing'
+
+    def stopProducing(self):
+        self.state = 'stopped'
+
+
+class SegmentedUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.patch(SegmentedUpload, 'stream_threshold', 4)
+        self.start(UploadConnection())
+
+    def start(self, conn):
+        self.patch(SwiftFileSystem, 'cluster_info', {})
+        self.conn = conn
+        self.fs = SwiftFileSystem(self.conn)
+        self.fs.upload_segment_size = 10
+        self.fs.upload_concurrency = 2
+        self.producer = FakeProducer()
+        self.d, self.writer = self.fs.startFileUpload('/container/object')
+        self.writer.registerProducer(self.producer, True)
+
+    def test_small_upload(self):
+        self.writer.write('ab')
+        self.writer.write('cd')
+        self.assertEqual(self.conn.puts, [])
+        self.writer.unregisterProducer()
+        self.assertEqual(len(self.conn.puts), 1)
+        container, path, _, params, data, d = self.conn.puts[0]
+        self.assertEqual((container, path, params, data),
+                         ('container', 'object', None, 'abcd'))
+        d.callback('done')
+        self.assertEqual(self.successResultOf(self.d), 'done')
+        self.assertEqual(self.conn.containers, [])
+
+    def test_streamed_to_object(self):
+        self.writer.write('abcdef')
+        self.assertEqual(self.producer.state, 'paused')
+        container, path, _, params, _, d = self.conn.puts[0]
+        self.assertEqual((container, path, params),
+                         ('container', 'object', None))
+
+        # The upload is sent as it is written
+        transport = self.conn.stream()
+        self.assertEqual(transport.value(), 'abcdef')
+        self.assertEqual(self.producer.state, 'producing')
+        self.writer.write('ghij')
+        self.assertEqual(transport.value(), 'abcdefghij')
+        self.assertNoResult(self.conn.streams[0])
+        self.writer.unregisterProducer()
+        self.successResultOf(self.conn.streams[0])
+        d.callback('done')
+        self.assertEqual(self.successResultOf(self.d), 'done')
+        self.assertEqual(len(self.conn.puts), 1)
+        self.assertEqual(self.conn.containers, [])
+        self.assertEqual(self.conn.deletes, [])
+
+    def test_switch_to_segments(self):
+        self.writer.write('abcdef')
+        transport = self.conn.stream()
+        self.writer.write('ghijk')
+
+        # The PUT to the object's name is aborted before it completes
+        self.assertEqual(transport.value(), 'abcdef')
+        self.failureResultOf(self.conn.streams[0], ConnectionAborted)
+        self.conn.puts[0][-1].errback(ConnectionAborted())
+        self.assertNoResult(self.d)
+
+        self.assertEqual(self.conn.containers[0][0], 'container_segments')
+        self.conn.containers[0][1].callback(None)
+        self.assertEqual(self.conn.puts[1][4], 'abcdefghij')
+        self.writer.unregisterProducer()
+        self.assertEqual(self.conn.puts[2][4], 'k')
+        self.conn.puts[1][-1].callback(None)
+        self.conn.puts[2][-1].callback(None)
+        container, path, _, params, data, d = self.conn.puts[3]
+        self.assertEqual((container, path), ('container', 'object'))
+        self.assertEqual(params, {'multipart-manifest': 'put'})
+        self.assertEqual([entry['size_bytes'] for entry in json.loads(data)],
+                         [10, 1])
+        d.callback('done')
+        self.assertEqual(self.successResultOf(self.d), 'done')
+
+    def test_segmented_upload(self):
+        self.writer.write('a' * 25)
+        self.assertEqual(self.conn.containers[0][0], 'container_segments')
+        self.assertEqual(self.conn.puts, [])
+        self.conn.containers[0][1].callback(None)
+        self.assertEqual(len(self.conn.puts), 2)
+        self.writer.unregisterProducer()
+        self.assertEqual(len(self.conn.puts), 2)
+        for put in self.conn.puts[:]:
+            put[-1].callback(None)
+        self.assertEqual(len(self.conn.puts), 3)
+        self.conn.puts[2][-1].callback(None)
+        self.assertEqual(len(self.conn.puts), 4)
+
+        container, path, _, params, data, d = self.conn.puts[3]
+        self.assertEqual((container, path), ('container', 'object'))
+        self.assertEqual(params, {'multipart-manifest': 'put'})
+        manifest = json.loads(data)
+        self.assertEqual([entry['size_bytes'] for entry in manifest],
+                         [10, 10, 5])
+        for entry, put in zip(manifest, self.conn.puts[:3]):
+            self.assertEqual(entry['path'], '/container_segments/%s' % put[1])
+            self.assertEqual(entry['etag'], put[2]['ETag'])
+            self.assertEqual(entry['etag'], hashlib.md5(put[4]).hexdigest())
+        self.assertTrue(self.conn.puts[0][1].startswith('object/slo/'))
+        self.assertTrue(self.conn.puts[2][1].endswith('/00000002'))
+        d.callback(None)
+        self.successResultOf(self.d)
+        self.assertEqual(self.conn.deletes, [])
+
+    def test_pause_while_segments_wait(self):
+        self.writer.write('a' * 11)
+        self.assertEqual(self.producer.state, 'paused')
+        self.conn.containers[0][1].callback(None)
+        self.assertEqual(self.producer.state, 'producing')
+        self.writer.write('a' * 20)
+        self.assertEqual(len(self.conn.puts), 2)
+        self.assertEqual(self.producer.state, 'paused')
+        self.conn.puts[0][-1].callback(None)
+        self.assertEqual(len(self.conn.puts), 3)
+        self.assertEqual(self.producer.state, 'producing')
+
+    def test_failed_segment(self):
+        self.writer.write('a' * 35)
+        self.conn.containers[0][1].callback(None)
+        self.conn.puts[0][-1].callback(None)
+        self.conn.puts[1][-1].errback(RequestError(500, 'Error'))
+        self.failureResultOf(self.d, RequestError)
+        self.assertEqual(self.producer.state, 'stopped')
+        self.assertEqual(self.conn.deletes,
+                         [('container_segments', self.conn.puts[0][1])])
+        self.conn.puts[2][-1].callback(None)
+        self.assertEqual(self.conn.deletes[-1],
+                         ('container_segments', self.conn.puts[2][1]))
+
+    def test_max_segments(self):
+        self.start(UploadConnection(
+            info={'slo': {'max_manifest_segments': 2}}))
+        self.writer.write('a' * 20)
+        self.assertNoResult(self.d)
+        self.writer.write('a' * 15)
+        self.failureResultOf(self.d, RequestError)
+        self.assertEqual(self.producer.state, 'stopped')
+
+    def test_old_segments_deleted(self):
+        self.start(UploadConnection(manifest=[
+            {'name': u'/container_segments/object/slo/1.0/10/00000000'},
+            {'name': u'/elsewhere/object/00000001'}]))
+        self.writer.write('abcdef')
+        self.conn.stream()
+        self.writer.unregisterProducer()
+        self.assertEqual(self.conn.deletes, [])
+        self.conn.puts[0][-1].callback(None)
+        self.successResultOf(self.d)
+        self.assertEqual(
+            self.conn.deletes,
+            [('container_segments', 'object/slo/1.0/10/00000000')])
+
+    def test_old_segments_looked_up_first(self):
+        self.conn.head_object = lambda container, path: defer.Deferred()
+        self.writer.write('abcdef')
+        self.conn.stream()
+        self.writer.unregisterProducer()
+        # The PUT isn't finished while the replaced object is unknown
+        self.assertNoResult(self.conn.streams[0])
+
+
+class ObjectResponse(object):
+    def __init__(self, data, etag):
+        self.code = 200
+        self.headers = Headers({'etag': [etag]})
+        self.length = len(data)
+
+
+class ObjectConnection(object):
+    " Answers GETs for one object, honouring If-None-Match "
+    username = 'username'
+    storage_url = 'http://127.0.0.1:8080/v1/AUTH_user'
+
+    def __init__(self, data, etag):
+        self.data = data
+        self.etag = etag
+        self.gets = []
+
+    def get_object(self, container, path, headers=None, receiver=None):
+        self.gets.append(headers)
+        if headers.get('If-None-Match') == '"%s"' % self.etag:
+            return defer.fail(PageRedirect(304, 'Not Modified'))
+        data = self.data
+        if 'Range' in headers:
+            data = data[int(headers['Range'][len('bytes='):-1]):]
+        receiver.makeConnection(StringTransport())
+        response = ObjectResponse(data, self.etag)
+        d = defer.succeed(response)
+        receiver.dataReceived(data)
+        receiver.connectionLost(Failure(ResponseDone()))
+        return d
+
+
+class ObjectCacheDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = ObjectConnection('abcdefghij', 'etag1')
+        self.cache = ObjectCache(self.mktemp(), 100)
+        self.fs = SwiftFileSystem(self.conn)
+        self.patch(SwiftFileSystem, 'object_cache', self.cache)
+        self.clock = Clock()
+        self.patch(objectcache, 'reactor', self.clock)
+
+    def download(self, offset=0):
+        consumer = RecordingProtocol()
+        self.fs.startFileDownload('/container/obj', consumer, offset, 10)
+        self.clock.advance(0)
+        self.assertTrue(consumer.reason.check(ResponseDone))
+        return ''.join(consumer.data)
+
+    def test_miss_then_hit(self):
+        self.assertEqual(self.download(), 'abcdefghij')
+        self.assertEqual(self.conn.gets, [{}])
+        self.assertEqual(self.download(), 'abcdefghij')
+        self.assertEqual(self.conn.gets[1], {'If-None-Match': '"etag1"'})
+
+    def test_hit_with_offset(self):
+        self.download()
+        self.assertEqual(self.download(offset=4), 'efghij')
+        self.assertEqual(self.conn.gets[1], {
+            'If-None-Match': '"etag1"', 'Range': 'bytes=4-'})
+
+    def test_offset_not_cached(self):
+        self.assertEqual(self.download(offset=4), 'efghij')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_modified(self):
+        self.download()
+        self.conn.data, self.conn.etag = 'klmnopqrst', 'etag2'
+        self.assertEqual(self.download(), 'klmnopqrst')
+        self.assertEqual(self.cache.get(
+            (self.conn.storage_url, 'container', 'obj')).etag, 'etag2')
+        self.assertEqual(self.download(), 'klmnopqrst')
+        self.assertEqual(self.conn.gets[2], {'If-None-Match': '"etag2"'})
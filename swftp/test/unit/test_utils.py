@@ -6,9 +6,12 @@ import os
 import time
 
 from twisted.python import log
+from twisted.internet.task import Clock
 
 from swftp.utils import (
-    try_datetime_parse, MetricCollector, parse_key_value_config)
+    try_datetime_parse, MetricCollector, parse_key_value_config, LRUCache,
+    ChunkBuffer, TransferBudget, FairScheduler, PRIORITY_METADATA,
+    AIMDLimiter, RetryPolicy)
 
 
 class MetricCollectorTest(unittest.TestCase):
@@ -120,3 +123,315 @@ class ParseKeyValueConfigTest(unittest.TestCase):
     def test_whitespace(self):
         res = parse_key_value_config('  test    : 1   ,   test2     :  2   ')
         self.assertEqual(res, {'test': '1', 'test2': '2'})
+
+
+class LRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = LRUCache(max_size=3, ttl=10, clock=self.clock)
+
+    def test_get_set(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('b', 'default'), 'default')
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+
+    def test_cached_none(self):
+        self.cache.set('a', None)
+        self.assertIn('a', self.cache)
+        self.assertEqual(self.cache.get('a', 'default'), None)
+
+    def test_ttl(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=20)
+        self.clock.advance(10)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 2)
+        self.clock.advance(10)
+        self.assertEqual(self.cache.get('b'), None)
+
+    def test_no_ttl(self):
+        cache = LRUCache(ttl=0, clock=self.clock)
+        cache.set('a', 1)
+        self.clock.advance(100000)
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_lru_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.set('c', 3)
+        # Touch 'a' so that 'b' becomes the least recently used
+        self.cache.get('a')
+        self.cache.set('d', 4)
+        self.assertEqual(len(self.cache), 3)
+        self.assertNotIn('b', self.cache)
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_expired_entries_evicted(self):
+        self.cache.set('a', 1)
+        self.clock.advance(10)
+        self.cache.set('b', 2)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_delete_clear(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.delete('a')
+        self.cache.delete('missing')
+        self.assertNotIn('a', self.cache)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+
+class ChunkBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.buf = ChunkBuffer()
+
+    def test_read_within_chunk(self):
+        self.buf.write('abcdef')
+        self.assertEqual(self.buf.read(2), 'ab')
+        self.assertEqual(self.buf.read(2), 'cd')
+        self.assertEqual(len(self.buf), 2)
+
+    def test_read_across_chunks(self):
+        for data in ('abc', 'def', 'ghi'):
+            self.buf.write(data)
+        self.assertEqual(self.buf.read(2), 'ab')
+        self.assertEqual(self.buf.read(5), 'cdefg')
+        self.assertEqual(self.buf.read(10), 'hi')
+        self.assertEqual(len(self.buf), 0)
+
+    def test_whole_chunk_not_copied(self):
+        chunk = 'x' * 100
+        self.buf.write(chunk)
+        self.assertIs(self.buf.read(100), chunk)
+
+    def test_empty(self):
+        self.buf.write('')
+        self.assertEqual(self.buf.read(10), '')
+        self.assertEqual(self.buf.read(-1), '')
+        self.buf.write('abc')
+        self.buf.clear()
+        self.assertEqual(len(self.buf), 0)
+        self.assertEqual(self.buf.read(10), '')
+
+    def test_read_chunk(self):
+        for data in ('abc', 'def'):
+            self.buf.write(data)
+        self.assertEqual(self.buf.read(1), 'a')
+        self.assertEqual(self.buf.read_chunk(), 'bc')
+        self.assertEqual(self.buf.read_chunk(), 'def')
+        self.assertEqual(self.buf.read_chunk(), '')
+        self.assertEqual(len(self.buf), 0)
+
+
+class TransferBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.budget = TransferBudget(100)
+        self.resumed = []
+        self.big = self.budget.share(lambda: self.resumed.append('big'))
+        self.small = self.budget.share(lambda: self.resumed.append('small'))
+
+    def test_within_budget(self):
+        self.big.set(90)
+        self.small.set(10)
+        self.assertFalse(self.big.check())
+        self.assertFalse(self.small.check())
+
+    def test_only_big_shares_pause(self):
+        self.big.set(90)
+        self.small.set(20)
+        self.assertTrue(self.big.check())
+        self.assertFalse(self.small.check())
+        self.assertEqual(self.budget.num_paused, 1)
+
+    def test_resume_on_release(self):
+        self.big.set(90)
+        self.small.set(20)
+        self.assertTrue(self.big.check())
+        self.small.set(5)
+        self.assertEqual(self.resumed, ['big'])
+        self.assertFalse(self.big.check())
+
+    def test_close(self):
+        self.big.set(90)
+        self.small.set(20)
+        self.big.check()
+        self.small.close()
+        self.assertEqual(self.budget.used, 90)
+        self.assertEqual(self.resumed, ['big'])
+        self.assertEqual(self.budget.shares, [self.big])
+
+    def test_no_limit(self):
+        budget = TransferBudget()
+        share = budget.share(lambda: None)
+        share.set(10 ** 9)
+        self.assertFalse(share.check())
+        self.assertEqual(budget.used, 10 ** 9)
+
+
+class FairSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = FairScheduler(2, clock=self.clock)
+        self.started = []
+
+    def acquire(self, key, name, **kwargs):
+        d = self.scheduler.acquire(key, **kwargs)
+        d.addCallback(lambda _: self.started.append(name))
+
+    def test_within_limit(self):
+        self.acquire('user1', 'a')
+        self.acquire('user1', 'b')
+        self.acquire('user1', 'c')
+        self.assertEqual(self.started, ['a', 'b'])
+        self.assertEqual(self.scheduler.gauges()['scheduler.queued'](), 1)
+        self.scheduler.release()
+        self.assertEqual(self.started, ['a', 'b', 'c'])
+        self.assertEqual(self.scheduler.gauges()['scheduler.active'](), 2)
+
+    def test_fair_share(self):
+        self.acquire('busy', 'busy0')
+        self.acquire('busy', 'busy1')
+        for i in range(2, 6):
+            self.acquire('busy', 'busy%s' % i)
+        self.acquire('quiet', 'quiet0')
+        self.acquire('quiet', 'quiet1')
+        for _ in range(6):
+            self.scheduler.release()
+        # The queued requests of both users take turns
+        self.assertEqual(self.started[2:], [
+            'quiet0', 'busy2', 'quiet1', 'busy3', 'busy4', 'busy5'])
+
+    def test_weight(self):
+        self.acquire('user1', 'a')
+        self.acquire('user1', 'b')
+        for i in range(6):
+            self.acquire('light', 'light%s' % i)
+            self.acquire('heavy', 'heavy%s' % i, weight=2)
+        for _ in range(6):
+            self.scheduler.release()
+        started = [name[:5] for name in self.started[2:]]
+        self.assertEqual(started.count('heavy'), 4)
+        self.assertEqual(started.count('light'), 2)
+
+    def test_metadata_priority(self):
+        self.acquire('user1', 'a')
+        self.acquire('user1', 'b')
+        self.acquire('user1', 'get')
+        self.acquire('user2', 'head', priority=PRIORITY_METADATA)
+        self.scheduler.release()
+        self.assertEqual(self.started[2:], ['head'])
+
+    def test_idle_flows_removed(self):
+        self.acquire('user1', 'a')
+        self.scheduler.release()
+        self.acquire('user2', 'b')
+        self.acquire('user2', 'c')
+        # user1 is kept until the others have caught up with it
+        self.assertEqual(sorted(self.scheduler.flows), ['user1', 'user2'])
+        self.scheduler.release()
+        self.acquire('user2', 'd')
+        self.assertEqual(self.scheduler.flows.keys(), ['user2'])
+
+    def test_wait_metrics(self):
+        collector = MetricCollector()
+        collector.start()
+        self.addCleanup(collector.stop)
+        self.acquire('user1', 'a')
+        self.acquire('user1', 'b')
+        self.acquire('user1', 'c')
+        self.clock.advance(1.5)
+        self.scheduler.release()
+        self.assertEqual(collector.totals['scheduler.waited'], 1)
+        self.assertEqual(collector.totals['scheduler.wait_ms'], 1500)
+
+    def test_no_wait_metrics_without_queueing(self):
+        collector = MetricCollector()
+        collector.start()
+        self.addCleanup(collector.stop)
+        # Time moves on while the requests are being added
+        ticks = iter(range(10))
+        self.clock.seconds = lambda: next(ticks)
+        self.acquire('user1', 'a')
+        self.acquire('user1', 'b')
+        self.assertEqual(self.started, ['a', 'b'])
+        self.assertNotIn('scheduler.waited', collector.totals)
+
+
+class AIMDLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.limiter = AIMDLimiter(4, max_limit=6, clock=self.clock)
+
+    def test_grows_while_latency_flat(self):
+        # Each full window of requests adds one
+        for _ in range(5):
+            self.limiter.record(0.1)
+        self.assertEqual(self.limiter.limit, 5)
+        for _ in range(20):
+            self.limiter.record(0.1)
+        self.assertEqual(self.limiter.limit, 6)
+
+    def test_holds_when_latency_rises(self):
+        self.limiter.record(0.1)
+        for _ in range(20):
+            self.limiter.record(1.0)
+        limit = self.limiter.limit
+        for _ in range(20):
+            self.limiter.record(1.0)
+        self.assertEqual(self.limiter.limit, limit)
+
+    def test_overloaded(self):
+        self.limiter.record(0.1)
+        self.limiter.record(0.1, overloaded=True)
+        self.assertEqual(self.limiter.limit, 2)
+        # More errors from the same round trip don't cut it again
+        self.limiter.record(0.1, overloaded=True)
+        self.assertEqual(self.limiter.limit, 2)
+        self.clock.advance(0.2)
+        self.limiter.record(0.1, overloaded=True)
+        self.limiter.record(0.1, overloaded=True)
+        self.assertEqual(self.limiter.limit, 1)
+
+    def test_scheduler_limit(self):
+        scheduler = FairScheduler(4, clock=self.clock, limiter=self.limiter)
+        for _ in range(5):
+            scheduler.acquire('user1')
+        self.assertEqual(scheduler.active, 4)
+        scheduler.release(0.1, overloaded=True)
+        self.assertEqual(scheduler.gauges()['scheduler.limit'](), 2)
+        self.assertEqual(scheduler.active, 3)
+        scheduler.release(0.1)
+        self.assertEqual((scheduler.active, scheduler.queued), (2, 1))
+        scheduler.release(0.1)
+        self.assertEqual((scheduler.active, scheduler.queued), (2, 0))
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def test_backoff(self):
+        policy = RetryPolicy(max_retries=4, backoff=0.1, max_delay=0.5,
+                             rand=lambda: 1.0)
+        self.assertEqual([policy.delay(n) for n in range(1, 6)],
+                         [0.1, 0.2, 0.4, 0.5, None])
+
+    def test_jitter(self):
+        policy = RetryPolicy(backoff=1.0, rand=lambda: 0.25)
+        self.assertEqual(policy.delay(3), 1.0)
+
+    def test_budget(self):
+        policy = RetryPolicy(budget_ratio=0.5, budget_burst=2)
+        self.assertEqual(policy.gauges()['retry.budget'](), 2)
+        self.assertNotEqual(policy.delay(1), None)
+        self.assertNotEqual(policy.delay(1), None)
+        self.assertEqual(policy.delay(1), None)
+        policy.request()
+        self.assertEqual(policy.delay(1), None)
+        policy.request()
+        self.assertNotEqual(policy.delay(1), None)
+        # Requests don't save up more than budget_burst retries
+        for _ in range(10):
+            policy.request()
+        self.assertEqual(policy.tokens, 2)
@@ -1,11 +1,12 @@
 """
 See COPYING for license information.
 """
-from collections import defaultdict
+from collections import defaultdict, deque
+import random
 import time
 
 from twisted.python import log
-from twisted.internet import reactor, tcp
+from twisted.internet import defer, reactor, tcp
 try:
     from collections import OrderedDict
 except ImportError:
@@ -25,6 +26,21 @@ GLOBAL_METRICS = [
     'num_clients',
     'auth.succeed',
     'auth.fail',
+    'auth.cache_hit',
+    'auth.cache_miss',
+    'listing.split',
+    'cache.hit',
+    'cache.miss',
+    'cache.bytes_saved',
+    'spool.full',
+    'rename.objects',
+    'delete.objects',
+    'scheduler.waited',
+    'scheduler.wait_ms',
+    'limiter.decrease',
+    'retry.attempt',
+    'retry.budget_exhausted',
+    'endpoint.ejected',
     'transfer.egress_bytes',
     'transfer.ingress_bytes',
 ]
@@ -68,6 +84,495 @@ def parse_key_value_config(config_value):
     return key_values
 
 
+_MISSING = object()
+
+
+class LRUCache(object):
+    """ A size-bounded mapping whose entries expire after a TTL. The least
+    recently used entry is evicted when the cache is full.
+
+    :param int max_size: the max number of entries to hold. 0 is unbounded
+    :param float ttl: seconds that an entry is valid for. 0 never expires
+    :param clock: provider of seconds(), defaults to the reactor
+
+    Example:
+        >>> c = LRUCache(max_size=2, ttl=60)
+        >>> c.set('a', 1)
+        >>> c.get('a')
+        1
+        >>> c.get('b', 'missing')
+        'missing'
+
+    """
+    def __init__(self, max_size=1000, ttl=0, clock=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock or reactor
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def _expired(self, expires):
+        return expires is not None and expires <= self.clock.seconds()
+
+    def get(self, key, default=None):
+        " Returns the value for key, or default if missing or expired "
+        try:
+            value, expires = self._entries.pop(key)
+        except KeyError:
+            return default
+        if self._expired(expires):
+            return default
+        self._entries[key] = (value, expires)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """ Stores a value. A ttl given here overrides the cache default
+        for this entry only """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl:
+            expires = self.clock.seconds() + ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (value, expires)
+        self._evict()
+
+    def delete(self, key):
+        " Removes a key from the cache if present "
+        self._entries.pop(key, None)
+
+    def clear(self):
+        " Removes all entries "
+        self._entries.clear()
+
+    def _evict(self):
+        while self._entries:
+            key, (_, expires) = next(self._entries.iteritems())
+            if not self._expired(expires) and \
+                    (not self.max_size or
+                     len(self._entries) <= self.max_size):
+                break
+            del self._entries[key]
+
+
+class ChunkBuffer(object):
+    """ A FIFO byte buffer kept as a deque of the chunks written to it.
+
+    Reading only copies the bytes being returned. A read that a single chunk
+    can satisfy is one slice, and a read of exactly one whole chunk hands
+    that chunk back without copying it.
+    """
+    def __init__(self):
+        self._chunks = deque()
+        self._offset = 0  # bytes already read from self._chunks[0]
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def write(self, data):
+        if data:
+            self._chunks.append(data)
+            self._len += len(data)
+
+    def read(self, length):
+        " Removes and returns up to length bytes from the buffer "
+        pieces = []
+        remaining = max(min(length, self._len), 0)
+        while remaining:
+            chunk = self._chunks[0]
+            start = self._offset
+            end = min(len(chunk), start + remaining)
+            if start == 0 and end == len(chunk):
+                pieces.append(chunk)
+            else:
+                pieces.append(chunk[start:end])
+            remaining -= end - start
+            if end == len(chunk):
+                self._chunks.popleft()
+                self._offset = 0
+            else:
+                self._offset = end
+        if len(pieces) == 1:
+            data = pieces[0]
+        else:
+            data = ''.join(pieces)
+        self._len -= len(data)
+        return data
+
+    def read_chunk(self):
+        " Removes and returns the next chunk, or what is left of it "
+        if not self._chunks:
+            return ''
+        chunk = self._chunks.popleft()
+        if self._offset:
+            chunk = chunk[self._offset:]
+            self._offset = 0
+        self._len -= len(chunk)
+        return chunk
+
+    def clear(self):
+        self._chunks.clear()
+        self._offset = 0
+        self._len = 0
+
+
+class TransferBudget(object):
+    """ Process-wide limit on the bytes that transfers hold in buffers
+
+    Each transfer takes a share and keeps it updated with how much it has
+    buffered. Once the total is over the limit, shares holding more than an
+    equal split of the limit report that they are over it, so their
+    transfers pause, while smaller transfers keep going. Paused transfers
+    are told to check again when usage goes down.
+
+    :param int limit: max number of bytes to buffer, or 0 for no limit
+    """
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.used = 0
+        self.shares = []
+
+    def share(self, listener):
+        """ Returns a new share of the budget.
+
+        :param listener: called with no arguments when a share that was over
+            the budget may no longer be
+        """
+        share = BudgetShare(self, listener)
+        self.shares.append(share)
+        return share
+
+    @property
+    def exhausted(self):
+        return bool(self.limit) and self.used > self.limit
+
+    @property
+    def fair_share(self):
+        return self.limit / max(len(self.shares), 1)
+
+    @property
+    def num_paused(self):
+        return len([share for share in self.shares if share.waiting])
+
+    def gauges(self):
+        " Returns callables for the current state of the budget, by name "
+        return {
+            'transfer.buffered_bytes': lambda: self.used,
+            'transfer.memory_budget': lambda: self.limit,
+            'transfer.paused': lambda: self.num_paused,
+        }
+
+    def _released(self):
+        for share in list(self.shares):
+            if share.waiting and not share._over:
+                share.waiting = False
+                share.listener()
+
+
+class BudgetShare(object):
+    " The part of a TransferBudget used by one transfer "
+    def __init__(self, budget, listener):
+        self.budget = budget
+        self.listener = listener
+        self.used = 0
+        self.waiting = False  # over the budget when it was last checked
+
+    def set(self, used):
+        " Sets the number of bytes this transfer holds "
+        change, self.used = used - self.used, used
+        self.budget.used += change
+        if change < 0:
+            self.budget._released()
+
+    @property
+    def _over(self):
+        return self.budget.exhausted and self.used > self.budget.fair_share
+
+    def check(self):
+        """ Returns True if this transfer should pause to stay within the
+        budget. The listener is then called once it may resume. """
+        self.waiting = self._over
+        return self.waiting
+
+    def close(self):
+        " Gives back everything this transfer holds "
+        if self in self.budget.shares:
+            self.budget.shares.remove(self)
+        self.waiting = False
+        self.budget.used -= self.used
+        self.used = 0
+        self.budget._released()
+
+
+# Request priorities for FairScheduler, lowest first
+PRIORITY_METADATA = 0
+PRIORITY_TRANSFER = 1
+
+
+class FairScheduler(object):
+    """ Shares a fixed number of request slots between users
+
+    Requests that can't start straight away wait in a queue per key (a user
+    or a session). When a slot frees up, it goes to the queue that has been
+    served the least for its weight, using start-time fair queuing, so one
+    user with many queued requests can't starve the others. Waiting
+    metadata requests (HEADs and listings) go before bulk transfers.
+
+    Requests that had to wait are counted in the scheduler.waited metric
+    and how long they waited in scheduler.wait_ms.
+
+    :param int max_concurrency: number of requests allowed at once
+    :param clock: provider of seconds(), defaults to the reactor
+    :param limiter: an AIMDLimiter that sets the number of requests allowed
+        at once instead of max_concurrency
+    """
+    def __init__(self, max_concurrency, clock=None, limiter=None):
+        self.max_concurrency = max_concurrency
+        self.clock = clock or reactor
+        self.limiter = limiter
+        self.active = 0
+        self.queued = 0
+        self.vtime = 0.0  # start tag of the last request given a slot
+        self.flows = {}
+        self._seq = 0  # breaks ties in favour of the oldest request
+        self._acquiring = None  # seq of the request acquire() is adding
+
+    def acquire(self, key, priority=PRIORITY_TRANSFER, weight=1):
+        """ Returns a Deferred that fires once the request may start. The
+        slot must then be given back with release().
+
+        :param key: who the request is for. Keys share slots fairly
+        :param int priority: PRIORITY_METADATA or PRIORITY_TRANSFER
+        :param weight: relative share of the slots this key gets
+        """
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = self.flows[key] = _Flow()
+        flow.weight = weight
+        d = defer.Deferred()
+        self._seq += 1
+        flow.waiting[priority].append((self._seq, d, self.clock.seconds()))
+        self.queued += 1
+        acquiring, self._acquiring = self._acquiring, self._seq
+        try:
+            self._dispatch()
+        finally:
+            self._acquiring = acquiring
+        return d
+
+    @property
+    def limit(self):
+        " The number of requests allowed at once "
+        if self.limiter:
+            return self.limiter.limit
+        return self.max_concurrency
+
+    def release(self, latency=None, overloaded=False):
+        """ Gives back a slot. With a limiter, the outcome of the request
+        is passed on to it.
+
+        :param float latency: seconds the request took, or None if that
+            says nothing about how busy swift is
+        :param bool overloaded: if swift was too busy to handle the request
+        """
+        self.active -= 1
+        if self.limiter and (latency is not None or overloaded):
+            self.limiter.record(latency, overloaded)
+        self._dispatch()
+
+    def gauges(self):
+        " Returns callables for the current state of the scheduler, by name "
+        gauges = {
+            'scheduler.active': lambda: self.active,
+            'scheduler.queued': lambda: self.queued,
+        }
+        if self.limiter:
+            gauges['scheduler.limit'] = lambda: self.limit
+        return gauges
+
+    def _dispatch(self):
+        while self.queued and self.active < self.limit:
+            best, best_rank = None, None
+            for key, flow in self.flows.items():
+                if not flow.queued:
+                    # Idle flows are kept until they have no credit left
+                    if flow.finish <= self.vtime:
+                        del self.flows[key]
+                    continue
+                priority = flow.priority
+                rank = (priority, max(flow.finish, self.vtime),
+                        flow.waiting[priority][0][0])
+                if best_rank is None or rank < best_rank:
+                    best, best_rank = flow, rank
+            self.vtime = best_rank[1]
+            best.finish = self.vtime + 1.0 / best.weight
+            seq, d, queued_at = best.waiting[best_rank[0]].popleft()
+            self.queued -= 1
+            self.active += 1
+            # Requests that start within their acquire() never waited
+            if seq != self._acquiring:
+                waited = self.clock.seconds() - queued_at
+                log.msg(metric='scheduler.waited')
+                log.msg(metric='scheduler.wait_ms',
+                        count=int(waited * 1000))
+            d.callback(None)
+
+
+class _Flow(object):
+    " Requests waiting in a FairScheduler for one key "
+    def __init__(self):
+        self.weight = 1
+        self.finish = 0.0  # virtual time that this flow's service ends at
+        self.waiting = {
+            PRIORITY_METADATA: deque(),
+            PRIORITY_TRANSFER: deque(),
+        }
+
+    @property
+    def queued(self):
+        return any(self.waiting.values())
+
+    @property
+    def priority(self):
+        for priority in sorted(self.waiting):
+            if self.waiting[priority]:
+                return priority
+
+
+class AIMDLimiter(object):
+    """ A concurrency limit that adapts to how swift is coping
+
+    Each request that succeeds while latency stays near the lowest seen
+    adds 1 / limit to the limit, so it grows by one for every full window
+    of requests (additive increase). Once latency rises above `tolerance`
+    times that baseline the limit stops growing. An overloaded response
+    (503, 429 or a timeout) multiplies the limit by `backoff`
+    (multiplicative decrease), at most once per round trip, so a burst of
+    errors from the same window only counts once. Each decrease is counted
+    in the limiter.decrease metric.
+
+    :param int initial: the starting limit
+    :param int min_limit: the limit never goes below this
+    :param int max_limit: the limit never goes above this
+    :param float backoff: factor to cut the limit by when overloaded
+    :param float tolerance: how far latency may rise above its baseline
+        while the limit still grows
+    :param clock: provider of seconds(), defaults to the reactor
+    """
+    # Weight given to each new sample in the smoothed latency
+    smoothing = 0.2
+    # How quickly the baseline latency drifts back up to the smoothed one
+    baseline_drift = 0.01
+
+    def __init__(self, initial, min_limit=1, max_limit=1000, backoff=0.5,
+                 tolerance=2.0, clock=None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.clock = clock or reactor
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self.latency = None  # smoothed latency of successful requests
+        self.baseline = None  # lowest latency seen, drifting upwards
+        self._hold_until = 0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def record(self, latency, overloaded=False):
+        """ Adjusts the limit for the outcome of a request
+
+        :param float latency: seconds the request took, or None if unknown
+        :param bool overloaded: if swift was too busy to handle it
+        """
+        if overloaded:
+            now = self.clock.seconds()
+            if now >= self._hold_until:
+                self._limit = max(self._limit * self.backoff, self.min_limit)
+                self._hold_until = now + max(self.latency or 0, latency or 0)
+                log.msg(metric='limiter.decrease')
+            return
+        if latency is None:
+            return
+
+        if self.latency is None:
+            self.latency = self.baseline = latency
+        else:
+            self.latency += (latency - self.latency) * self.smoothing
+            self.baseline = min(
+                latency, self.baseline +
+                (self.latency - self.baseline) * self.baseline_drift)
+        if self.latency <= self.baseline * self.tolerance:
+            self._limit = min(self._limit + 1.0 / self._limit,
+                              self.max_limit)
+
+
+class RetryPolicy(object):
+    """ Decides if and when a failed request is tried again
+
+    The wait before retry n is picked at random between 0 and
+    backoff * 2 ** (n - 1) seconds, capped at max_delay (exponential backoff
+    with full jitter), so requests that failed together don't all come back
+    at once.
+
+    Retries are also limited by a budget shared by every request. Each
+    request adds `budget_ratio` of a retry to it, up to `budget_burst`, and
+    each retry takes one away. When swift is down, requests keep failing,
+    but the retries stay a fraction of them instead of multiplying the
+    load. Retries are counted in the retry.attempt metric and those refused
+    by the budget in retry.budget_exhausted.
+
+    :param int max_retries: max number of retries for one request
+    :param float backoff: seconds to wait (at most) before the first retry
+    :param float max_delay: the longest wait before a retry
+    :param float budget_ratio: retries allowed per request
+    :param int budget_burst: max number of retries that can be saved up
+    :param clock: provider of callLater(), defaults to the reactor
+    :param rand: returns a random float in [0, 1)
+    """
+    def __init__(self, max_retries=3, backoff=0.1, max_delay=5.0,
+                 budget_ratio=0.1, budget_burst=10, clock=None,
+                 rand=random.random):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.clock = clock or reactor
+        self.rand = rand
+        self.tokens = float(budget_burst)
+
+    def request(self):
+        " Adds to the budget for a new request that may be retried "
+        self.tokens = min(self.tokens + self.budget_ratio, self.budget_burst)
+
+    def delay(self, attempt):
+        """ Returns how many seconds to wait before retry number `attempt`,
+        or None if the request shouldn't be retried """
+        if attempt > self.max_retries:
+            return None
+        if self.tokens < 1:
+            log.msg(metric='retry.budget_exhausted')
+            return None
+        self.tokens -= 1
+        log.msg(metric='retry.attempt')
+        return self.rand() * min(self.max_delay,
+                                 self.backoff * 2 ** (attempt - 1))
+
+    def gauges(self):
+        " Returns callables for the current state of the budget, by name "
+        return {
+            'retry.budget': lambda: int(self.tokens),
+        }
+
+
 class MetricCollector(object):
     """ Collects metrics using Twisted Logging
 